@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from clients import get_resource
+
+logger = logging.getLogger()
+
+class EmailCache:
+    """
+    User ID to email cache in front of Cognito.
+
+    Entries live in an in-process LRU of max_size users, kept for ttl_seconds,
+    which survives warm invocations. Users without an email are cached too,
+    for negative_ttl_seconds. When table_name is set, a DynamoDB table (hash
+    key user_id, TTL attribute expires_at) is shared by every container as a
+    second tier; failures there only cost a Cognito call.
+    """
+
+    def __init__(self, max_size=1000, ttl_seconds=3600, negative_ttl_seconds=300, table_name=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.table = get_resource('dynamodb').Table(table_name) if table_name else None
+        self.stats = {'hits': 0, 'negative_hits': 0, 'shared_hits': 0, 'misses': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns (found, email); email is None for a cached user without one"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.stats['negative_hits' if entry[0] is None else 'hits'] += 1
+                return True, entry[0]
+            if entry:
+                del self._entries[user_id]
+
+        item = self._get_shared(user_id, now)
+        if item is not None:
+            self._store_local(user_id, item.get('email'), float(item['expires_at']))
+            self.stats['shared_hits'] += 1
+            return True, item.get('email')
+
+        self.stats['misses'] += 1
+        return False, None
+
+    def put(self, user_id, email):
+        """Caches a lookup result; None records that the user has no email"""
+        expires_at = time.time() + (self.ttl_seconds if email else self.negative_ttl_seconds)
+        self._store_local(user_id, email, expires_at)
+        if self.table:
+            item = {'user_id': user_id, 'expires_at': int(expires_at)}
+            if email:
+                item['email'] = email
+            try:
+                self.table.put_item(Item=item)
+            except Exception as e:
+                logger.warning(f"Failed to store email in shared cache: {str(e)}")
+
+    def _store_local(self, user_id, email, expires_at):
+        with self._lock:
+            self._entries[user_id] = (email, expires_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, user_id, now):
+        if not self.table:
+            return None
+        try:
+            item = self.table.get_item(Key={'user_id': user_id}).get('Item')
+        except Exception as e:
+            logger.warning(f"Shared email cache unavailable: {str(e)}")
+            return None
+        # DynamoDB deletes expired items lazily, so check the expiry here
+        if not item or float(item.get('expires_at', 0)) <= now:
+            return None
+        return item
+
+    def hit_rate(self):
+        lookups = sum(self.stats.values())
+        return (lookups - self.stats['misses']) / lookups if lookups else 0.0
+
+    def log_stats(self):
+        logger.info(
+            f"Email cache: {self.stats['hits']} hits, {self.stats['negative_hits']} negative hits, "
+            f"{self.stats['shared_hits']} shared hits, {self.stats['misses']} misses "
+            f"({self.hit_rate():.0%} hit rate, {len(self._entries)} cached users)"
+        )
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the container's EmailCache, configured by EMAIL_CACHE_SIZE,
+    EMAIL_CACHE_TTL_SECONDS, EMAIL_CACHE_NEGATIVE_TTL_SECONDS and EMAIL_CACHE_TABLE
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmailCache(
+                    max_size=int(os.environ.get('EMAIL_CACHE_SIZE', '1000')),
+                    ttl_seconds=int(os.environ.get('EMAIL_CACHE_TTL_SECONDS', '3600')),
+                    negative_ttl_seconds=int(os.environ.get('EMAIL_CACHE_NEGATIVE_TTL_SECONDS', '300')),
+                    table_name=os.environ.get('EMAIL_CACHE_TABLE') or None
+                )
+    return _cache
+
+def reset():
+    """Drops the container's cache, e.g. between tests"""
+    global _cache
+    with _cache_lock:
+        _cache = None
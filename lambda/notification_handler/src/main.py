@@ -1,29 +1,65 @@
 import json
 import os
-import boto3
+import re
+import time
 import logging
 from botocore.exceptions import ClientError
+from clients import get_client
+import email_cache
+from send_scheduler import get_scheduler
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def get_user_email(cognito, user_pool_id, user_id):
+# SES accepts at most 50 destinations per bulk call
+MAX_BULK_DESTINATIONS = 50
+
+TEMPLATE_FIELDS = ('video_id', 'output_url', 'error')
+
+# Bulk send statuses worth retrying, and the one meaning nothing more goes out today
+RETRYABLE_STATUSES = ('AccountThrottled', 'TransientFailure')
+DAILY_QUOTA_STATUS = 'AccountDailyQuotaExceeded'
+
+# SQS accepts at most 10 messages per batch and delays of up to 15 minutes
+MAX_QUEUE_BATCH = 10
+MAX_DEFER_SECONDS = 900
+
+# Time left for deferring notifications before the invocation times out
+DEADLINE_MARGIN_SECONDS = 5
+
+# SES templates registered by this container
+_registered_templates = set()
+
+class DeferralFailed(Exception):
+    """
+    SNS notifications could neither be sent nor queued. Raised out of the
+    handler, so that Lambda retries the asynchronous SNS invocation instead
+    of the notifications being dropped.
+    """
+
+def get_user_email(cognito, user_pool_id, user_id, cache=None):
     """
-    Get user email from Cognito
+    Get user email, from the cache or else from Cognito.
+    Users without an email are cached too; lookup errors are not.
     """
+    cache = cache or email_cache.get_cache()
+    found, email = cache.get(user_id)
+    if found:
+        return email
+
     try:
         response = cognito.admin_get_user(
             UserPoolId=user_pool_id,
             Username=user_id
         )
-        for attr in response['UserAttributes']:
-            if attr['Name'] == 'email':
-                return attr['Value']
-        return None
     except Exception as e:
         logger.error(f"Error getting user email: {str(e)}")
         return None
 
+    email = next((attr['Value'] for attr in response['UserAttributes'] if attr['Name'] == 'email'), None)
+    cache.put(user_id, email)
+    return email
+
 def send_email(ses, sender, recipient, subject, body):
     """
     Send email using SES
@@ -80,55 +116,281 @@ def get_email_template(status, video_id, output_url=None, error=None):
     
     return subject, body
 
-def handler(event, context):
+def template_name(status):
     """
-    Lambda handler for sending notifications about video processing status
+    SES template name for a status, prefixed by EMAIL_TEMPLATE_PREFIX
     """
+    prefix = os.environ.get('EMAIL_TEMPLATE_PREFIX', 'video-processing')
+    return f"{prefix}-{re.sub(r'[^a-z0-9_-]', '_', status.lower())}"
+
+def ensure_template(ses, status):
+    """
+    Register the SES template for a status from get_email_template, once per container
+    """
+    name = template_name(status)
+    if name in _registered_templates:
+        return name
+
+    subject, body = get_email_template(status, *('{{' + field + '}}' for field in TEMPLATE_FIELDS))
+    template = {'TemplateName': name, 'SubjectPart': subject, 'HtmlPart': body}
     try:
-        # Parse SNS message
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        user_id = message['user_id']
-        video_id = message['video_id']
-        status = message['status']
-        output_url = message.get('output_url')
-        error = message.get('error')
-
-        # Initialize AWS clients
-        cognito = boto3.client('cognito-idp')
-        ses = boto3.client('ses')
-
-        # Get user email from Cognito
-        user_email = get_user_email(
-            cognito,
-            os.environ['COGNITO_USER_POOL_ID'],
-            user_id
+        ses.create_template(Template=template)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'AlreadyExists':
+            raise
+        # Keep the stored template in line with get_email_template
+        ses.update_template(Template=template)
+
+    _registered_templates.add(name)
+    return name
+
+def template_data(message):
+    return json.dumps({field: str(message.get(field) or '') for field in TEMPLATE_FIELDS})
+
+def send_bulk_email(ses, sender, template, destinations, scheduler=None, deadline=None):
+    """
+    Send a templated email to each (recipient, message) pair with SES bulk sending,
+    paced to the account's send rate.
+    Returns True (sent), False (failed) or None (deferred) for each destination, in order.
+    """
+    scheduler = scheduler or get_scheduler(ses)
+
+    def send_batch(batch):
+        response = ses.send_bulk_templated_email(
+            Source=sender,
+            Template=template,
+            DefaultTemplateData=template_data({}),
+            Destinations=[
+                {
+                    'Destination': {'ToAddresses': [recipient]},
+                    'ReplacementTemplateData': template_data(message)
+                }
+                for recipient, message in batch
+            ]
         )
+        outcomes = []
+        for status in response['Status']:
+            if status['Status'] == DAILY_QUOTA_STATUS:
+                scheduler.quota_exhausted = True
+            if status['Status'] in RETRYABLE_STATUSES + (DAILY_QUOTA_STATUS,):
+                outcomes.append(None)
+            else:
+                if status['Status'] != 'Success':
+                    logger.error(f"Error sending bulk email: {status['Status']} {status.get('Error', '')}")
+                outcomes.append(status['Status'] == 'Success')
+        return outcomes
 
-        if not user_email:
-            raise Exception(f"Could not find email for user {user_id}")
+    results = []
+    size = scheduler.batch_size(MAX_BULK_DESTINATIONS)
+    for start in range(0, len(destinations), size):
+        results.extend(scheduler.send(destinations[start:start + size], send_batch, deadline))
+    return results
 
-        # Generate email content
-        subject, body = get_email_template(status, video_id, output_url, error)
+def send_notifications(ses, sender, status, destinations, scheduler=None, deadline=None):
+    """
+    Send the notifications for one status.
+    Returns True (sent), False (failed) or None (deferred) for each destination.
+    """
+    scheduler = scheduler or get_scheduler(ses)
+    try:
+        template = ensure_template(ses, status)
+    except Exception as e:
+        logger.error(f"Error registering email template for {status}, sending individually: {str(e)}")
+
+        def send_one(batch):
+            (recipient, message), = batch
+            subject, body = get_email_template(
+                status, message['video_id'], message.get('output_url'), message.get('error')
+            )
+            ses.send_email(
+                Source=sender,
+                Destination={'ToAddresses': [recipient]},
+                Message={'Subject': {'Data': subject}, 'Body': {'Html': {'Data': body}}}
+            )
+            return [True]
 
-        # Send email
-        if not send_email(
-            ses,
-            os.environ['SENDER_EMAIL'],
-            user_email,
-            subject,
-            body
-        ):
-            raise Exception("Failed to send email notification")
+        return [scheduler.send([destination], send_one, deadline)[0] for destination in destinations]
+
+    return send_bulk_email(ses, sender, template, destinations, scheduler, deadline)
+
+def defer_notifications(sqs, queue_url, messages, delay_seconds):
+    """
+    Send notification messages back to the queue to be retried after delay_seconds.
+    Returns whether each message was queued.
+    """
+    queued = []
+    for start in range(0, len(messages), MAX_QUEUE_BATCH):
+        batch = messages[start:start + MAX_QUEUE_BATCH]
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {
+                        'Id': str(i),
+                        'MessageBody': json.dumps(message),
+                        'DelaySeconds': min(int(delay_seconds), MAX_DEFER_SECONDS)
+                    }
+                    for i, message in enumerate(batch)
+                ]
+            )
+            failed_ids = {entry['Id'] for entry in response.get('Failed', [])}
+            queued.extend(str(i) not in failed_ids for i in range(len(batch)))
+        except Exception as e:
+            logger.error(f"Error deferring notifications: {str(e)}")
+            queued.extend([False] * len(batch))
+    return queued
+
+def invocation_deadline(context):
+    """
+    time.monotonic() value by which sending must stop to leave time for deferring
+    """
+    try:
+        remaining = context.get_remaining_time_in_millis() / 1000
+    except (AttributeError, TypeError):
+        return None
+    return time.monotonic() + remaining - DEADLINE_MARGIN_SECONDS
+
+def defer_overflow(messages, scheduler):
+    """
+    Queue the notifications SES could not take for a later invocation.
+    Returns whether each message was queued; none are without NOTIFICATION_QUEUE_URL.
+    """
+    if not messages:
+        return []
+
+    queue_url = os.environ.get('NOTIFICATION_QUEUE_URL')
+    if not queue_url:
+        return [False] * len(messages)
+    delay = MAX_DEFER_SECONDS if scheduler.quota_exhausted else int(os.environ.get('NOTIFICATION_DEFER_SECONDS', '60'))
+    return defer_notifications(get_client('sqs'), queue_url, messages, delay)
+
+def batch_item_failures(records):
+    """
+    batchItemFailures entries for the records delivered by an SQS queue (deferred
+    notifications), so that the event source redelivers them instead of deleting them
+    """
+    return [
+        {'itemIdentifier': record['messageId']}
+        for record in records
+        if 'Sns' not in record and record.get('messageId')
+    ]
+
+def handler(event, context):
+    """
+    Lambda handler for sending notifications about video processing status.
+    Every SNS (or deferred SQS) record in the event is handled; records are
+    grouped by status so each group is sent with as few SES calls as possible.
+    Notifications SES cannot take in time are deferred to NOTIFICATION_QUEUE_URL.
+
+    Nothing is dropped silently: SQS records whose notification failed or could
+    not be deferred are returned in batchItemFailures, and SNS notifications
+    that could not be deferred raise DeferralFailed.
+    """
+    try:
+        # Shared AWS clients, reused across warm invocations
+        cognito = get_client('cognito-idp')
+        ses = get_client('ses')
+
+        scheduler = get_scheduler(ses)
+        deadline = invocation_deadline(context)
+
+        sent = []
+        failed = []
+        deferred = []
+        overflow = []
+        # Records whose notification did not go out, to be handed back to their source
+        retry = []
+        groups = {}
+        for record in event['Records']:
+            try:
+                # Parse SNS message, or one deferred to the queue by an earlier invocation
+                message = json.loads(record['Sns']['Message'] if 'Sns' in record else record['body'])
+                user_id = message['user_id']
+                video_id = message['video_id']
+                status = message['status']
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Invalid notification record: {str(e)}")
+                failed.append({'error': f"Invalid notification record: {str(e)}"})
+                retry.append(record)
+                continue
+
+            # Get user email from Cognito
+            user_email = get_user_email(
+                cognito,
+                os.environ['COGNITO_USER_POOL_ID'],
+                user_id
+            )
+
+            if not user_email:
+                failed.append({
+                    'user_id': user_id,
+                    'video_id': video_id,
+                    'error': f"Could not find email for user {user_id}"
+                })
+                retry.append(record)
+                continue
+
+            groups.setdefault(status, []).append((user_email, message, record))
+
+        for status, entries in groups.items():
+            results = send_notifications(
+                ses, os.environ['SENDER_EMAIL'], status,
+                [(user_email, message) for user_email, message, _ in entries], scheduler, deadline
+            )
+            for (_, message, record), success in zip(entries, results):
+                notification = {'user_id': message['user_id'], 'video_id': message['video_id']}
+                if success:
+                    sent.append(notification)
+                elif success is None:
+                    overflow.append((message, record))
+                else:
+                    failed.append({**notification, 'error': "Failed to send email notification"})
+                    retry.append(record)
+
+        undeferred = []
+        for (message, record), queued in zip(overflow, defer_overflow([m for m, _ in overflow], scheduler)):
+            notification = {'user_id': message['user_id'], 'video_id': message['video_id']}
+            if queued:
+                deferred.append(notification)
+            else:
+                failed.append({**notification, 'error': "SES send rate exceeded and the notification could not be deferred"})
+                retry.append(record)
+                undeferred.append(record)
+
+        logger.info(
+            f"Sent {len(sent)} notifications in {len(groups)} status groups, "
+            f"{len(deferred)} deferred, {len(failed)} failed"
+        )
+
+        if any('Sns' in record for record in undeferred):
+            raise DeferralFailed(f"{len(undeferred)} notifications could not be sent or deferred")
+
+        if failed:
+            return {
+                'statusCode': 500,
+                'body': json.dumps({
+                    'message': 'Error sending notification',
+                    'error': f"{len(failed)} of {len(sent) + len(failed)} notifications failed",
+                    'sent': sent,
+                    'deferred': deferred,
+                    'failed': failed
+                }),
+                'batchItemFailures': batch_item_failures(retry)
+            }
 
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Notification sent successfully',
-                'user_id': user_id,
-                'video_id': video_id
-            })
+                'sent': sent,
+                'deferred': deferred
+            }),
+            'batchItemFailures': []
         }
 
+    except DeferralFailed:
+        raise
+
     except Exception as e:
         logger.error(f"Error sending notification: {str(e)}")
         return {
@@ -136,5 +398,9 @@ def handler(event, context):
             'body': json.dumps({
                 'message': 'Error sending notification',
                 'error': str(e)
-            })
-        }
\ No newline at end of file
+            }),
+            'batchItemFailures': batch_item_failures(event.get('Records') or [])
+        }
+
+    finally:
+        email_cache.get_cache().log_stats()
@@ -0,0 +1,208 @@
+import os
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# SES sandbox send rate, used when the quota cannot be read
+DEFAULT_SEND_RATE = 1.0
+
+# How often a warm container re-reads the account's send quota
+QUOTA_REFRESH_SECONDS = 300
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailable')
+
+def is_throttling(error):
+    """Whether a botocore ClientError means "slow down" rather than "this will never work" """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+def is_daily_quota_error(error):
+    response = getattr(error, 'response', None) or {}
+    return 'daily message quota' in response.get('Error', {}).get('Message', '').lower()
+
+class TokenBucket:
+    """
+    Allows rate tokens per second with bursts of up to capacity tokens
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def acquire(self, tokens=1, deadline=None):
+        """
+        Waits until tokens are available and takes them. Returns False without
+        taking any when they would not be available before deadline.
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = self._refill()
+                # Allow for rounding, or sleeping exactly the computed wait may fall short
+                if self.tokens >= tokens - 1e-9:
+                    self.tokens = max(self.tokens - tokens, 0.0)
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            self._sleep(wait)
+
+class SendScheduler:
+    """
+    Paces sends to the account's SES send rate.
+
+    The rate starts at the quota's MaxSendRate (times SES_SEND_RATE_FRACTION,
+    for functions running many containers at once), is halved whenever SES
+    throttles and recovers by a tenth of the quota per successful send. Throttled
+    sends are retried with full-jitter exponential backoff; whatever is still
+    unsent when the attempts or the deadline run out is reported as deferred.
+    """
+
+    def __init__(self, max_rate, max_attempts=5, base_delay=0.5, max_delay=20.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = max_rate
+        self.min_rate = min(max_rate, DEFAULT_SEND_RATE)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(max_rate, clock=clock, sleep=sleep)
+        self.quota_exhausted = False
+        self.throttled = 0
+        self._clock = clock
+        self._sleep = sleep
+
+    @classmethod
+    def from_quota(cls, ses, **kwargs):
+        """Sizes a scheduler from get_send_quota, falling back to the sandbox rate"""
+        fraction = float(os.environ.get('SES_SEND_RATE_FRACTION', '1.0'))
+        try:
+            quota = ses.get_send_quota()
+            max_rate = float(quota['MaxSendRate'])
+            max_daily = float(quota['Max24HourSend'])
+            sent_today = float(quota['SentLast24Hours'])
+        except Exception as e:
+            logger.warning(f"Could not read SES send quota, assuming {DEFAULT_SEND_RATE}/s: {str(e)}")
+            return cls(DEFAULT_SEND_RATE, **kwargs)
+
+        scheduler = cls(max(max_rate * fraction, 0.1), **kwargs)
+        # Max24HourSend is -1 for accounts without a daily limit
+        if 0 <= max_daily <= sent_today:
+            scheduler.quota_exhausted = True
+        return scheduler
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def batch_size(self, limit):
+        """Largest batch that fits in one burst of the bucket"""
+        return max(1, min(limit, int(self.bucket.capacity)))
+
+    def acquire(self, tokens, deadline=None):
+        return not self.quota_exhausted and self.bucket.acquire(tokens, deadline)
+
+    def on_throttled(self):
+        self.throttled += 1
+        self.bucket.set_rate(max(self.rate / 2, self.min_rate))
+        logger.warning(f"SES throttled, send rate lowered to {self.rate:.2f}/s")
+
+    def on_success(self, count):
+        if self.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.rate + self.max_rate * 0.1 * count))
+
+    def backoff(self, attempt, deadline=None):
+        """Sleeps a jittered exponential delay; returns False if it would pass deadline"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if deadline is not None and self._clock() + delay > deadline:
+            return False
+        self._sleep(delay)
+        return True
+
+    def send(self, items, send_batch, deadline=None):
+        """
+        Sends items with send_batch(items), which returns one outcome per item:
+        True when sent, False when it failed for good or None when it should be
+        retried. A throttling ClientError retries the whole batch.
+
+        Returns True, False or None (deferred: not sent yet) for each item.
+        """
+        results = [None] * len(items)
+        pending = list(range(len(items)))
+        attempt = 0
+        while pending:
+            if not self.acquire(len(pending), deadline):
+                break
+            try:
+                outcomes = send_batch([items[i] for i in pending])
+            except Exception as e:
+                if is_daily_quota_error(e):
+                    self.quota_exhausted = True
+                    break
+                if not is_throttling(e):
+                    logger.error(f"Error sending email: {str(e)}")
+                    for i in pending:
+                        results[i] = False
+                    break
+                outcomes = [None] * len(pending)
+
+            retry = []
+            for i, outcome in zip(pending, outcomes):
+                if outcome is None:
+                    retry.append(i)
+                else:
+                    results[i] = outcome
+            if retry:
+                self.on_throttled()
+            else:
+                self.on_success(len(pending))
+
+            pending = retry
+            attempt += 1
+            if pending and (attempt >= self.max_attempts or self.quota_exhausted
+                            or not self.backoff(attempt, deadline)):
+                break
+        return results
+
+_scheduler = None
+_refreshed_at = 0
+_lock = threading.Lock()
+
+def get_scheduler(ses):
+    """
+    Returns the container's SendScheduler, re-reading the quota every
+    QUOTA_REFRESH_SECONDS so raised limits and a new day are picked up
+    """
+    global _scheduler, _refreshed_at
+    with _lock:
+        if _scheduler is None or time.monotonic() - _refreshed_at > QUOTA_REFRESH_SECONDS:
+            _scheduler = SendScheduler.from_quota(
+                ses, max_attempts=int(os.environ.get('SES_MAX_ATTEMPTS', '5'))
+            )
+            _refreshed_at = time.monotonic()
+        return _scheduler
+
+def reset():
+    """Drops the container's scheduler, e.g. between tests"""
+    global _scheduler, _refreshed_at
+    with _lock:
+        _scheduler = None
+        _refreshed_at = 0
@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# Lambda runs main.py from the package root, so src/ modules import each other
+# as top-level modules; mirror that layout here.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import clients
+import email_cache
+import send_scheduler
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    clients.reset()
+    email_cache.reset()
+    send_scheduler.reset()
+    yield
+    clients.reset()
+    email_cache.reset()
+    send_scheduler.reset()
@@ -1,7 +1,26 @@
 import pytest
 import json
 from unittest.mock import Mock, patch
-from src.main import handler, get_user_email, send_email, get_email_template
+from botocore.exceptions import ClientError
+import clients
+import email_cache
+import src.main
+from src.main import handler, get_user_email, send_email, get_email_template, ensure_template, send_bulk_email, DeferralFailed
+from send_scheduler import SendScheduler, TokenBucket
+
+@pytest.fixture(autouse=True)
+def reset_templates():
+    src.main._registered_templates.clear()
+    yield
+    src.main._registered_templates.clear()
+
+SEND_QUOTA = {'Max24HourSend': 50000.0, 'MaxSendRate': 100.0, 'SentLast24Hours': 0.0}
+
+def bulk_success(**kwargs):
+    return {'Status': [{'Status': 'Success', 'MessageId': str(i)} for i, _ in enumerate(kwargs['Destinations'])]}
+
+def sns_event(*messages):
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}} for message in messages]}
 
 @pytest.fixture
 def mock_event():
@@ -20,21 +39,20 @@ def mock_event():
 
 @pytest.fixture
 def mock_context():
-    return Mock()
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    return context
 
 @pytest.fixture
 def mock_aws_clients():
-    with patch('boto3.client') as mock_client:
-        cognito = Mock()
-        ses = Mock()
-        
-        def get_mock_client(service):
-            if service == 'cognito-idp':
-                return cognito
-            return ses
-        
-        mock_client.side_effect = get_mock_client
-        yield cognito, ses
+    cognito = Mock()
+    ses = Mock()
+    ses.send_bulk_templated_email.side_effect = bulk_success
+    ses.get_send_quota.return_value = SEND_QUOTA
+
+    clients.set_client('cognito-idp', cognito)
+    clients.set_client('ses', ses)
+    yield cognito, ses
 
 def test_get_user_email():
     cognito = Mock()
@@ -70,6 +88,107 @@ def test_get_user_email_error():
     
     assert email is None
 
+def test_get_user_email_cached():
+    cognito = Mock()
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') == 'test@example.com'
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') == 'test@example.com'
+
+    cognito.admin_get_user.assert_called_once()
+    cache = email_cache.get_cache()
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+    assert cache.hit_rate() == 0.5
+
+def test_get_user_email_caches_missing_email():
+    cognito = Mock()
+    cognito.admin_get_user.return_value = {'UserAttributes': []}
+
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') is None
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') is None
+
+    cognito.admin_get_user.assert_called_once()
+    assert email_cache.get_cache().stats['negative_hits'] == 1
+
+def test_get_user_email_does_not_cache_errors():
+    cognito = Mock()
+    cognito.admin_get_user.side_effect = [
+        Exception('Throttled'),
+        {'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]}
+    ]
+
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') is None
+    assert get_user_email(cognito, 'user-pool-id', 'test-user') == 'test@example.com'
+    assert cognito.admin_get_user.call_count == 2
+
+def test_email_cache_expiry_and_eviction():
+    cache = email_cache.EmailCache(max_size=2, ttl_seconds=60, negative_ttl_seconds=1)
+
+    with patch('email_cache.time.time', return_value=1000):
+        cache.put('a', 'a@example.com')
+        cache.put('b', None)
+        cache.get('a')
+        cache.put('c', 'c@example.com')
+
+        # 'b' was least recently used
+        assert cache.get('b') == (False, None)
+        assert cache.get('a') == (True, 'a@example.com')
+
+    with patch('email_cache.time.time', return_value=1061):
+        assert cache.get('a') == (False, None)
+
+def test_email_cache_shared_table():
+    table = Mock()
+    dynamodb = Mock()
+    dynamodb.Table.return_value = table
+    clients.set_resource('dynamodb', dynamodb)
+    table.get_item.return_value = {
+        'Item': {'user_id': 'test-user', 'email': 'test@example.com', 'expires_at': 2000}
+    }
+
+    cache = email_cache.EmailCache(table_name='email-cache')
+    with patch('email_cache.time.time', return_value=1000):
+        assert cache.get('test-user') == (True, 'test@example.com')
+        # Now served from the local tier
+        assert cache.get('test-user') == (True, 'test@example.com')
+        cache.put('other-user', 'other@example.com')
+
+    dynamodb.Table.assert_called_with('email-cache')
+    table.get_item.assert_called_once_with(Key={'user_id': 'test-user'})
+    table.put_item.assert_called_with(Item={
+        'user_id': 'other-user', 'email': 'other@example.com', 'expires_at': 4600
+    })
+    assert cache.stats['shared_hits'] == 1
+    assert cache.stats['hits'] == 1
+
+def test_email_cache_shared_table_errors():
+    table = Mock()
+    table.get_item.side_effect = Exception('DynamoDB error')
+    table.put_item.side_effect = Exception('DynamoDB error')
+    dynamodb = Mock()
+    dynamodb.Table.return_value = table
+    clients.set_resource('dynamodb', dynamodb)
+
+    cache = email_cache.EmailCache(table_name='email-cache')
+    assert cache.get('test-user') == (False, None)
+    cache.put('test-user', 'test@example.com')
+    assert cache.get('test-user') == (True, 'test@example.com')
+
+def test_handler_reuses_cached_email(mock_event, mock_context, mock_aws_clients):
+    mock_cognito, mock_ses = mock_aws_clients
+    mock_cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+
+    assert handler(mock_event, mock_context)['statusCode'] == 200
+    assert handler(mock_event, mock_context)['statusCode'] == 200
+
+    mock_cognito.admin_get_user.assert_called_once()
+    assert mock_ses.send_bulk_templated_email.call_count == 2
+
 def test_send_email():
     ses = Mock()
     
@@ -130,19 +249,24 @@ def test_handler_success(mock_event, mock_context, mock_aws_clients):
         ]
     }
     
-    # Mock SES response
-    ses.send_email.return_value = {'MessageId': 'test-message-id'}
-    
     response = handler(mock_event, mock_context)
     
     assert response['statusCode'] == 200
     response_body = json.loads(response['body'])
     assert response_body['message'] == 'Notification sent successfully'
-    assert response_body['user_id'] == 'test-user'
-    assert response_body['video_id'] == 'test-video-123'
-    
-    # Verify email was sent
-    ses.send_email.assert_called_once()
+    assert response_body['sent'] == [{'user_id': 'test-user', 'video_id': 'test-video-123'}]
+    
+    # Verify email was sent from the registered template
+    ses.create_template.assert_called_once()
+    ses.send_bulk_templated_email.assert_called_once()
+    kwargs = ses.send_bulk_templated_email.call_args.kwargs
+    assert kwargs['Template'] == 'video-processing-completed'
+    assert kwargs['Destinations'][0]['Destination'] == {'ToAddresses': ['test@example.com']}
+    assert json.loads(kwargs['Destinations'][0]['ReplacementTemplateData']) == {
+        'video_id': 'test-video-123',
+        'output_url': 's3://test-bucket/test.zip',
+        'error': ''
+    }
 
 def test_handler_no_user_email(mock_event, mock_context, mock_aws_clients):
     cognito, ses = mock_aws_clients
@@ -158,7 +282,7 @@ def test_handler_no_user_email(mock_event, mock_context, mock_aws_clients):
     assert 'Could not find email' in response['body']
     
     # Verify email was not sent
-    ses.send_email.assert_not_called()
+    ses.send_bulk_templated_email.assert_not_called()
 
 def test_handler_cognito_error(mock_event, mock_context, mock_aws_clients):
     cognito, ses = mock_aws_clients
@@ -172,7 +296,7 @@ def test_handler_cognito_error(mock_event, mock_context, mock_aws_clients):
     assert 'Error sending notification' in response['body']
     
     # Verify email was not sent
-    ses.send_email.assert_not_called()
+    ses.send_bulk_templated_email.assert_not_called()
 
 def test_handler_ses_error(mock_event, mock_context, mock_aws_clients):
     cognito, ses = mock_aws_clients
@@ -185,13 +309,271 @@ def test_handler_ses_error(mock_event, mock_context, mock_aws_clients):
     }
     
     # Mock SES error
-    ses.send_email.side_effect = Exception('SES error')
+    ses.send_bulk_templated_email.side_effect = Exception('SES error')
     
     response = handler(mock_event, mock_context)
     
     assert response['statusCode'] == 500
     assert 'Error sending notification' in response['body']
 
+def test_handler_batches_records_by_status(mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.side_effect = lambda UserPoolId, Username: {
+        'UserAttributes': [{'Name': 'email', 'Value': f'{Username}@example.com'}]
+    }
+    event = sns_event(
+        {'user_id': 'a', 'video_id': 'v1', 'status': 'COMPLETED', 'output_url': 's3://out/v1.zip'},
+        {'user_id': 'b', 'video_id': 'v2', 'status': 'ERROR', 'error': 'Corrupt video'},
+        {'user_id': 'c', 'video_id': 'v3', 'status': 'COMPLETED', 'output_url': 's3://out/v3.zip'}
+    )
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert len(json.loads(response['body'])['sent']) == 3
+    assert ses.create_template.call_count == 2
+    calls = {call.kwargs['Template']: call.kwargs for call in ses.send_bulk_templated_email.call_args_list}
+    assert set(calls) == {'video-processing-completed', 'video-processing-error'}
+    assert [d['Destination']['ToAddresses'] for d in calls['video-processing-completed']['Destinations']] == [
+        ['a@example.com'], ['c@example.com']
+    ]
+    ses.send_email.assert_not_called()
+
+def test_handler_reports_partial_failures(mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.side_effect = lambda UserPoolId, Username: {
+        'UserAttributes': [{'Name': 'email', 'Value': f'{Username}@example.com'}] if Username != 'b' else []
+    }
+    ses.send_bulk_templated_email.side_effect = lambda **kwargs: {
+        'Status': [{'Status': 'Success'}, {'Status': 'MessageRejected', 'Error': 'Rejected'}]
+    }
+    event = sns_event(
+        {'user_id': 'a', 'video_id': 'v1', 'status': 'COMPLETED'},
+        {'user_id': 'b', 'video_id': 'v2', 'status': 'COMPLETED'},
+        {'user_id': 'c', 'video_id': 'v3', 'status': 'COMPLETED'}
+    )
+    event['Records'].append({'Sns': {'Message': 'not json'}})
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 500
+    body = json.loads(response['body'])
+    assert body['sent'] == [{'user_id': 'a', 'video_id': 'v1'}]
+    assert [f.get('video_id') for f in body['failed']] == ['v2', None, 'v3']
+    assert 'Could not find email' in body['failed'][0]['error']
+    assert 'Invalid notification record' in body['failed'][1]['error']
+
+def test_ensure_template_registers_once():
+    ses = Mock()
+    ses.create_template.side_effect = ClientError(
+        {'Error': {'Code': 'AlreadyExists', 'Message': 'exists'}}, 'CreateTemplate'
+    )
+
+    assert ensure_template(ses, 'COMPLETED') == 'video-processing-completed'
+    assert ensure_template(ses, 'COMPLETED') == 'video-processing-completed'
+
+    ses.create_template.assert_called_once()
+    template = ses.update_template.call_args.kwargs['Template']
+    assert template['SubjectPart'] == 'Video Processing Completed'
+    assert '{{video_id}}' in template['HtmlPart']
+    assert '{{output_url}}' in template['HtmlPart']
+
+def test_send_bulk_email_splits_batches():
+    ses = Mock()
+    ses.send_bulk_templated_email.side_effect = bulk_success
+    destinations = [(f'user{i}@example.com', {'video_id': str(i)}) for i in range(120)]
+
+    results = send_bulk_email(ses, 'sender@example.com', 'template', destinations, SendScheduler(100))
+
+    assert results == [True] * 120
+    assert [len(call.kwargs['Destinations']) for call in ses.send_bulk_templated_email.call_args_list] == [50, 50, 20]
+
+def test_handler_falls_back_without_template(mock_event, mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+    ses.create_template.side_effect = ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': 'denied'}}, 'CreateTemplate'
+    )
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    ses.send_bulk_templated_email.assert_not_called()
+    ses.send_email.assert_called_once()
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Maximum sending rate exceeded.'}}, 'SendBulkTemplatedEmail')
+
+def test_token_bucket_paces_to_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+
+    for _ in range(40):
+        assert bucket.acquire()
+
+    # The first 10 are the initial burst, the remaining 30 take 3 seconds
+    assert clock.now == pytest.approx(3.0)
+    assert not bucket.acquire(10, deadline=clock.now + 0.5)
+    assert bucket.acquire(10, deadline=clock.now + 1.0)
+
+def test_scheduler_retries_throttling_with_backoff():
+    clock = FakeClock()
+    scheduler = SendScheduler(8, clock=clock, sleep=clock.sleep)
+    send_batch = Mock(side_effect=[throttling_error(), [True, None], [True]])
+
+    results = scheduler.send(['a', 'b'], send_batch)
+
+    assert results == [True, True]
+    assert [call.args[0] for call in send_batch.call_args_list] == [['a', 'b'], ['a', 'b'], ['b']]
+    assert scheduler.throttled == 2
+    assert scheduler.rate < 8
+    assert len(clock.sleeps) >= 2
+
+def test_scheduler_defers_when_attempts_run_out():
+    clock = FakeClock()
+    scheduler = SendScheduler(8, max_attempts=3, clock=clock, sleep=clock.sleep)
+    send_batch = Mock(side_effect=throttling_error())
+
+    assert scheduler.send(['a', 'b'], send_batch) == [None, None]
+    assert send_batch.call_count == 3
+
+def test_scheduler_defers_past_deadline():
+    clock = FakeClock()
+    scheduler = SendScheduler(1, clock=clock, sleep=clock.sleep)
+    send_batch = Mock(return_value=[True])
+
+    results = [scheduler.send([i], send_batch, deadline=2.5)[0] for i in range(5)]
+
+    assert results == [True, True, True, None, None]
+
+def test_scheduler_from_quota():
+    ses = Mock()
+    ses.get_send_quota.return_value = {'Max24HourSend': 200.0, 'MaxSendRate': 14.0, 'SentLast24Hours': 200.0}
+
+    with patch.dict('os.environ', {'SES_SEND_RATE_FRACTION': '0.5'}):
+        scheduler = SendScheduler.from_quota(ses)
+
+    assert scheduler.rate == 7.0
+    assert scheduler.batch_size(50) == 7
+    assert scheduler.quota_exhausted
+    assert not scheduler.acquire(1)
+
+def test_handler_defers_throttled_notifications(mock_event, mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+    ses.send_bulk_templated_email.side_effect = lambda **kwargs: {
+        'Status': [{'Status': 'AccountDailyQuotaExceeded'}]
+    }
+    sqs = Mock()
+    sqs.send_message_batch.return_value = {'Successful': [{'Id': '0'}], 'Failed': []}
+    clients.set_client('sqs', sqs)
+
+    with patch.dict('os.environ', {'NOTIFICATION_QUEUE_URL': 'https://sqs/notifications'}):
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['deferred'] == [{'user_id': 'test-user', 'video_id': 'test-video-123'}]
+    kwargs = sqs.send_message_batch.call_args.kwargs
+    assert kwargs['QueueUrl'] == 'https://sqs/notifications'
+    entry = kwargs['Entries'][0]
+    assert entry['DelaySeconds'] == 900
+    assert json.loads(entry['MessageBody'])['video_id'] == 'test-video-123'
+
+    # The deferred message is sent when the queue delivers it back
+    ses.send_bulk_templated_email.side_effect = bulk_success
+    src.main.get_scheduler(ses).quota_exhausted = False
+    response = handler({'Records': [{'body': entry['MessageBody']}]}, mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['sent'] == [{'user_id': 'test-user', 'video_id': 'test-video-123'}]
+
+def test_handler_fails_throttled_notifications_without_queue(mock_event, mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+    ses.get_send_quota.return_value = {**SEND_QUOTA, 'SentLast24Hours': 50000.0}
+
+    # Raising makes Lambda retry the SNS invocation rather than drop the email
+    with pytest.raises(DeferralFailed):
+        handler(mock_event, mock_context)
+    ses.send_bulk_templated_email.assert_not_called()
+
+def sqs_event(*messages):
+    return {'Records': [{'messageId': f'm{i}', 'body': json.dumps(message)} for i, message in enumerate(messages)]}
+
+def test_handler_returns_failed_queue_records(mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.side_effect = lambda UserPoolId, Username: {
+        'UserAttributes': [{'Name': 'email', 'Value': f'{Username}@example.com'}] if Username != 'b' else []
+    }
+    ses.send_bulk_templated_email.side_effect = lambda **kwargs: {
+        'Status': [{'Status': 'Success'}, {'Status': 'MessageRejected', 'Error': 'Rejected'}]
+    }
+    event = sqs_event(
+        {'user_id': 'a', 'video_id': 'v1', 'status': 'COMPLETED'},
+        {'user_id': 'b', 'video_id': 'v2', 'status': 'COMPLETED'},
+        {'user_id': 'c', 'video_id': 'v3', 'status': 'COMPLETED'}
+    )
+    event['Records'].append({'messageId': 'm3', 'body': 'not json'})
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 500
+    # The queue redelivers these instead of deleting them
+    assert response['batchItemFailures'] == [{'itemIdentifier': f'm{i}'} for i in (1, 3, 2)]
+
+def test_handler_returns_undeferred_queue_records(mock_context, mock_aws_clients):
+    cognito, ses = mock_aws_clients
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+    ses.send_bulk_templated_email.side_effect = lambda **kwargs: {
+        'Status': [{'Status': 'AccountDailyQuotaExceeded'}]
+    }
+    sqs = Mock()
+    sqs.send_message_batch.side_effect = Exception('SQS unavailable')
+    clients.set_client('sqs', sqs)
+
+    with patch.dict('os.environ', {'NOTIFICATION_QUEUE_URL': 'https://sqs/notifications'}):
+        response = handler(sqs_event({'user_id': 'a', 'video_id': 'v1', 'status': 'COMPLETED'}), mock_context)
+
+    assert response['statusCode'] == 500
+    assert 'could not be deferred' in response['body']
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm0'}]
+
+def test_handler_error_returns_every_queue_record(mock_context, mock_aws_clients):
+    cognito, _ = mock_aws_clients
+    cognito.admin_get_user.return_value = {
+        'UserAttributes': [{'Name': 'email', 'Value': 'test@example.com'}]
+    }
+    event = sqs_event(
+        {'user_id': 'a', 'video_id': 'v1', 'status': 'COMPLETED'},
+        {'user_id': 'b', 'video_id': 'v2', 'status': 'ERROR'}
+    )
+
+    with patch('src.main.send_notifications', side_effect=Exception('boom')):
+        response = handler(event, mock_context)
+
+    assert response['statusCode'] == 500
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm0'}, {'itemIdentifier': 'm1'}]
+
 @pytest.mark.integration
 def test_integration_notification_flow():
     """
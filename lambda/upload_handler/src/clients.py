@@ -0,0 +1,58 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Clients are created on first use and kept at module scope, so warm
+# invocations reuse them and their connection pools.
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+def _config():
+    """Connection pool and retry settings shared by every client"""
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        connect_timeout=5,
+        tcp_keepalive=True,
+        retries={
+            'mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+            'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+        }
+    )
+
+def get_client(service_name):
+    """Returns the shared boto3 client for a service, creating it on first use"""
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _clients[service_name] = boto3.client(service_name, config=_config())
+    return client
+
+def get_resource(service_name):
+    """Returns the shared boto3 resource for a service, creating it on first use"""
+    resource = _resources.get(service_name)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(service_name)
+            if resource is None:
+                resource = _resources[service_name] = boto3.resource(service_name, config=_config())
+    return resource
+
+def set_client(service_name, client):
+    """Replaces the shared client for a service, e.g. with a fake in tests"""
+    _clients[service_name] = client
+
+def set_resource(service_name, resource):
+    """Replaces the shared resource for a service, e.g. with a fake in tests"""
+    _resources[service_name] = resource
+
+def reset():
+    """Drops every cached client and resource"""
+    with _lock:
+        _clients.clear()
+        _resources.clear()
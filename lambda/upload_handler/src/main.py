@@ -1,14 +1,48 @@
 import json
 import os
-import boto3
+import math
 import uuid
 import logging
 from datetime import datetime
+from urllib.parse import unquote_plus
 from botocore.exceptions import ClientError
+from clients import get_client, get_resource
+from probe import probe_duration
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+MB = 1024 * 1024
+
+# S3 multipart limits
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+# Most part URLs presigned per file in one response; clients request the rest
+# with the "parts" action, which keeps responses well under Lambda's 6 MB limit
+MAX_PART_URLS = 100
+
+# Most files a single request may initiate
+MAX_FILES_PER_REQUEST = 25
+
+# SQS accepts at most 10 messages per batch
+MAX_QUEUE_BATCH = 10
+
+# When videos are sent for processing: once S3 reports the object was created,
+# or as soon as the upload is requested (before anything was uploaded)
+ENQUEUE_MODES = ('object_created', 'request')
+
+# Processing tiers, from cheapest to most expensive; each has its own queue
+# and processor configuration
+TIERS = ('small', 'medium', 'large')
+DEFAULT_TIER = 'medium'
+
+def enqueue_on_request():
+    mode = os.environ.get('ENQUEUE_MODE', 'object_created')
+    if mode not in ENQUEUE_MODES:
+        raise ValueError(f"Unknown ENQUEUE_MODE {mode}; expected one of {', '.join(ENQUEUE_MODES)}")
+    return mode == 'request'
+
 def get_presigned_url(s3_client, bucket, key, expires_in=3600):
     """
     Generate a presigned URL for S3 upload
@@ -28,72 +62,434 @@ def get_presigned_url(s3_client, bucket, key, expires_in=3600):
         logger.error(f"Error generating presigned URL: {str(e)}")
         return None
 
-def handler(event, context):
+def get_part_size(size):
+    """
+    Part size for a multipart upload of size bytes: UPLOAD_PART_SIZE_MB,
+    grown to whole MB when the file would need more than MAX_PARTS parts
+    """
+    part_size = max(int(os.environ.get('UPLOAD_PART_SIZE_MB', '64')) * MB, MIN_PART_SIZE)
+    return max(part_size, math.ceil(size / MAX_PARTS / MB) * MB)
+
+def presign_parts(s3_client, bucket, key, upload_id, first_part, count, expires_in=3600):
     """
-    Lambda handler for initiating video uploads
+    Presigned upload_part URLs for count parts starting at part number first_part
+    """
+    return [
+        s3_client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': bucket,
+                'Key': key,
+                'UploadId': upload_id,
+                'PartNumber': part_number
+            },
+            ExpiresIn=expires_in
+        )
+        for part_number in range(first_part, first_part + count)
+    ]
+
+def create_multipart_upload(s3_client, bucket, key, size, expires_in=3600):
+    """
+    Start a multipart upload and presign URLs for up to its first MAX_PART_URLS parts
     """
     try:
-        # Parse request body
-        body = json.loads(event['body'])
-        filename = body.get('filename')
-        
-        if not filename:
-            return {
-                'statusCode': 400,
-                'body': json.dumps({
-                    'message': 'Filename is required'
-                })
-            }
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            ContentType='video/mp4'
+        )['UploadId']
 
-        # Get user info from Cognito authorizer
-        user_id = event['requestContext']['authorizer']['claims']['sub']
-        
-        # Initialize AWS clients
-        s3 = boto3.client('s3')
-        sqs = boto3.client('sqs')
-        dynamodb = boto3.resource('dynamodb')
-        
-        # Generate unique video ID
+        part_size = get_part_size(size)
+        part_count = max(math.ceil(size / part_size), 1)
+        part_urls = presign_parts(s3_client, bucket, key, upload_id, 1, min(part_count, MAX_PART_URLS), expires_in)
+        return {'upload_id': upload_id, 'part_size': part_size, 'part_count': part_count, 'part_urls': part_urls}
+    except ClientError as e:
+        logger.error(f"Error creating multipart upload: {str(e)}")
+        return None
+
+def job_tier(size=None, duration=None):
+    """
+    Processing tier for a video of size bytes and duration seconds: the larger
+    of the tiers each known value falls in, DEFAULT_TIER when neither is known
+    """
+    limits = (
+        (duration, float(os.environ.get('TIER_SMALL_MAX_SECONDS', '60')),
+         float(os.environ.get('TIER_MEDIUM_MAX_SECONDS', '600'))),
+        (size, float(os.environ.get('TIER_SMALL_MAX_MB', '100')) * MB,
+         float(os.environ.get('TIER_MEDIUM_MAX_MB', '1024')) * MB),
+    )
+    tiers = [
+        'small' if value <= small else 'medium' if value <= medium else 'large'
+        for value, small, medium in limits if value is not None
+    ]
+    return max(tiers, key=TIERS.index) if tiers else DEFAULT_TIER
+
+def tier_queue_url(tier):
+    """SQS_QUEUE_URL_<TIER>, or SQS_QUEUE_URL for tiers without a queue of their own"""
+    return os.environ.get(f'SQS_QUEUE_URL_{tier.upper()}') or os.environ['SQS_QUEUE_URL']
+
+def enqueue_videos(sqs, queue_url, messages):
+    """
+    Send processing messages to SQS in batches.
+
+    Messages are grouped by user (MessageGroupId), which SQS fair queues use to
+    keep a user with a large backlog from delaying everyone else, and FIFO
+    queues to interleave users.
+    """
+    failed = 0
+    for start in range(0, len(messages), MAX_QUEUE_BATCH):
+        batch = messages[start:start + MAX_QUEUE_BATCH]
+        entries = []
+        for i, message in enumerate(batch):
+            entry = {'Id': str(i), 'MessageBody': json.dumps(message), 'MessageGroupId': message['user_id']}
+            if queue_url.endswith('.fifo'):
+                entry['MessageDeduplicationId'] = message['video_id']
+            entries.append(entry)
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed += len(response.get('Failed', []))
+    if failed:
+        raise Exception(f"Failed to enqueue {failed} videos for processing")
+
+def enqueue_jobs(sqs, messages):
+    """
+    Send processing messages to the queue of their tier
+    """
+    by_queue = {}
+    for message in messages:
+        by_queue.setdefault(tier_queue_url(message['tier']), []).append(message)
+    for queue_url, queued in by_queue.items():
+        enqueue_videos(sqs, queue_url, queued)
+
+def validate_files(body):
+    """
+    Files requested by either form of the body: a single {"filename", "size"}
+    or {"files": [{"filename", "size"}, ...]}. Returns (files, error message).
+    """
+    files = body.get('files') if 'files' in body else [body]
+    if not isinstance(files, list) or not files:
+        return None, 'Files must be a non-empty list'
+    if len(files) > MAX_FILES_PER_REQUEST:
+        return None, f'At most {MAX_FILES_PER_REQUEST} files can be uploaded per request'
+
+    max_size = float(os.environ.get('MAX_UPLOAD_SIZE_GB', '50')) * 1024 * MB
+    for file in files:
+        if not isinstance(file, dict) or not file.get('filename'):
+            return None, 'Filename is required'
+        size = file.get('size')
+        if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+            return None, f"Invalid size for {file['filename']}"
+        if size is not None and size > max_size:
+            return None, f"{file['filename']} exceeds the maximum upload size"
+    return files, None
+
+def bad_request(message):
+    return {
+        'statusCode': 400,
+        'body': json.dumps({
+            'message': message
+        })
+    }
+
+def initiate_uploads(files, user_id, s3, sqs, table):
+    """
+    Create the upload URLs, DynamoDB rows and processing messages for files.
+
+    Files of at least MULTIPART_THRESHOLD_MB (when the client sends their size)
+    get a multipart upload. Videos are sent for processing when S3 reports
+    them created, unless ENQUEUE_MODE is "request"; multipart uploads are
+    then sent by the complete action, once all parts are uploaded.
+    """
+    bucket = os.environ['INPUT_BUCKET']
+    expires_in = int(os.environ.get('UPLOAD_URL_EXPIRES_SECONDS', '3600'))
+    threshold = int(os.environ.get('MULTIPART_THRESHOLD_MB', '100')) * MB
+
+    uploads = []
+    items = []
+    messages = []
+    for file in files:
+        filename = file['filename']
         video_id = str(uuid.uuid4())
-        
-        # Generate S3 key
         video_key = f"inputs/{user_id}/{video_id}/{filename}"
-        
-        # Get presigned URL for upload
-        upload_url = get_presigned_url(s3, os.environ['INPUT_BUCKET'], video_key)
-        if not upload_url:
-            raise Exception("Failed to generate upload URL")
+        now = datetime.now().isoformat()
+        item = {
+            'user_id': user_id,
+            'video_id': video_id,
+            'filename': filename,
+            'status': 'PENDING',
+            'created_at': now,
+            'updated_at': now
+        }
+        upload = {'filename': filename, 'video_id': video_id}
 
-        # Create entry in DynamoDB
-        table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
-        table.put_item(
-            Item={
+        size = file.get('size')
+        if size is not None:
+            item['file_size'] = size
+        if size is not None and size >= threshold:
+            multipart = create_multipart_upload(s3, bucket, video_key, size, expires_in)
+            if not multipart:
+                raise Exception(f"Failed to create multipart upload for {filename}")
+            item.update({
+                'video_key': video_key,
+                'upload_id': multipart['upload_id'],
+                'part_count': multipart['part_count']
+            })
+            upload.update(multipart)
+        else:
+            upload_url = get_presigned_url(s3, bucket, video_key, expires_in)
+            if not upload_url:
+                raise Exception("Failed to generate upload URL")
+            upload['upload_url'] = upload_url
+            messages.append({
                 'user_id': user_id,
                 'video_id': video_id,
-                'filename': filename,
-                'status': 'PENDING',
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
+                'video_key': video_key,
+                'tier': job_tier(size)
+            })
+
+        items.append(item)
+        uploads.append(upload)
+
+    # Create entries in DynamoDB
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+    # Send messages to SQS for processing
+    if messages and enqueue_on_request():
+        enqueue_jobs(sqs, messages)
+
+    return uploads
+
+def not_found(message):
+    return {
+        'statusCode': 404,
+        'body': json.dumps({
+            'message': message
+        })
+    }
+
+def presign_upload_parts(body, user_id, s3, table):
+    """
+    Presign up to MAX_PART_URLS more part URLs of a multipart upload, starting
+    at part number first_part, for files with more parts than the first response carries
+    """
+    video_id = body.get('video_id')
+    first_part = body.get('first_part')
+    if not video_id or not isinstance(first_part, int) or isinstance(first_part, bool) or first_part < 1:
+        return bad_request('video_id and a first_part of at least 1 are required')
+
+    item = table.get_item(Key={'user_id': user_id, 'video_id': video_id}).get('Item')
+    if not item or not item.get('upload_id'):
+        return not_found('Multipart upload not found')
+
+    part_count = int(item.get('part_count', MAX_PARTS))
+    if first_part > part_count:
+        return bad_request(f'The upload has {part_count} parts')
+
+    count = min(part_count - first_part + 1, MAX_PART_URLS)
+    expires_in = int(os.environ.get('UPLOAD_URL_EXPIRES_SECONDS', '3600'))
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'video_id': video_id,
+            'first_part': first_part,
+            'part_urls': presign_parts(s3, os.environ['INPUT_BUCKET'], item['video_key'],
+                                       item['upload_id'], first_part, count, expires_in)
+        })
+    }
+
+def complete_upload(body, user_id, s3, sqs, table):
+    """
+    Complete a multipart upload from the ETags of its parts; the video is
+    sent for processing by its ObjectCreated event, or here in "request" mode
+    """
+    video_id = body.get('video_id')
+    parts = body.get('parts')
+    if not video_id or not isinstance(parts, list) or not parts:
+        return bad_request('video_id and parts are required')
+
+    item = table.get_item(Key={'user_id': user_id, 'video_id': video_id}).get('Item')
+    if not item or not item.get('upload_id'):
+        return not_found('Multipart upload not found')
+
+    try:
+        parts = sorted(
+            ({'PartNumber': int(part['part_number']), 'ETag': part['etag']} for part in parts),
+            key=lambda part: part['PartNumber']
+        )
+    except (KeyError, TypeError, ValueError):
+        return bad_request('Each part needs a part_number and an etag')
+
+    s3.complete_multipart_upload(
+        Bucket=os.environ['INPUT_BUCKET'],
+        Key=item['video_key'],
+        UploadId=item['upload_id'],
+        MultipartUpload={'Parts': parts}
+    )
+    table.update_item(
+        Key={'user_id': user_id, 'video_id': video_id},
+        UpdateExpression='SET updated_at = :updated_at REMOVE upload_id',
+        ExpressionAttributeValues={':updated_at': datetime.now().isoformat()}
+    )
+    if enqueue_on_request():
+        enqueue_jobs(sqs, [{
+            'user_id': user_id,
+            'video_id': video_id,
+            'video_key': item['video_key'],
+            'tier': job_tier(item.get('file_size'))
+        }])
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'video_id': video_id,
+            'message': 'Upload completed successfully'
+        })
+    }
+
+def parse_video_key(key):
+    """
+    (user_id, video_id) from an input key laid out as inputs/{user_id}/{video_id}/{filename},
+    or None for any other key
+    """
+    parts = key.split('/', 3)
+    if len(parts) != 4 or parts[0] != 'inputs' or not all(parts[1:]):
+        return None
+    return parts[1], parts[2]
+
+def mark_uploaded(table, user_id, video_id, size):
+    """
+    Record that a PENDING video's object arrived. Returns False when there is no
+    such row or it was already marked, as S3 may deliver an event more than once.
+    """
+    try:
+        table.update_item(
+            Key={'user_id': user_id, 'video_id': video_id},
+            UpdateExpression='SET uploaded_at = :now, updated_at = :now, file_size = :size',
+            ConditionExpression='#status = :pending AND attribute_not_exists(uploaded_at)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':now': datetime.now().isoformat(),
+                ':size': size,
+                ':pending': 'PENDING'
             }
         )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
 
-        # Send message to SQS for processing
-        sqs.send_message(
-            QueueUrl=os.environ['SQS_QUEUE_URL'],
-            MessageBody=json.dumps({
-                'user_id': user_id,
-                'video_id': video_id,
-                'video_key': video_key
+def unmark_uploaded(table, user_id, video_id):
+    table.update_item(
+        Key={'user_id': user_id, 'video_id': video_id},
+        UpdateExpression='REMOVE uploaded_at'
+    )
+
+def estimate_tier(s3, bucket, key, size):
+    """
+    Processing tier of an uploaded video from its size and, unless the size
+    alone already makes it large, its duration probed from the MP4 header
+    """
+    tier = job_tier(size)
+    if tier == 'large':
+        return tier
+    duration = probe_duration(s3, bucket, key, size)
+    logger.info(f"Probed {key}: {size} bytes, {duration} seconds")
+    return job_tier(size, duration)
+
+def handle_object_created(event, s3, sqs, table):
+    """
+    Send the videos of S3 ObjectCreated records for processing, to the queue
+    of the tier their estimated cost puts them in.
+
+    Each object is matched to its PENDING row by its key; objects without one
+    (other keys, unknown or already queued videos) are skipped. Raises when
+    videos could not be marked or queued, after unmarking the ones marked so
+    far, so the event is retried.
+    """
+    messages = []
+    marked = []
+    skipped = 0
+    try:
+        for record in event['Records']:
+            key = unquote_plus(record['s3']['object']['key'])
+            size = record['s3']['object'].get('size', 0)
+            ids = parse_video_key(key) if record.get('eventName', '').startswith('ObjectCreated') else None
+            if not ids or not mark_uploaded(table, *ids, size):
+                logger.info(f"No pending upload for {key}, skipping")
+                skipped += 1
+                continue
+            marked.append(ids)
+            messages.append({
+                'user_id': ids[0],
+                'video_id': ids[1],
+                'video_key': key,
+                'tier': estimate_tier(s3, record['s3']['bucket']['name'], key, size)
             })
-        )
 
+        if messages:
+            enqueue_jobs(sqs, messages)
+    except Exception:
+        # Rows marked so far would otherwise be skipped when the event is retried
+        for user_id, video_id in marked:
+            unmark_uploaded(table, user_id, video_id)
+        raise
+
+    logger.info(f"Queued {len(messages)} uploaded videos, skipped {skipped} objects")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'queued': {message['video_id']: message['tier'] for message in messages},
+            'skipped': skipped
+        })
+    }
+
+def is_s3_event(event):
+    records = event.get('Records') or []
+    return bool(records) and all('s3' in record for record in records)
+
+def handler(event, context):
+    """
+    Lambda handler for initiating video uploads, one or many per request,
+    presigning further parts of multipart uploads ({"action": "parts", ...})
+    and completing them ({"action": "complete", ...}).
+    Invoked by S3 ObjectCreated notifications, it queues the uploaded videos.
+    """
+    if is_s3_event(event):
+        table = get_resource('dynamodb').Table(os.environ['DYNAMODB_TABLE'])
+        return handle_object_created(event, get_client('s3'), get_client('sqs'), table)
+
+    try:
+        # Parse request body
+        body = json.loads(event['body'])
+
+        # Get user info from Cognito authorizer
+        user_id = event['requestContext']['authorizer']['claims']['sub']
+
+        # Shared AWS clients, reused across warm invocations
+        s3 = get_client('s3')
+        sqs = get_client('sqs')
+        dynamodb = get_resource('dynamodb')
+        table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+
+        if body.get('action') == 'complete':
+            return complete_upload(body, user_id, s3, sqs, table)
+        if body.get('action') == 'parts':
+            return presign_upload_parts(body, user_id, s3, table)
+
+        files, error = validate_files(body)
+        if error:
+            return bad_request(error)
+
+        uploads = initiate_uploads(files, user_id, s3, sqs, table)
+
+        # The single-file form keeps its flat response
+        response = {'uploads': uploads} if 'files' in body else uploads[0]
+        response['message'] = 'Upload URL generated successfully'
         return {
             'statusCode': 200,
-            'body': json.dumps({
-                'video_id': video_id,
-                'upload_url': upload_url,
-                'message': 'Upload URL generated successfully'
-            })
+            'body': json.dumps(response)
         }
 
     except Exception as e:
@@ -104,4 +500,4 @@ def handler(event, context):
                 'message': 'Error processing upload request',
                 'error': str(e)
             })
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,171 @@
+import struct
+
+# Helpers for the top-level box layout of ISO BMFF (MP4/MOV) files. They take
+# a read(offset, length) callable, so a file in S3 can be inspected with a
+# handful of ranged GETs instead of a full download.
+#
+# Each Lambda image is built from its own directory, so this module is copied
+# verbatim into video_processor (src/utils/mp4.py) and upload_handler
+# (src/mp4.py); the upload_handler tests fail when the copies differ.
+
+def iter_boxes(read, offset=0, end=None, max_boxes=64):
+    """
+    Yields (type, offset, size) for consecutive boxes starting at offset.
+
+    size is None for a box that extends to the end of the file.
+    """
+    for _ in range(max_boxes):
+        if end is not None and offset >= end:
+            return
+        header = read(offset, 16)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header[:8])
+        box_type = box_type.decode('latin-1')
+        if size == 1:
+            if len(header) < 16:
+                return
+            size = struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            yield box_type, offset, None
+            return
+        if size < 8:
+            return  # corrupt, or not ISO BMFF at all
+        yield box_type, offset, size
+        offset += size
+
+def is_faststart(read):
+    """
+    True when the moov index precedes the media data.
+
+    Only then can a decoder start on the first bytes of a download; with the
+    index at the end (or for non-MP4 data) this returns False.
+    """
+    for box_type, _, _ in iter_boxes(read):
+        if box_type == 'moov':
+            return True
+        if box_type == 'mdat':
+            return False
+    return False
+
+# FFmpeg's name for the ISO BMFF demuxer, as utils.decoders expects it
+CONTAINER_FORMAT = 'mov,mp4,m4a,3gp,3g2,mj2'
+
+# Sample entry types of common video codecs, by their FFmpeg names
+CODECS = {
+    'avc1': 'h264', 'avc3': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1',
+    'vp09': 'vp9', 'vp08': 'vp8',
+    'mp4v': 'mpeg4',
+    'jpeg': 'mjpeg',
+    'apch': 'prores', 'apcn': 'prores', 'apcs': 'prores', 'apco': 'prores', 'ap4h': 'prores',
+}
+
+def cached_reader(read, block_size=64 * 1024):
+    """
+    Wraps read(offset, length) so that it is called once per aligned block of
+    block_size bytes, however many box headers fall inside it
+    """
+    blocks = {}
+
+    def block(index):
+        if index not in blocks:
+            blocks[index] = read(index * block_size, block_size)
+        return blocks[index]
+
+    def cached(offset, length):
+        data = b''
+        for index in range(offset // block_size, (offset + length - 1) // block_size + 1):
+            chunk = block(index)
+            data += chunk
+            if len(chunk) < block_size:
+                break
+        skip = offset - (offset // block_size) * block_size
+        return data[skip:skip + length]
+
+    return cached
+
+def _children(read, offset, size):
+    """(type, offset, size) of the boxes inside the box at offset"""
+    return iter_boxes(read, offset + 8, offset + size if size else None)
+
+def _child(read, box, path):
+    """The box at path (e.g. 'minf/stbl') below box, or None"""
+    for name in path.split('/'):
+        if box is None:
+            return None
+        box = next(((t, o, s) for t, o, s in _children(read, box[1], box[2]) if t == name), None)
+    return box
+
+def _payload(read, box, length):
+    return read(box[1] + 8, length) if box else b''
+
+def _timing(data):
+    """(timescale, duration) from the payload of an mvhd or mdhd box"""
+    if data[:1] == b'\x01' and len(data) >= 32:
+        return struct.unpack('>IQ', data[20:32])
+    if len(data) >= 20:
+        return struct.unpack('>II', data[12:20])
+    return 0, 0
+
+def probe(read, size=None):
+    """
+    Reads duration, fps, frame count, resolution, codec, keyframe interval and
+    bitrate of an MP4/MOV file from its moov box, wherever it is, without
+    touching the media data.
+
+    Returns None when the data is not ISO BMFF or has no video track; fields
+    that cannot be read are left out.
+    """
+    moov = next((box for box in iter_boxes(read) if box[0] == 'moov'), None)
+    if moov is None:
+        return None
+
+    info = {'container': CONTAINER_FORMAT}
+    if size:
+        info['size'] = size
+    timescale, duration = _timing(_payload(read, _child(read, moov, 'mvhd'), 32))
+    if timescale and duration:
+        info['duration'] = duration / timescale
+
+    for trak in _children(read, moov[1], moov[2]):
+        if trak[0] != 'trak':
+            continue
+        mdia = _child(read, trak, 'mdia')
+        if _payload(read, _child(read, mdia, 'hdlr'), 12)[8:12] != b'vide':
+            continue
+
+        stbl = _child(read, mdia, 'minf/stbl')
+        entry = _payload(read, _child(read, stbl, 'stsd'), 44)
+        if len(entry) >= 44:
+            sample_type = entry[12:16].decode('latin-1')
+            info['codec'] = CODECS.get(sample_type, sample_type)
+            info['width'], info['height'] = struct.unpack('>HH', entry[40:44])
+
+        sizes = _payload(read, _child(read, stbl, 'stsz'), 12)
+        if len(sizes) == 12:
+            info['frame_count'] = struct.unpack('>I', sizes[8:12])[0]
+
+        # Average distance between keyframes; without a sync sample table every frame is one
+        stss = _child(read, stbl, 'stss')
+        sync = _payload(read, stss, 8)
+        if stss is None:
+            info['keyframe_interval'] = 1
+        elif len(sync) == 8 and info.get('frame_count'):
+            keyframes = struct.unpack('>I', sync[4:8])[0]
+            if keyframes:
+                info['keyframe_interval'] = max(round(info['frame_count'] / keyframes), 1)
+
+        timescale, duration = _timing(_payload(read, _child(read, mdia, 'mdhd'), 32))
+        if timescale and duration:
+            info.setdefault('duration', duration / timescale)
+            if info.get('frame_count'):
+                info['fps'] = info['frame_count'] * timescale / duration
+        break
+    else:
+        return None
+
+    if size and info.get('duration'):
+        info['bitrate'] = int(size * 8 / info['duration'])
+    return info
@@ -0,0 +1,27 @@
+import logging
+from mp4 import cached_reader, probe
+
+logger = logging.getLogger()
+
+def s3_reader(s3_client, bucket, key, size):
+    """read(offset, length) over an S3 object with ranged GETs"""
+    def read(offset, length):
+        if offset >= size:
+            return b''
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={offset}-{min(offset + length, size) - 1}')
+        return response['Body'].read()
+
+    return read
+
+def probe_duration(s3_client, bucket, key, size):
+    """
+    Duration in seconds of an MP4/MOV object, read from its headers with a
+    few ranged GETs wherever the moov box is (see mp4.probe); None when it is
+    not ISO BMFF or cannot be read
+    """
+    try:
+        info = probe(cached_reader(s3_reader(s3_client, bucket, key, size)), size)
+        return info.get('duration') if info else None
+    except Exception as e:
+        logger.warning(f"Could not probe {key}: {str(e)}")
+    return None
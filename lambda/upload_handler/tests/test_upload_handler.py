@@ -1,7 +1,12 @@
 import pytest
 import json
-from unittest.mock import Mock, patch
-from src.main import handler, get_presigned_url
+import os
+from unittest.mock import Mock, MagicMock, patch
+import clients
+import io
+import struct
+from src.main import handler, get_presigned_url, get_part_size, parse_video_key, job_tier, MB, MAX_PART_URLS
+from probe import probe_duration
 from botocore.exceptions import ClientError
 
 @pytest.fixture
@@ -20,26 +25,33 @@ def mock_event():
         }
     }
 
+@pytest.fixture
+def s3_event():
+    with open(os.path.join(os.path.dirname(__file__), 's3_event.json')) as f:
+        return json.load(f)
+
+@pytest.fixture
+def request_mode():
+    with patch.dict('os.environ', {'ENQUEUE_MODE': 'request'}):
+        yield
+
 @pytest.fixture
 def mock_context():
     return Mock()
 
 @pytest.fixture
 def mock_aws_clients():
-    with patch('boto3.client') as mock_client:
-        s3 = Mock()
-        sqs = Mock()
-        dynamodb = Mock()
-        
-        def get_mock_client(service):
-            if service == 's3':
-                return s3
-            elif service == 'sqs':
-                return sqs
-            return dynamodb
-        
-        mock_client.side_effect = get_mock_client
-        yield s3, sqs, dynamodb
+    s3 = Mock()
+    sqs = Mock()
+    dynamodb = Mock()
+    dynamodb.Table.return_value = dynamodb
+    dynamodb.batch_writer.return_value = MagicMock()
+    sqs.send_message_batch.return_value = {'Successful': []}
+
+    clients.set_client('s3', s3)
+    clients.set_client('sqs', sqs)
+    clients.set_resource('dynamodb', dynamodb)
+    yield s3, sqs, dynamodb
 
 def test_get_presigned_url():
     s3_client = Mock()
@@ -82,11 +94,31 @@ def test_handler_success(mock_event, mock_context, mock_aws_clients):
     assert 'upload_url' in response_body
     assert response_body['video_id'] == 'test-video-id'
     
-    # Verify DynamoDB put_item was called
-    dynamodb.put_item.assert_called_once()
+    # Verify the DynamoDB row was written
+    batch = dynamodb.batch_writer.return_value.__enter__.return_value
+    batch.put_item.assert_called_once()
+    assert batch.put_item.call_args.kwargs['Item']['status'] == 'PENDING'
     
-    # Verify SQS message was sent
-    sqs.send_message.assert_called_once()
+    # The video is queued by its ObjectCreated event, not before the upload
+    sqs.send_message_batch.assert_not_called()
+
+def test_handler_request_mode_enqueues(mock_event, mock_context, mock_aws_clients, request_mode):
+    s3, sqs, dynamodb = mock_aws_clients
+    s3.generate_presigned_url.return_value = 'https://test-url'
+
+    with patch('uuid.uuid4', return_value='test-video-id'):
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    sqs.send_message_batch.assert_called_once()
+    entries = sqs.send_message_batch.call_args.kwargs['Entries']
+    assert json.loads(entries[0]['MessageBody']) == {
+        'user_id': 'test-user-id',
+        'video_id': 'test-video-id',
+        'video_key': 'inputs/test-user-id/test-video-id/test-video.mp4',
+        'tier': 'medium'
+    }
+    assert entries[0]['MessageGroupId'] == 'test-user-id'
 
 def test_handler_missing_filename(mock_context, mock_aws_clients):
     event = {
@@ -117,6 +149,303 @@ def test_handler_presigned_url_error(mock_event, mock_context, mock_aws_clients)
     assert response['statusCode'] == 500
     assert 'Error processing upload request' in response['body']
 
+def batch_event(body):
+    return {
+        'body': json.dumps(body),
+        'requestContext': {'authorizer': {'claims': {'sub': 'test-user-id'}}}
+    }
+
+def test_handler_batch_upload(mock_context, mock_aws_clients, request_mode):
+    s3, sqs, dynamodb = mock_aws_clients
+    s3.generate_presigned_url.side_effect = lambda operation, Params, ExpiresIn: \
+        f"https://{operation}/{Params['Key']}/{Params.get('PartNumber', '')}"
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    files = [{'filename': f'small-{i}.mp4', 'size': 10 * MB} for i in range(12)]
+    files.append({'filename': 'large.mp4', 'size': 200 * MB})
+
+    response = handler(batch_event({'files': files}), mock_context)
+
+    assert response['statusCode'] == 200
+    uploads = json.loads(response['body'])['uploads']
+    assert [upload['filename'] for upload in uploads] == [file['filename'] for file in files]
+    assert all('upload_url' in upload for upload in uploads[:12])
+
+    large = uploads[12]
+    assert large['upload_id'] == 'upload-1'
+    assert large['part_size'] == 64 * MB
+    assert large['part_count'] == 4
+    assert len(large['part_urls']) == 4
+    assert large['part_urls'][0].startswith('https://upload_part/')
+
+    # One batch writer for every row, two SQS batches for the 12 single-PUT files
+    batch = dynamodb.batch_writer.return_value.__enter__.return_value
+    assert batch.put_item.call_count == 13
+    assert batch.put_item.call_args.kwargs['Item']['upload_id'] == 'upload-1'
+    assert batch.put_item.call_args.kwargs['Item']['part_count'] == 4
+    assert [len(call.kwargs['Entries']) for call in sqs.send_message_batch.call_args_list] == [10, 2]
+    sqs.send_message.assert_not_called()
+
+def test_handler_caps_part_urls(mock_context, mock_aws_clients):
+    s3, _, _ = mock_aws_clients
+    s3.generate_presigned_url.side_effect = lambda operation, Params, ExpiresIn: \
+        f"https://{operation}/{Params['PartNumber']}"
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    files = [{'filename': f'huge-{i}.mp4', 'size': 40 * 1024 * MB} for i in range(25)]
+
+    response = handler(batch_event({'files': files}), mock_context)
+
+    assert response['statusCode'] == 200
+    uploads = json.loads(response['body'])['uploads']
+    assert all(upload['part_count'] == 640 for upload in uploads)
+    assert all(len(upload['part_urls']) == MAX_PART_URLS for upload in uploads)
+    assert s3.generate_presigned_url.call_count == 25 * MAX_PART_URLS
+
+def test_handler_presign_parts(mock_context, mock_aws_clients):
+    s3, _, dynamodb = mock_aws_clients
+    s3.generate_presigned_url.side_effect = lambda operation, Params, ExpiresIn: \
+        f"https://{operation}/{Params['UploadId']}/{Params['PartNumber']}"
+    dynamodb.get_item.return_value = {'Item': {
+        'video_key': 'inputs/test-user-id/test-video-id/huge.mp4',
+        'upload_id': 'upload-1',
+        'part_count': 250
+    }}
+
+    def presign(first_part):
+        with patch.dict('os.environ', {'INPUT_BUCKET': 'test-bucket'}):
+            return handler(batch_event({
+                'action': 'parts',
+                'video_id': 'test-video-id',
+                'first_part': first_part
+            }), mock_context)
+
+    body = json.loads(presign(101)['body'])
+    assert body['first_part'] == 101
+    assert body['part_urls'] == [f'https://upload_part/upload-1/{n}' for n in range(101, 201)]
+    # The last batch stops at the final part
+    assert len(json.loads(presign(201)['body'])['part_urls']) == 50
+
+    assert presign(251)['statusCode'] == 400
+    assert presign(0)['statusCode'] == 400
+    dynamodb.get_item.return_value = {}
+    assert presign(1)['statusCode'] == 404
+
+def test_handler_batch_validation(mock_context, mock_aws_clients):
+    too_many = [{'filename': f'{i}.mp4'} for i in range(26)]
+
+    assert handler(batch_event({'files': too_many}), mock_context)['statusCode'] == 400
+    assert handler(batch_event({'files': []}), mock_context)['statusCode'] == 400
+    assert handler(batch_event({'files': [{'filename': 'a.mp4', 'size': -1}]}), mock_context)['statusCode'] == 400
+    response = handler(batch_event({'files': [{'filename': 'a.mp4', 'size': 60 * 1024 * MB}]}), mock_context)
+    assert response['statusCode'] == 400
+    assert 'maximum upload size' in response['body']
+
+def test_handler_enqueue_failure(mock_event, mock_context, mock_aws_clients, request_mode):
+    s3, sqs, _ = mock_aws_clients
+    s3.generate_presigned_url.return_value = 'https://test-url'
+    sqs.send_message_batch.return_value = {'Failed': [{'Id': '0', 'Message': 'error'}]}
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 500
+    assert 'Failed to enqueue' in response['body']
+
+def test_get_part_size():
+    assert get_part_size(200 * MB) == 64 * MB
+    # Large files use bigger parts to stay within 10,000 parts
+    assert get_part_size(1024 * 1024 * MB) == 105 * MB
+    with patch.dict('os.environ', {'UPLOAD_PART_SIZE_MB': '1'}):
+        assert get_part_size(10 * MB) == 5 * MB
+
+def test_handler_complete_upload(mock_context, mock_aws_clients, request_mode):
+    s3, sqs, dynamodb = mock_aws_clients
+    dynamodb.get_item.return_value = {'Item': {
+        'user_id': 'test-user-id',
+        'video_id': 'test-video-id',
+        'video_key': 'inputs/test-user-id/test-video-id/large.mp4',
+        'upload_id': 'upload-1'
+    }}
+
+    with patch.dict('os.environ', {'INPUT_BUCKET': 'test-bucket'}):
+        response = handler(batch_event({
+            'action': 'complete',
+            'video_id': 'test-video-id',
+            'parts': [{'part_number': 2, 'etag': '"b"'}, {'part_number': 1, 'etag': '"a"'}]
+        }), mock_context)
+
+    assert response['statusCode'] == 200
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket='test-bucket',
+        Key='inputs/test-user-id/test-video-id/large.mp4',
+        UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': '"a"'}, {'PartNumber': 2, 'ETag': '"b"'}]}
+    )
+    dynamodb.update_item.assert_called_once()
+    message = json.loads(sqs.send_message_batch.call_args.kwargs['Entries'][0]['MessageBody'])
+    assert message['video_key'] == 'inputs/test-user-id/test-video-id/large.mp4'
+
+def test_handler_complete_unknown_upload(mock_context, mock_aws_clients):
+    s3, sqs, dynamodb = mock_aws_clients
+    dynamodb.get_item.return_value = {}
+
+    response = handler(batch_event({
+        'action': 'complete',
+        'video_id': 'test-video-id',
+        'parts': [{'part_number': 1, 'etag': '"a"'}]
+    }), mock_context)
+
+    assert response['statusCode'] == 404
+    s3.complete_multipart_upload.assert_not_called()
+    sqs.send_message_batch.assert_not_called()
+
+def test_parse_video_key():
+    assert parse_video_key('inputs/user/video/file.mp4') == ('user', 'video')
+    assert parse_video_key('inputs/user/video/dir/file.mp4') == ('user', 'video')
+    assert parse_video_key('inputs/user/file.mp4') is None
+    assert parse_video_key('outputs/user/video/frames.zip') is None
+
+def test_handler_object_created(s3_event, mock_context, mock_aws_clients):
+    _, sqs, dynamodb = mock_aws_clients
+
+    response = handler(s3_event, mock_context)
+
+    assert response['statusCode'] == 200
+    user_id = '12345678-1234-1234-1234-123456789012'
+    video_id = '87654321-4321-4321-4321-210987654321'
+    kwargs = dynamodb.update_item.call_args.kwargs
+    assert kwargs['Key'] == {'user_id': user_id, 'video_id': video_id}
+    assert kwargs['ExpressionAttributeValues'][':pending'] == 'PENDING'
+    assert kwargs['ExpressionAttributeValues'][':size'] == 1048576
+    message = json.loads(sqs.send_message_batch.call_args.kwargs['Entries'][0]['MessageBody'])
+    assert message == {
+        'user_id': user_id,
+        'video_id': video_id,
+        'video_key': f'inputs/{user_id}/{video_id}/test video.mp4',
+        'tier': 'small'
+    }
+
+def test_handler_object_created_skips_unknown_uploads(s3_event, mock_context, mock_aws_clients):
+    _, sqs, dynamodb = mock_aws_clients
+    dynamodb.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+        'UpdateItem'
+    )
+    other = json.loads(json.dumps(s3_event['Records'][0]))
+    other['s3']['object']['key'] = 'outputs/user/video/frames.zip'
+    s3_event['Records'].append(other)
+
+    response = handler(s3_event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {'queued': {}, 'skipped': 2}
+    dynamodb.update_item.assert_called_once()
+    sqs.send_message_batch.assert_not_called()
+
+def test_handler_object_created_enqueue_failure(s3_event, mock_context, mock_aws_clients):
+    _, sqs, dynamodb = mock_aws_clients
+    sqs.send_message_batch.side_effect = ClientError(
+        {'Error': {'Code': 'ServiceUnavailable', 'Message': 'Unavailable'}}, 'SendMessageBatch'
+    )
+
+    # Raising lets Lambda retry the S3 event, which the removed marker allows
+    with pytest.raises(ClientError):
+        handler(s3_event, mock_context)
+
+    assert dynamodb.update_item.call_args.kwargs['UpdateExpression'] == 'REMOVE uploaded_at'
+
+def test_handler_object_created_mark_failure(s3_event, mock_context, mock_aws_clients):
+    _, sqs, dynamodb = mock_aws_clients
+    first = s3_event['Records'][0]
+    second = json.loads(json.dumps(first))
+    second['s3']['object']['key'] = first['s3']['object']['key'].replace('87654321', '11111111')
+    s3_event['Records'].append(second)
+    throttled = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Slow down'}},
+                            'UpdateItem')
+    dynamodb.update_item.side_effect = [{}, throttled, {}]
+
+    with pytest.raises(ClientError):
+        handler(s3_event, mock_context)
+
+    # The first video was marked before the second failed; it must be retried too
+    unmark = dynamodb.update_item.call_args_list[2].kwargs
+    assert unmark['UpdateExpression'] == 'REMOVE uploaded_at'
+    assert unmark['Key']['video_id'].startswith('87654321')
+    sqs.send_message_batch.assert_not_called()
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type.encode()) + payload
+
+def mp4_bytes(duration, timescale=1000, mdat_size=200000, version=0):
+    if version == 1:
+        mvhd = bytes([1, 0, 0, 0]) + struct.pack('>QQIQ', 0, 0, timescale, int(duration * timescale))
+    else:
+        mvhd = bytes(4) + struct.pack('>IIII', 0, 0, timescale, int(duration * timescale))
+    trak = box('trak', box('mdia', box('hdlr', bytes(8) + b'vide' + bytes(12))))
+    # moov after the media data, as most cameras write it
+    return box('ftyp', b'isom' + bytes(4)) + box('mdat', bytes(mdat_size)) + box('moov', box('mvhd', mvhd + bytes(80)) + trak)
+
+class RangedS3:
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(v) for v in Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_probe_duration(version):
+    data = mp4_bytes(12.5, version=version)
+    s3 = RangedS3(data)
+
+    assert probe_duration(s3, 'bucket', 'key', len(data)) == 12.5
+    # The first block, then the block holding the moov box at the end of the file
+    assert len(s3.ranges) <= 4
+    assert sum(end - start + 1 for start, end in s3.ranges) < 70 * 1024
+
+def test_mp4_module_matches_video_processor():
+    # Each Lambda is built from its own directory, so both keep a copy of the module
+    root = os.path.join(os.path.dirname(__file__), '..', '..')
+    with open(os.path.join(root, 'upload_handler', 'src', 'mp4.py')) as ours, \
+            open(os.path.join(root, 'video_processor', 'src', 'utils', 'mp4.py')) as theirs:
+        assert ours.read() == theirs.read()
+
+def test_probe_duration_not_mp4():
+    data = b'not a video at all' * 100
+    assert probe_duration(RangedS3(data), 'bucket', 'key', len(data)) is None
+    assert probe_duration(Mock(), 'bucket', 'key', 1000) is None
+
+def test_job_tier():
+    assert job_tier() == 'medium'
+    assert job_tier(size=10 * MB) == 'small'
+    assert job_tier(size=10 * MB, duration=30) == 'small'
+    # A small file can still be a long video, and a short clip a big file
+    assert job_tier(size=10 * MB, duration=1800) == 'large'
+    assert job_tier(size=2048 * MB, duration=5) == 'large'
+    assert job_tier(size=500 * MB) == 'medium'
+
+def test_handler_routes_by_tier(s3_event, mock_context, mock_aws_clients):
+    s3, sqs, dynamodb = mock_aws_clients
+    records = []
+    for name, size in (('clip', 5 * MB), ('movie', 3000 * MB)):
+        record = json.loads(json.dumps(s3_event['Records'][0]))
+        record['s3']['object'].update({'key': f'inputs/user/{name}/{name}.mp4', 'size': size})
+        records.append(record)
+    s3.get_object.side_effect = RangedS3(mp4_bytes(20)).get_object
+
+    with patch.dict('os.environ', {
+        'SQS_QUEUE_URL_SMALL': 'https://sqs/small',
+        'SQS_QUEUE_URL_LARGE': 'https://sqs/large.fifo'
+    }):
+        response = handler({'Records': records}, mock_context)
+
+    assert json.loads(response['body'])['queued'] == {'clip': 'small', 'movie': 'large'}
+    calls = {call.kwargs['QueueUrl']: call.kwargs['Entries'] for call in sqs.send_message_batch.call_args_list}
+    assert set(calls) == {'https://sqs/small', 'https://sqs/large.fifo'}
+    assert calls['https://sqs/large.fifo'][0]['MessageDeduplicationId'] == 'movie'
+    # Only the file that is not large by size alone was probed
+    assert all(call.kwargs['Key'] == 'inputs/user/clip/clip.mp4' for call in s3.get_object.call_args_list)
+
 # Add integration tests
 @pytest.mark.integration
 def test_integration_upload_flow():
@@ -0,0 +1,197 @@
+"""
+Local stand-ins for the AWS clients the video processor uses.
+
+They implement just the calls StorageManager and ResultCache make, backed by
+a directory (S3) or memory (DynamoDB, SNS, SQS), and are installed with
+utils.clients.set_client / set_resource so the handler runs unchanged.
+"""
+import io
+import os
+import shutil
+import threading
+import uuid
+from botocore.exceptions import ClientError
+
+class _Body(io.BufferedReader):
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+class LocalS3:
+    """S3 objects as files under root/bucket/key"""
+
+    def __init__(self, root):
+        self.root = root
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _existing(self, bucket, key):
+        path = self.path(bucket, key)
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject')
+        return path
+
+    def put(self, bucket, key, source_path):
+        os.makedirs(os.path.dirname(self.path(bucket, key)), exist_ok=True)
+        shutil.copyfile(source_path, self.path(bucket, key))
+
+    def download_file(self, bucket, key, local_path):
+        shutil.copyfile(self._existing(bucket, key), local_path)
+        self.bytes_out += os.path.getsize(local_path)
+
+    def upload_file(self, local_path, bucket, key):
+        self.put(bucket, key, local_path)
+        self.bytes_in += os.path.getsize(local_path)
+
+    def head_object(self, Bucket, Key):
+        size = os.path.getsize(self._existing(Bucket, Key))
+        return {'ContentLength': size, 'ETag': f'"{size}-{os.path.getmtime(self.path(Bucket, Key))}"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._existing(Bucket, Key)
+        if not Range:
+            self.bytes_out += os.path.getsize(path)
+            return {'Body': _Body(io.FileIO(path))}
+
+        start, end = (int(v) for v in Range[len('bytes='):].split('-'))
+        if start >= os.path.getsize(path):
+            raise ClientError({'Error': {'Code': 'InvalidRange', 'Message': Range}}, 'GetObject')
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.bytes_out += len(data)
+        return {'Body': _Body(io.BytesIO(data))}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn=3600):
+        # OpenCV reads local paths directly, which stands in for an HTTP URL
+        return self._existing(Params['Bucket'], Params['Key'])
+
+    def copy(self, source, bucket, key):
+        self.put(bucket, key, self._existing(source['Bucket'], source['Key']))
+
+    def delete_objects(self, Bucket, Delete):
+        for entry in Delete['Objects']:
+            path = self.path(Bucket, entry['Key'])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self._uploads[UploadId][PartNumber] = Body
+            self.bytes_in += len(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self._uploads.pop(UploadId)
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in MultipartUpload['Parts']:
+                f.write(parts[part['PartNumber']])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._uploads.pop(UploadId, None)
+
+class LocalTable:
+    """In-memory DynamoDB table supporting the SET/ADD updates StorageManager issues"""
+
+    def __init__(self, key_names=('user_id', 'video_id')):
+        self.key_names = key_names
+        self.items = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key):
+        return tuple(sorted(key.items()))
+
+    def get_item(self, Key):
+        item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item, **kwargs):
+        key = {name: Item[name] for name in self.key_names}
+        self.items[self._key(key)] = dict(Item)
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(self._key(Key), None)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ReturnValues='NONE', **kwargs):
+        with self._lock:
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            old = {}
+            for clause in UpdateExpression.replace(' ADD ', '\nADD ').replace('SET ', '\nSET ', 1).split('\n'):
+                if not clause.strip():
+                    continue
+                action, assignments = clause.strip().split(' ', 1)
+                for assignment in assignments.split(', '):
+                    parts = assignment.replace(' = ', ' ').split()
+                    name = ExpressionAttributeNames.get(parts[0], parts[0])
+                    value = ExpressionAttributeValues[parts[1]]
+                    if name in item:
+                        old[name] = item[name]
+                    if action == 'ADD' and isinstance(value, set):
+                        item[name] = set(item.get(name, set())) | value
+                    elif action == 'ADD':
+                        item[name] = item.get(name, 0) + value
+                    else:
+                        item[name] = value
+        if ReturnValues == 'UPDATED_OLD':
+            return {'Attributes': old}
+        return {}
+
+class LocalDynamoDB:
+    def __init__(self):
+        self.tables = {}
+
+    def Table(self, name):
+        if name not in self.tables:
+            is_cache = name == os.environ.get('RESULT_CACHE_TABLE')
+            self.tables[name] = LocalTable(('cache_key',) if is_cache else ('user_id', 'video_id'))
+        return self.tables[name]
+
+class LocalSNS:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message, **kwargs):
+        self.messages.append(Message)
+        return {'MessageId': str(len(self.messages))}
+
+class LocalSQS:
+    def __init__(self):
+        self.messages = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(entry['MessageBody'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+def install(root):
+    """Installs local stand-ins for every AWS client, returning them by service name"""
+    from utils import clients
+
+    services = {
+        's3': LocalS3(os.path.join(root, 's3')),
+        'dynamodb': LocalDynamoDB(),
+        'sns': LocalSNS(),
+        'sqs': LocalSQS(),
+    }
+    for name, service in services.items():
+        if name == 'dynamodb':
+            clients.set_resource(name, service)
+        else:
+            clients.set_client(name, service)
+    return services
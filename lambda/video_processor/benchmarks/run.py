@@ -0,0 +1,335 @@
+"""
+Offline benchmarks for the video processor hot path.
+
+    python benchmarks/run.py run --output results.json
+    python benchmarks/run.py run --quick --job '{"output": {"max_width": 640}}'
+    python benchmarks/run.py compare baseline.json results.json
+
+Synthetic videos are generated with cv2.VideoWriter and cached in
+--video-dir. Each case runs in a fresh process, so peak RSS and /tmp use
+are its own: extract_frames (frames to a directory), create_zip (that
+directory to a ZIP), extract_frames_to_zip (frames streamed into a ZIP) and
+handler (the whole Lambda against local S3/DynamoDB/SNS/SQS stand-ins).
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cv2  # noqa: E402
+from synthetic import CODECS, RESOLUTIONS, generate_video, video_name  # noqa: E402
+
+CASES = ('extract_frames', 'create_zip', 'extract_frames_to_zip', 'handler')
+
+# Metrics where a higher value is worse, with the smallest change worth reporting
+REGRESSION_METRICS = {'seconds': 0.05, 'peak_rss_mb': 5, 'peak_tmp_mb': 5, 'output_mb': 0.5}
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class _PeakDirSize(threading.Thread):
+    """Samples the size of a directory in the background, keeping the maximum"""
+
+    def __init__(self, path, interval=0.05):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, _dir_size(self.path))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, _dir_size(self.path))
+
+class _CountingSink:
+    """Write-only file object that only counts bytes, standing in for the S3 upload stream"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; children covers decoder processes
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+def _run_case(spec):
+    """Runs one case in this process and returns its measurements"""
+    from utils.video import extract_frames, extract_frames_to_zip, create_zip
+
+    job = spec['job']
+    kwargs = {'sampling': job.get('sampling'), 'output': job.get('output')}
+    tmp_dir = tempfile.gettempdir()
+    monitor = _PeakDirSize(tmp_dir)
+    monitor.start()
+    start = time.perf_counter()
+
+    if spec['case'] == 'extract_frames':
+        frames_dir = tempfile.mkdtemp()
+        success, frame_count = extract_frames(spec['video'], frames_dir, **kwargs)
+        output_bytes = _dir_size(frames_dir)
+    elif spec['case'] == 'create_zip':
+        zip_path = os.path.join(tmp_dir, 'frames.zip')
+        success = create_zip(spec['frames_dir'], zip_path)
+        frame_count = len(os.listdir(spec['frames_dir']))
+        output_bytes = os.path.getsize(zip_path) if success else 0
+    elif spec['case'] == 'extract_frames_to_zip':
+        sink = _CountingSink()
+        success, frame_count = extract_frames_to_zip(spec['video'], sink, **kwargs)
+        output_bytes = sink.size
+    else:
+        success, frame_count, output_bytes = _run_handler(spec)
+
+    seconds = time.perf_counter() - start
+    monitor.stop()
+    return {
+        'success': bool(success),
+        'seconds': round(seconds, 4),
+        'frames_out': frame_count,
+        'output_mb': round(output_bytes / 1e6, 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'peak_tmp_mb': round(monitor.peak / 1e6, 3),
+    }
+
+def _run_handler(spec):
+    """Runs the Lambda handler end to end against local AWS stand-ins outside /tmp"""
+    import local_aws
+
+    os.environ.update({
+        'INPUT_BUCKET': 'input', 'OUTPUT_BUCKET': 'output', 'DYNAMODB_TABLE': 'videos',
+        'SNS_TOPIC_ARN': 'arn:aws:sns:local:0:notifications', 'AWS_DEFAULT_REGION': 'us-east-1',
+    })
+    services = local_aws.install(spec['aws_dir'])
+    video_key = f"inputs/bench/video/{os.path.basename(spec['video'])}"
+    services['s3'].put('input', video_key, spec['video'])
+
+    from main import handler
+    message = {'user_id': 'bench', 'video_id': 'video', 'video_key': video_key, **spec['job']}
+    response = handler({'Records': [{'messageId': '1', 'body': json.dumps(message)}]}, None)
+    body = json.loads(response['body'])
+    zip_path = services['s3'].path('output', 'outputs/bench/video/frames.zip')
+    output_bytes = os.path.getsize(zip_path) if os.path.exists(zip_path) else 0
+    return response['statusCode'] == 200, body.get('frame_count', 0), output_bytes
+
+def _case_id(case, video, job):
+    job_hash = hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()[:8] if job else 'default'
+    return f"{case}/{os.path.basename(video)}/{job_hash}"
+
+def _spawn_case(spec, work_dir):
+    """Runs a case in a child process with its own TMPDIR"""
+    tmp_dir = os.path.join(work_dir, 'tmp')
+    aws_dir = os.path.join(work_dir, 'aws')
+    for path in (tmp_dir, aws_dir):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    env = dict(os.environ, TMPDIR=tmp_dir)
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), 'case', json.dumps({**spec, 'aws_dir': aws_dir})],
+        env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return {'success': False, 'error': result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def _probe(path):
+    cap = cv2.VideoCapture(path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+    finally:
+        cap.release()
+
+def _prepare_videos(args):
+    os.makedirs(args.video_dir, exist_ok=True)
+    videos = []
+    for resolution in args.resolutions:
+        for seconds in args.seconds:
+            for codec in args.codecs:
+                path = os.path.join(args.video_dir, video_name(resolution, seconds, codec))
+                if not os.path.exists(path):
+                    print(f"generating {os.path.basename(path)}", file=sys.stderr)
+                    if not generate_video(path, resolution, seconds, codec):
+                        print(f"skipping {codec}: no encoder in this OpenCV build", file=sys.stderr)
+                        continue
+                frame_count, fps = _probe(path)
+                videos.append({
+                    'path': path, 'resolution': resolution, 'seconds': seconds, 'codec': codec,
+                    'frame_count': frame_count, 'fps': fps, 'bytes': os.path.getsize(path)
+                })
+    return videos
+
+def _frames_dir(video, job):
+    """Extracted frames for the create_zip case, cached next to the video"""
+    from utils.video import extract_frames
+
+    path = f"{video['path']}.{_case_id('frames', video['path'], job).rsplit('/', 1)[-1]}.frames"
+    if not os.path.isdir(path):
+        extract_frames(video['path'], path, sampling=job.get('sampling'), output=job.get('output'))
+    return path
+
+def run(args):
+    videos = _prepare_videos(args)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-') as work_dir:
+        for video in videos:
+            for case in args.cases:
+                spec = {'case': case, 'video': video['path'], 'job': args.job}
+                if case == 'create_zip':
+                    spec['frames_dir'] = _frames_dir(video, args.job)
+
+                runs = [_spawn_case(spec, work_dir) for _ in range(args.repeat)]
+                ok = [r for r in runs if r.get('success')]
+                if ok:
+                    # fastest run for time, worst run for memory and disk
+                    measured = min(ok, key=lambda r: r['seconds'])
+                    measured.update({k: max(r[k] for r in ok) for k in ('peak_rss_mb', 'peak_tmp_mb')})
+                    measured['source_fps'] = round(video['frame_count'] / measured['seconds'], 1)
+                    measured['input_mb_per_s'] = round(video['bytes'] / 1e6 / measured['seconds'], 2)
+                else:
+                    measured = runs[-1]
+
+                result = {'id': _case_id(case, video['path'], args.job), 'case': case,
+                          'video': {k: v for k, v in video.items() if k != 'path'}, **measured}
+                results.append(result)
+                print(_format_result(result), file=sys.stderr)
+
+    report = {'meta': _meta(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 0 if all(r.get('success') for r in results) else 1
+
+def _meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    import numpy
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'job': args.job,
+        'repeat': args.repeat,
+    }
+
+def _format_result(result):
+    if not result.get('success'):
+        return f"{result['id']:<60} FAILED {result.get('error', '')}"
+    return (f"{result['id']:<60} {result['seconds']:>8.2f}s {result['source_fps']:>8.1f} fps "
+            f"{result['input_mb_per_s']:>7.2f} MB/s  rss {result['peak_rss_mb']:>7.1f} MB  "
+            f"tmp {result['peak_tmp_mb']:>8.1f} MB  out {result['output_mb']:>8.1f} MB")
+
+def compare(args):
+    """Prints metric changes between two result files; exits 1 on regressions above --threshold"""
+    with open(args.baseline) as f:
+        baseline = {r['id']: r for r in json.load(f)['results']}
+    with open(args.candidate) as f:
+        candidate = {r['id']: r for r in json.load(f)['results']}
+
+    regressions = 0
+    for case_id in sorted(set(baseline) | set(candidate)):
+        base, new = baseline.get(case_id), candidate.get(case_id)
+        if not base or not new:
+            print(f"{case_id}: only in {'candidate' if new else 'baseline'}")
+            continue
+        if not (base.get('success') and new.get('success')):
+            print(f"{case_id}: success {base.get('success')} -> {new.get('success')}")
+            regressions += bool(base.get('success') and not new.get('success'))
+            continue
+
+        changes = []
+        for metric, min_delta in REGRESSION_METRICS.items():
+            before, after = base[metric], new[metric]
+            relative = (after - before) / before if before else 0.0
+            regressed = relative > args.threshold and after - before > min_delta
+            regressions += regressed
+            changes.append(f"{metric} {before:g} -> {after:g} ({relative:+.1%}){' REGRESSION' if regressed else ''}")
+        print(f"{case_id}:\n    " + "\n    ".join(changes))
+
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark matrix')
+    run_parser.add_argument('--resolutions', type=lambda v: v.split(','), default=['480p', '720p', '1080p'])
+    run_parser.add_argument('--seconds', type=lambda v: [int(s) for s in v.split(',')], default=[10, 30])
+    run_parser.add_argument('--codecs', type=lambda v: v.split(','), default=['mp4v', 'mjpg'])
+    run_parser.add_argument('--cases', type=lambda v: v.split(','), default=list(CASES))
+    run_parser.add_argument('--job', type=json.loads, default={},
+                            help='SQS message fields applied to every case, e.g. sampling and output')
+    run_parser.add_argument('--repeat', type=int, default=1)
+    run_parser.add_argument('--quick', action='store_true', help='a single short 360p mp4v video')
+    run_parser.add_argument('--video-dir', default=os.path.join(tempfile.gettempdir(), 'video-processor-bench'))
+    run_parser.add_argument('--output', help='results file (default: stdout)')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+
+    case_parser = commands.add_parser('case')
+    case_parser.add_argument('spec', type=json.loads)
+
+    args = parser.parse_args(argv)
+    if args.command == 'case':
+        print(json.dumps(_run_case(args.spec)))
+        return 0
+    if args.command == 'compare':
+        return compare(args)
+
+    if args.quick:
+        args.resolutions, args.seconds, args.codecs = ['360p'], [5], ['mp4v']
+    unknown = [c for c in args.cases if c not in CASES] + [r for r in args.resolutions if r not in RESOLUTIONS] + \
+        [c for c in args.codecs if c not in CODECS]
+    if unknown:
+        parser.error(f"unknown values: {', '.join(unknown)}")
+    return run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import os
+import cv2
+import numpy as np
+
+RESOLUTIONS = {
+    '360p': (640, 360),
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '2160p': (3840, 2160),
+}
+
+# FourCC and container for each codec cv2.VideoWriter can produce
+CODECS = {
+    'mp4v': ('mp4v', 'mp4'),
+    'mjpg': ('MJPG', 'avi'),
+    'avc1': ('avc1', 'mp4'),
+}
+
+def video_name(resolution, seconds, codec, fps=30):
+    return f"{resolution}_{seconds}s_{fps}fps_{codec}.{CODECS[codec][1]}"
+
+def generate_video(path, resolution='720p', seconds=10, codec='mp4v', fps=30, scene_seconds=3, seed=0):
+    """
+    Writes a synthetic video that is cheap to make but realistic to decode.
+
+    Every scene_seconds the background pattern changes (a cut); within a
+    scene a block moves across a textured background with a little noise, so
+    both the codec and the scene/dedup filters have real work to do.
+    Returns False when OpenCV has no encoder for the codec.
+    """
+    width, height = RESOLUTIONS[resolution]
+    fourcc, _ = CODECS[codec]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        return False
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    block = max(height // 6, 8)
+    try:
+        for i in range(int(seconds * fps)):
+            scene = i // (scene_seconds * fps)
+            if i % (scene_seconds * fps) == 0:
+                phase = rng.uniform(0, 2 * np.pi, 3)
+                freq = rng.uniform(2, 12, 3)
+                background = np.stack([
+                    127 + 100 * np.sin(2 * np.pi * freq[c] * (x + y * (c + 1)) + phase[c]) for c in range(3)
+                ], axis=-1).astype(np.uint8)
+
+            frame = background.copy()
+            left = (i * 8) % max(width - block, 1)
+            top = (height - block) // 2
+            frame[top:top + block, left:left + block] = (40 * scene) % 256
+            noise = rng.integers(0, 6, (height // 4, width // 4, 1), dtype=np.uint8)
+            frame[:height // 4 * 4, :width // 4 * 4] += np.repeat(np.repeat(noise, 4, 0), 4, 1)
+            cv2.putText(frame, str(i), (20, height - 20), cv2.FONT_HERSHEY_SIMPLEX, height / 400, (255, 255, 255), 2)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return os.path.exists(path) and os.path.getsize(path) > 0
@@ -2,75 +2,563 @@ import json
 import os
 import tempfile
 import logging
-from utils.video import extract_frames, create_zip
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from utils.video import extract_frames_to_zip, merge_zips, plan_chunks, probe_video
 from utils.storage import StorageManager
+from utils.cache import ResultCache
+from utils.sampling import check_sampling, split_alignment
+from utils.encoding import DEFAULT_OUTPUT, FrameEncoder
+from utils.decoders import DECODER_BACKENDS, default_backend, select_backend
+from utils.metrics import Metrics, recording
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def handler(event, context):
+FRAME_INTERVAL = 30
+
+# Where the decoder reads the input video from:
+#   download - copy the whole object to /tmp first (original behaviour)
+#   stream   - decode from a presigned URL while the bytes arrive, falling back
+#              to download for containers whose index sits at the end
+#   ranged   - decode from a presigned URL wherever the index is, reading only
+#              the byte ranges the decoder seeks to; the default for chunks,
+#              which each need a small part of the video
+INPUT_MODES = ('download', 'stream', 'ranged')
+
+# How long a merge may hold its claim when there is no Lambda context to ask
+DEFAULT_MERGE_LEASE_SECONDS = 900
+
+def _zip_key(user_id, video_id):
+    return f"outputs/{user_id}/{video_id}/frames.zip"
+
+def _chunk_key(user_id, video_id, index):
+    return f"outputs/{user_id}/{video_id}/chunks/{index:04d}.zip"
+
+def job_sampling(message):
     """
-    Lambda handler for processing videos and creating frame ZIPs.
+    Sampling spec of a job: the message's 'sampling' entry, e.g.
+    {"mode": "fps", "fps": 1}, {"mode": "scene", "threshold": 0.2} or
+    {"mode": "interval", "frame_interval": 30, "dedup": 6}, or every
+    FRAME_INTERVAL-th frame when it has none. Raises ValueError for options
+    check_sampling would reject.
+    """
+    sampling = message.get('sampling') or {'mode': 'interval', 'frame_interval': FRAME_INTERVAL}
+    check_sampling(sampling)
+    return sampling
+
+def job_output(message):
+    """
+    Output spec of a job: the message's 'output' entry, e.g.
+    {"format": "webp", "quality": 80, "max_width": 1280, "grayscale": true},
+    or default-quality JPEG at the source resolution when it has none.
+    Raises ValueError for options FrameEncoder would reject.
+    """
+    output = message.get('output') or DEFAULT_OUTPUT
+    FrameEncoder(output)
+    return output
+
+def job_decoder(message):
+    """
+    Decoder backend of a job: the message's 'decoder' entry ("opencv", "pyav"
+    or "auto"), or DECODER_BACKEND when it has none
+    """
+    decoder = message.get('decoder') or default_backend()
+    if decoder not in DECODER_BACKENDS:
+        raise ValueError(f"Unknown decoder: {decoder}")
+    return decoder
+
+def choose_decoder(decoder, sampling, info):
+    """
+    Resolves 'auto' from the pre-flight probe's codec and container, so the
+    decoder does not have to open the video to find them
+    """
+    if decoder != 'auto' or not info or 'codec' not in info:
+        return decoder
+    return select_backend(info['codec'], info['container'], keyframes_only=sampling.get('mode') == 'keyframes')
+
+def check_limits(info):
+    """
+    Why a probed video is too big to process, or None. Limits are set by
+    MAX_VIDEO_DURATION_SECONDS and MAX_VIDEO_PIXELS (0 turns a limit off).
+    """
+    if not info:
+        return None
+    max_duration = float(os.environ.get('MAX_VIDEO_DURATION_SECONDS', '0'))
+    max_pixels = int(os.environ.get('MAX_VIDEO_PIXELS', str(7680 * 4320)))
+    if max_duration and info.get('duration', 0) > max_duration:
+        return f"Video is {info['duration']:.0f}s long; the limit is {max_duration:.0f}s"
+    if max_pixels and info.get('width', 0) * info.get('height', 0) > max_pixels:
+        return f"Video resolution {info['width']}x{info['height']} exceeds the limit of {max_pixels} pixels"
+    return None
+
+def extraction_params(message):
+    """Parameters that determine the archive produced for a video"""
+    return {'sampling': job_sampling(message), 'output': job_output(message)}
+
+def content_cache_key(storage, cache, bucket, key, params):
+    """
+    Result cache key of an input video.
+
+    RESULT_CACHE_KEY selects the content identity: 'etag' (default) uses the S3
+    ETag and size; 'sha256' streams the object through a hash, which also
+    matches identical files uploaded with different multipart part sizes.
+    """
+    head = storage.head_object(bucket, key)
+    if os.environ.get('RESULT_CACHE_KEY', 'etag') == 'sha256':
+        content_id = storage.hash_object(bucket, key)
+    else:
+        content_id = head['ETag']
+    return cache.content_key(content_id, head['ContentLength'], params)
+
+def copy_cached_result(storage, cache, cache_key, bucket, key):
+    """
+    Serves a job from the result cache with a server-side copy.
+
+    Returns the cached frame count, or None on a miss. Entries whose archive
+    has disappeared are evicted.
+    """
+    entry = cache.lookup(cache_key)
+    if not entry:
+        return None
+    if (entry['bucket'], entry['key']) != (bucket, key) and \
+            not storage.copy_object(entry['bucket'], entry['key'], bucket, key):
+        cache.evict(cache_key)
+        return None
+    return int(entry['frame_count'])
+
+def cache_result(message, bucket, key, frame_count):
+    """Records a finished archive in the result cache; failures only cost a future hit"""
+    if not message.get('cache_key'):
+        return
+    try:
+        ResultCache().store(message['cache_key'], bucket, key, frame_count)
+    except Exception as e:
+        logger.warning(f"Failed to cache result: {str(e)}")
+
+def complete_job(storage, user_id, video_id, output_bucket, zip_key, frame_count, **details):
+    """Marks a job COMPLETED, notifies the user and builds the success response"""
+    output_url = f"s3://{output_bucket}/{zip_key}"
+    storage.update_status(user_id, video_id, 'COMPLETED', output_url=output_url)
+    storage.notify_completion(user_id, video_id, 'COMPLETED', output_url=output_url)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Processing completed successfully',
+            'video_id': video_id,
+            'output_url': output_url,
+            'frame_count': frame_count,
+            **details
+        })
+    }
+
+def reject_job(storage, user_id, video_id, reason):
+    """
+    Fails a job its pre-flight probe or its options ruled out. The 400 keeps the
+    message out of batchItemFailures: redelivering it would only be rejected again.
+    """
+    storage.update_status(user_id, video_id, 'ERROR', error=reason)
+    storage.notify_completion(user_id, video_id, 'ERROR', error=reason)
+    return {
+        'statusCode': 400,
+        'body': json.dumps({
+            'message': 'Video rejected',
+            'video_id': video_id,
+            'error': reason
+        })
+    }
+
+def fan_out(storage, message, input_bucket):
+    """
+    Coordinator mode: splits a long video into chunk messages for other invocations.
+
+    Enabled by CHUNK_QUEUE_URL; videos longer than CHUNK_FRAMES frames are
+    split. Returns the number of chunks sent, or 0 when this invocation should
+    process the whole video itself.
+    """
+    queue_url = os.environ.get('CHUNK_QUEUE_URL')
+    if not queue_url:
+        return 0
+
+    # Scene detection and dedup compare each frame with the previous ones: no splitting
+    alignment = split_alignment(job_sampling(message))
+    if alignment is None:
+        return 0
+
+    chunk_frames = int(os.environ.get('CHUNK_FRAMES', '18000'))
+    # The pre-flight probe's frame count, or else the decoder's over a presigned URL
+    frame_count = (message.get('video_info') or {}).get('frame_count')
+    if not frame_count:
+        frame_count = probe_video(storage.get_video_url(input_bucket, message['video_key']))['frame_count']
+    chunks = plan_chunks(frame_count, alignment, chunk_frames)
+    if len(chunks) <= 1:
+        return 0
+
+    # Chunks record their frame counts in chunk_frames (see StorageManager.add_frames_processed)
+    storage.update_status(message['user_id'], message['video_id'], 'PROCESSING', chunks_total=len(chunks),
+                          frames_total=frame_count, chunk_frames={})
+    storage.enqueue_messages(queue_url, [
+        {**message, 'chunk': {'index': i, 'start': start, 'end': end, 'total': len(chunks)}}
+        for i, (start, end) in enumerate(chunks)
+    ])
+    return len(chunks)
+
+def open_video_source(storage, bucket, key, temp_dir, input_mode):
+    """Returns the path or URL the decoder should read the video from"""
+    if input_mode not in INPUT_MODES:
+        raise ValueError(f"Unknown input mode: {input_mode}")
+
+    if input_mode == 'ranged' or (input_mode == 'stream' and storage.is_streamable(bucket, key)):
+        url = storage.get_video_url(bucket, key)
+        try:
+            probe_video(url)
+            return url
+        except Exception as e:
+            logger.warning(f"Cannot stream {key}, downloading instead: {str(e)}")
+
+    video_path = os.path.join(temp_dir, 'video.mp4')
+    if not storage.download_video(bucket, key, video_path):
+        raise Exception("Failed to download video")
+    return video_path
+
+def _downloaded(storage, bucket, keys, temp_dir):
+    """Downloads objects one at a time, removing each once the caller moves on"""
+    for key in keys:
+        path = os.path.join(temp_dir, os.path.basename(key))
+        storage.download_object(bucket, key, path)
+        yield path
+        os.remove(path)
+
+def merge_chunks(storage, user_id, video_id, chunk_total, output_bucket, temp_dir, record=None):
+    """
+    Fan-in: assembles the per-chunk archives into the final frames.zip.
+
+    record, when given, is called with the frame count once frames.zip is
+    complete and before the chunk archives are deleted. Returns the number of
+    frames in the merged archive.
+    """
+    chunk_keys = [_chunk_key(user_id, video_id, i) for i in range(chunk_total)]
+    with storage.open_zip_upload(output_bucket, _zip_key(user_id, video_id)) as upload:
+        success, frame_count = merge_zips(_downloaded(storage, output_bucket, chunk_keys, temp_dir), upload)
+        if not success:
+            raise Exception("Failed to merge chunk ZIPs")
+
+    if record:
+        record(frame_count)
+    storage.delete_objects(output_bucket, chunk_keys)
+    return frame_count
+
+def merge_lease_seconds(context):
+    """How long a merge claim lasts: the rest of the invocation, after which a redelivery may take over"""
+    try:
+        return float(context.get_remaining_time_in_millis()) / 1000
+    except (AttributeError, TypeError):
+        return DEFAULT_MERGE_LEASE_SECONDS
+
+def fan_in(storage, user_id, video_id, chunk_total, output_bucket, temp_dir, merge):
+    """
+    Merges a fanned-out job's chunks under the merge claim of this invocation.
+
+    merge is the job item as claim_merge found it: when an earlier claimant had
+    already recorded a complete frames.zip, only its cleanup is repeated.
+    Returns the number of frames in frames.zip.
+    """
+    if merge.get('merge_state') == 'MERGED':
+        storage.delete_objects(output_bucket, [_chunk_key(user_id, video_id, i) for i in range(chunk_total)])
+        return int(merge['merged_frames'])
+    return merge_chunks(storage, user_id, video_id, chunk_total, output_bucket, temp_dir,
+                        record=lambda frame_count: storage.record_merge(user_id, video_id, frame_count))
+
+def checkpoint_stop(context):
+    """
+    stop callable for extraction that turns True when the invocation has less
+    than CHECKPOINT_RESERVE_SECONDS (default 60) left, enough to finish the
+    archive and checkpoint; None without a Lambda context or with a reserve of 0
+    """
+    reserve = float(os.environ.get('CHECKPOINT_RESERVE_SECONDS', '60')) * 1000
+    try:
+        float(context.get_remaining_time_in_millis())
+    except (AttributeError, TypeError):
+        return None
+    if reserve <= 0:
+        return None
+    return lambda: context.get_remaining_time_in_millis() < reserve
+
+def out_of_time(context):
+    """True when the invocation has less than CHECKPOINT_RESERVE_SECONDS left, too little to start on a record"""
+    stop = checkpoint_stop(context)
+    return bool(stop and stop())
+
+def defer_record(video_id, reason):
+    """
+    Hands a record back to SQS without touching its job: the 503 puts it in
+    batchItemFailures, so it is redelivered to an invocation with time to spare
+    """
+    logger.info(f"Deferring {video_id}: {reason}")
+    return {
+        'statusCode': 503,
+        'body': json.dumps({
+            'message': 'Processing deferred',
+            'video_id': video_id,
+            'reason': reason
+        })
+    }
+
+def resume_queue_url(record):
+    """RESUME_QUEUE_URL, or the URL of the queue the record came from"""
+    if os.environ.get('RESUME_QUEUE_URL'):
+        return os.environ['RESUME_QUEUE_URL']
+    try:
+        _, _, _, region, account, name = record['eventSourceARN'].split(':')
+    except (KeyError, ValueError):
+        raise Exception("Cannot tell which queue to resume on; set RESUME_QUEUE_URL")
+    return f"https://sqs.{region}.amazonaws.com/{account}/{name}"
+
+def checkpoint_job(storage, record, message, checkpoint, output_bucket, zip_key, start, next_frame):
+    """
+    Saves how far a job got and sends its message back to the queue, so that a
+    fresh invocation extracts the rest into the next part archive.
+
+    A job's first run writes straight to frames.zip; once it is cut short that
+    archive becomes part 0. Parts use the chunk keys, so the run that finishes
+    the video merges them with merge_chunks.
+    """
+    user_id, video_id = message['user_id'], message['video_id']
+    if next_frame <= start:
+        raise Exception("No frames extracted before the time limit")
+
+    parts = checkpoint['parts'] if checkpoint else 0
+    if not checkpoint:
+        part_key = _chunk_key(user_id, video_id, 0)
+        if not storage.copy_object(output_bucket, zip_key, output_bucket, part_key):
+            raise Exception("Failed to keep the partial archive")
+        storage.delete_objects(output_bucket, [zip_key])
+
+    storage.save_checkpoint(user_id, video_id, next_frame, parts + 1)
+    storage.enqueue_messages(resume_queue_url(record), [message])
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Processing checkpointed',
+            'video_id': video_id,
+            'next_frame': next_frame,
+            'parts': parts + 1
+        })
+    }
+
+def process_record(record, context=None, fresh=True):
+    """
+    Processes one SQS message, returning its response.
+
+    fresh tells whether the record started with the invocation's whole time
+    budget, rather than after other records of the batch.
+
+    Stage timings and counters for the message are emitted as an EMF metrics
+    line and added to the response body under 'metrics'.
+    """
+    metrics = Metrics()
+    with recording(metrics):
+        with metrics.stage('total'):
+            response = _process_record(record, metrics, context, fresh)
+
+    body = json.loads(response['body'])
+    metrics.emit(video_id=body.get('video_id'), status_code=response['statusCode'])
+    body['metrics'] = metrics.as_dict()
+    return {**response, 'body': json.dumps(body)}
+
+def _process_record(record, metrics, context=None, fresh=True):
+    """
+    A message with a 'chunk' entry is a fanned-out piece of a long video. Once
+    every chunk is done, the invocation holding the merge claim merges them and
+    completes the job; a merge that fails or times out is retried by the
+    redelivered message, without failing the job.
+
+    A whole video that would outlast the invocation is checkpointed and
+    re-enqueued (see checkpoint_job); the run that picks it up, or a redelivery
+    after a timeout, resumes from the checkpoint.
+
+    A whole video is probed first (see StorageManager.read_video_info); inputs
+    over the limits in check_limits are rejected before anything is downloaded.
+
+    A record that starts with less than CHECKPOINT_RESERVE_SECONDS left, or
+    that started after other records and ran out of time before its first
+    frame, is deferred (see defer_record) rather than failed.
     """
     try:
         # Parse SQS message
-        message = json.loads(event['Records'][0]['body'])
+        message = json.loads(record['body'])
         user_id = message['user_id']
         video_id = message['video_id']
         input_bucket = os.environ['INPUT_BUCKET']
         output_bucket = os.environ['OUTPUT_BUCKET']
         video_key = message['video_key']
+        chunk = message.get('chunk')
+
+        # Records after the first ones of a batch may find the invocation nearly spent
+        if out_of_time(context):
+            return defer_record(video_id, "Not enough time left in this invocation")
 
         storage = StorageManager()
-        
-        # Update status to processing
-        storage.update_status(user_id, video_id, 'PROCESSING')
+        try:
+            sampling = job_sampling(message)
+            output = job_output(message)
+            decoder = job_decoder(message)
+        except ValueError as e:
+            # Checked before any I/O; bad options fail the same way on every redelivery
+            return reject_job(storage, user_id, video_id, str(e))
+        checkpoint = None if chunk else storage.get_checkpoint(user_id, video_id)
+
+        if not chunk and not checkpoint:
+            # Read the container headers before spending anything on the video; chunks
+            # and resumed runs find the result in their message
+            with metrics.stage('probe'):
+                info = storage.read_video_info(input_bucket, video_key)
+            reason = check_limits(info)
+            if reason:
+                return reject_job(storage, user_id, video_id, reason)
+            if info:
+                message['video_info'] = info
+
+            # Update status to processing, storing what the probe found
+            storage.update_status(user_id, video_id, 'PROCESSING', **({'video_info': info} if info else {}))
+
+            # Identical input with identical parameters: copy the earlier result
+            cache = ResultCache()
+            if cache.enabled:
+                try:
+                    with metrics.stage('cache'):
+                        message['cache_key'] = content_cache_key(storage, cache, input_bucket, video_key,
+                                                                 extraction_params(message))
+                        frame_count = copy_cached_result(storage, cache, message['cache_key'],
+                                                         output_bucket, _zip_key(user_id, video_id))
+                    if frame_count is not None:
+                        return complete_job(storage, user_id, video_id, output_bucket, _zip_key(user_id, video_id),
+                                            frame_count, cached=True)
+                except Exception as e:
+                    logger.warning(f"Result cache unavailable: {str(e)}")
+
+            with metrics.stage('fan_out'):
+                chunk_count = fan_out(storage, message, input_bucket)
+            if chunk_count:
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'message': 'Processing split into chunks',
+                        'video_id': video_id,
+                        'chunk_count': chunk_count
+                    })
+                }
 
         with tempfile.TemporaryDirectory() as temp_dir:
-            video_path = os.path.join(temp_dir, 'video.mp4')
-            frames_dir = os.path.join(temp_dir, 'frames')
-            zip_path = os.path.join(temp_dir, 'frames.zip')
-
-            # Download video
-            if not storage.download_video(input_bucket, video_key, video_path):
-                raise Exception("Failed to download video")
-
-            # Extract frames
-            success, frame_count = extract_frames(video_path, frames_dir)
-            if not success:
-                raise Exception("Failed to extract frames")
-
-            # Create ZIP
-            if not create_zip(frames_dir, zip_path):
-                raise Exception("Failed to create ZIP")
-
-            # Upload ZIP
-            zip_key = f"outputs/{user_id}/{video_id}/frames.zip"
-            if not storage.upload_zip(zip_path, output_bucket, zip_key):
-                raise Exception("Failed to upload ZIP")
-
-            # Update status and notify
-            output_url = f"s3://{output_bucket}/{zip_key}"
-            storage.update_status(user_id, video_id, 'COMPLETED', output_url=output_url)
-            storage.notify_completion(user_id, video_id, 'COMPLETED', output_url=output_url)
-
-            return {
-                'statusCode': 200,
-                'body': json.dumps({
-                    'message': 'Processing completed successfully',
-                    'video_id': video_id,
-                    'output_url': output_url,
-                    'frame_count': frame_count
-                })
-            }
+            # Download the video, or stream it when the message or INPUT_MODE asks to;
+            # chunks read just their ranges of it unless CHUNK_INPUT_MODE says otherwise
+            if chunk:
+                input_mode = message.get('input_mode') or os.environ.get('CHUNK_INPUT_MODE', 'ranged')
+            else:
+                input_mode = message.get('input_mode') or os.environ.get('INPUT_MODE', 'download')
+            with metrics.stage('input'):
+                source = open_video_source(storage, input_bucket, video_key, temp_dir, input_mode)
+
+            # Extract frames into a ZIP that is uploaded while it is being written;
+            # the multipart upload is aborted if extraction fails
+            if chunk:
+                zip_key = _chunk_key(user_id, video_id, chunk['index'])
+                start, end = chunk['start'], chunk['end']
+            elif checkpoint:
+                zip_key = _chunk_key(user_id, video_id, checkpoint['parts'])
+                start, end = checkpoint['next_frame'], None
+            else:
+                zip_key = _zip_key(user_id, video_id)
+                start, end = 0, None
+
+            # Only whole videos sampled by index can be cut short and resumed
+            stop = None if chunk or split_alignment(sampling) is None else checkpoint_stop(context)
+
+            info = message.get('video_info') or {}
+            decoder = choose_decoder(decoder, sampling, info)
+
+            stats = {}
+            progress = storage.progress_reporter(user_id, video_id, chunk['index'] if chunk else None)
+            # A resumed video reports progress through the whole video
+            report = (lambda done, total: progress(start + done, start + total)) if checkpoint else progress
+            try:
+                with metrics.stage('extract'), storage.open_zip_upload(output_bucket, zip_key) as upload:
+                    success, frame_count = extract_frames_to_zip(source, upload, sampling=sampling, output=output,
+                                                                 start=start, end=end, stats=stats,
+                                                                 progress=report, stop=stop, decoder=decoder,
+                                                                 keyframe_interval=info.get('keyframe_interval'))
+                    if not success:
+                        raise Exception("Failed to extract frames")
+            finally:
+                # Progress writes must land before the final status
+                progress.close()
+
+            if 'resume_frame' in stats:
+                resume_frame = stats.pop('resume_frame')
+                # Without a whole budget, no progress says nothing about the video
+                if resume_frame <= start and not fresh:
+                    return defer_record(video_id, "No frames extracted before the time limit")
+                with metrics.stage('checkpoint'):
+                    return checkpoint_job(storage, record, message, checkpoint, output_bucket, zip_key,
+                                          start, resume_frame)
+
+            if checkpoint:
+                if os.path.exists(source):
+                    os.remove(source)
+                with metrics.stage('merge_chunks'):
+                    frame_count = merge_chunks(storage, user_id, video_id, checkpoint['parts'] + 1,
+                                               output_bucket, temp_dir)
+                storage.clear_checkpoint(user_id, video_id)
+                zip_key = _zip_key(user_id, video_id)
+
+            if chunk:
+                merge = None
+                if storage.complete_chunk(user_id, video_id, chunk['index'], chunk['total']):
+                    merge = storage.claim_merge(user_id, video_id, merge_lease_seconds(context))
+                if merge is None:
+                    return {
+                        'statusCode': 200,
+                        'body': json.dumps({
+                            'message': 'Chunk processed successfully',
+                            'video_id': video_id,
+                            'chunk_index': chunk['index'],
+                            'frame_count': frame_count
+                        })
+                    }
+
+                # Every chunk is done and this invocation merges them; the video is no longer needed
+                if os.path.exists(source):
+                    os.remove(source)
+                try:
+                    with metrics.stage('merge_chunks'):
+                        frame_count = fan_in(storage, user_id, video_id, chunk['total'], output_bucket,
+                                             temp_dir, merge)
+                except Exception as e:
+                    # The chunks are all there: leave the job PROCESSING for the redelivery to merge
+                    logger.error(f"Error merging chunks: {str(e)}")
+                    storage.release_merge(user_id, video_id)
+                    return {
+                        'statusCode': 500,
+                        'body': json.dumps({
+                            'message': 'Error merging chunks',
+                            'video_id': video_id,
+                            'error': str(e)
+                        })
+                    }
+                zip_key = _zip_key(user_id, video_id)
+
+            cache_result(message, output_bucket, zip_key, frame_count)
+            return complete_job(storage, user_id, video_id, output_bucket, zip_key, frame_count, **stats)
 
     except Exception as e:
         error_message = str(e)
         logger.error(f"Error processing video: {error_message}")
-        
+
         if 'storage' in locals() and 'user_id' in locals() and 'video_id' in locals():
-            storage.update_status(user_id, video_id, 'ERROR', error=error_message)
-            storage.notify_completion(user_id, video_id, 'ERROR', error=error_message)
+            # Chunks of one video may all fail; only the first one to do so notifies
+            if storage.fail_job(user_id, video_id, error_message):
+                storage.notify_completion(user_id, video_id, 'ERROR', error=error_message)
 
         return {
             'statusCode': 500,
@@ -78,4 +566,43 @@ def handler(event, context):
                 'message': 'Error processing video',
                 'error': error_message
             })
-        }
\ No newline at end of file
+        }
+
+def handler(event, context):
+    """
+    Lambda handler for processing videos and creating frame ZIPs.
+
+    Every record in the SQS batch is processed, up to RECORD_CONCURRENCY at a
+    time. Failed and deferred messages are listed in batchItemFailures so that,
+    with ReportBatchItemFailures enabled on the event source, only they are
+    redelivered; rejected ones (status 400) are not, as they would fail again.
+    """
+    records = event['Records']
+    process = partial(process_record, context=context)
+    workers = min(int(os.environ.get('RECORD_CONCURRENCY', '1')), len(records))
+    # The first record on each worker starts with the invocation's whole budget
+    fresh = [i < max(workers, 1) for i in range(len(records))]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda record, first: process(record, fresh=first), records, fresh))
+    else:
+        results = [process(record, fresh=first) for record, first in zip(records, fresh)]
+
+    failures = [
+        {'itemIdentifier': record.get('messageId')}
+        for record, result in zip(records, results)
+        if result['statusCode'] >= 500
+    ]
+
+    if len(results) == 1:
+        response = dict(results[0])
+    else:
+        response = {
+            'statusCode': 500 if failures else 200,
+            'body': json.dumps({
+                'message': f"Processed {len(results) - len(failures)} of {len(results)} messages",
+                'results': [json.loads(result['body']) for result in results]
+            })
+        }
+    response['batchItemFailures'] = failures
+    return response
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from utils.clients import get_resource
+
+class ResultCache:
+    """
+    Content-addressed index of finished frame archives, kept in DynamoDB.
+
+    Entries are keyed by a digest of the input video's identity (S3 ETag and
+    size, or a SHA-256 of its bytes) and the extraction parameters. They
+    expire after ttl_seconds through DynamoDB TTL on expires_at; every hit
+    pushes the expiry back, so entries that keep being used stay cached.
+    The cache is disabled unless RESULT_CACHE_TABLE is set.
+    """
+
+    def __init__(self, table_name=None, ttl_seconds=None):
+        table_name = table_name or os.environ.get('RESULT_CACHE_TABLE')
+        self.table = get_resource('dynamodb').Table(table_name) if table_name else None
+        self.ttl_seconds = ttl_seconds or int(os.environ.get('RESULT_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+
+    @property
+    def enabled(self):
+        return self.table is not None
+
+    @staticmethod
+    def content_key(content_id, size, params):
+        """Digest of the input's content identity and the extraction parameters"""
+        payload = json.dumps({'content': content_id, 'size': size, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, cache_key):
+        """Returns the cached entry for cache_key, or None"""
+        item = self.table.get_item(Key={'cache_key': cache_key}).get('Item')
+        # DynamoDB deletes expired items lazily, so check the expiry ourselves
+        if not item or int(item['expires_at']) <= time.time():
+            return None
+
+        self.table.update_item(
+            Key={'cache_key': cache_key},
+            UpdateExpression='SET expires_at = :expires_at',
+            ExpressionAttributeValues={':expires_at': int(time.time()) + self.ttl_seconds}
+        )
+        return item
+
+    def store(self, cache_key, bucket, key, frame_count):
+        """Records the archive produced for cache_key"""
+        self.table.put_item(
+            Item={
+                'cache_key': cache_key,
+                'bucket': bucket,
+                'key': key,
+                'frame_count': frame_count,
+                'created_at': datetime.now().isoformat(),
+                'expires_at': int(time.time()) + self.ttl_seconds
+            }
+        )
+
+    def evict(self, cache_key):
+        """Drops an entry, e.g. when its archive no longer exists"""
+        self.table.delete_item(Key={'cache_key': cache_key})
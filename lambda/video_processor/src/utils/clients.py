@@ -0,0 +1,69 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Clients are created on first use and kept at module scope, so warm
+# invocations reuse them and their connection pools. boto3 clients are
+# thread-safe, but resources are not: each thread gets resources of its own.
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+_clients = {}
+_resources = {}
+_thread_resources = threading.local()
+_lock = threading.Lock()
+
+def _config():
+    """Connection pool and retry settings shared by every client"""
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        connect_timeout=5,
+        tcp_keepalive=True,
+        retries={
+            'mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+            'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+        }
+    )
+
+def get_client(service_name):
+    """Returns the shared boto3 client for a service, creating it on first use"""
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _clients[service_name] = boto3.client(service_name, config=_config())
+    return client
+
+def get_resource(service_name):
+    """
+    Returns this thread's boto3 resource for a service, creating it on first
+    use, or the replacement set with set_resource
+    """
+    resource = _resources.get(service_name)
+    if resource is not None:
+        return resource
+    resources = getattr(_thread_resources, 'resources', None)
+    if resources is None:
+        resources = _thread_resources.resources = {}
+    if service_name not in resources:
+        # Session creation is not thread-safe either
+        with _lock:
+            resources[service_name] = boto3.resource(service_name, config=_config())
+    return resources[service_name]
+
+def set_client(service_name, client):
+    """Replaces the shared client for a service, e.g. with a fake in tests"""
+    _clients[service_name] = client
+
+def set_resource(service_name, resource):
+    """Replaces the resource for a service on every thread, e.g. with a fake in tests"""
+    _resources[service_name] = resource
+
+def reset():
+    """Drops every cached client and resource"""
+    global _thread_resources
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _thread_resources = threading.local()
@@ -0,0 +1,240 @@
+import os
+import logging
+import cv2
+
+try:
+    import av
+except ImportError:  # PyAV is optional; without it every video is decoded by OpenCV
+    av = None
+
+logger = logging.getLogger()
+
+# Decoder implementations, chosen per job or with DECODER_BACKEND:
+#   opencv - cv2.VideoCapture with its bundled FFmpeg (original behaviour)
+#   pyav   - FFmpeg through PyAV, with frame and slice threading and
+#            keyframe-only decoding
+#   auto   - pyav for the codecs and containers below, opencv otherwise
+DECODER_BACKENDS = ('opencv', 'pyav', 'auto')
+
+# Codecs and containers auto hands to PyAV: codecs whose decoding dominates
+# the cost of a job, and containers without a sample index where seeking
+# works from timestamps. H.264 and MPEG-4 in MP4/MOV stay on OpenCV.
+PYAV_CODECS = ('hevc', 'av1', 'vp9', 'vp8')
+PYAV_CONTAINERS = ('matroska,webm', 'mpegts')
+
+class OpenCVDecoder:
+    """Frames of a video through cv2.VideoCapture"""
+
+    name = 'opencv'
+
+    def __init__(self, source, threads=None):
+        self._cap = cv2.VideoCapture(source)
+        # CAP_PROP_FRAME_TYPE is only available on newer OpenCV builds
+        self._frame_type_prop = getattr(cv2, 'CAP_PROP_FRAME_TYPE', None)
+        self.reports_keyframes = self._frame_type_prop is not None
+
+    def is_opened(self):
+        return self._cap.isOpened()
+
+    @property
+    def fps(self):
+        return self._cap.get(cv2.CAP_PROP_FPS)
+
+    @property
+    def frame_count(self):
+        return int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def seek(self, index):
+        """Makes frame index the next one grab or read returns"""
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+    def grab(self):
+        """Decodes the next frame without converting it; False at the end"""
+        return self._cap.grab()
+
+    def read(self):
+        """Decodes the next frame as a BGR array: (ok, frame)"""
+        return self._cap.read()
+
+    def is_keyframe(self):
+        """Whether the last frame grabbed or read was a keyframe"""
+        return self._cap.get(self._frame_type_prop) == ord('I')
+
+    def iter_keyframes(self, start=0, end=None):
+        """
+        Yields (index, frame) for the keyframes in [start, end).
+
+        OpenCV cannot skip decoding the frames in between, but only keyframes
+        are converted.
+        """
+        if not self.reports_keyframes:
+            raise ValueError("This OpenCV build does not report frame types; use the pyav decoder")
+        if start:
+            self.seek(start)
+        index = start
+        while end is None or index < end:
+            if not self._cap.grab():
+                return
+            if self.is_keyframe():
+                ret, frame = self._cap.retrieve()
+                if not ret:
+                    return
+                yield index, frame
+            index += 1
+
+    def release(self):
+        self._cap.release()
+
+class PyAVDecoder:
+    """
+    Frames of a video through PyAV.
+
+    threads sets the number of FFmpeg decoding threads (0 lets FFmpeg pick one
+    per CPU). Frame indexes after a seek are derived from presentation
+    timestamps, as OpenCV does, so they assume a constant frame rate.
+    """
+
+    name = 'pyav'
+    reports_keyframes = True
+
+    def __init__(self, source, threads=None):
+        if av is None:
+            raise ValueError("The pyav decoder needs the av package")
+        self._container = av.open(source)
+        try:
+            self._stream = self._container.streams.video[0]
+        except IndexError:
+            self._container.close()
+            raise ValueError(f"No video stream in {source}")
+        self._stream.thread_type = 'AUTO'
+        self._stream.thread_count = threads or 0
+        self._start_pts = self._stream.start_time or 0
+        self._frames = self._container.decode(self._stream)
+        self._seek_to = None
+        self._last = None
+        self.position = 0  # index of the next frame
+
+    def is_opened(self):
+        return True
+
+    @property
+    def codec(self):
+        return self._stream.codec_context.name
+
+    @property
+    def container_format(self):
+        return self._container.format.name
+
+    @property
+    def fps(self):
+        rate = self._stream.average_rate or self._stream.guessed_rate
+        return float(rate) if rate else 0.0
+
+    @property
+    def frame_count(self):
+        if self._stream.frames:
+            return self._stream.frames
+        if self._stream.duration and self.fps:
+            return int(self._stream.duration * self._stream.time_base * self.fps)
+        return 0
+
+    def _index_of(self, frame):
+        if frame.pts is None or not self.fps:
+            return self.position
+        return round((frame.pts - self._start_pts) * self._stream.time_base * self.fps)
+
+    def _next(self):
+        """Decodes the next frame, skipping those before a pending seek target"""
+        for frame in self._frames:
+            index = self._index_of(frame)
+            if self._seek_to is not None:
+                if index < self._seek_to:
+                    continue
+                self._seek_to = None
+            self.position = index + 1
+            self._last = frame
+            return frame
+        self._last = None
+        return None
+
+    def seek(self, index):
+        """
+        Makes frame index the next one grab or read returns. Decoding restarts
+        at the keyframe before it, and the frames up to it are dropped.
+        """
+        timestamp = self._start_pts + int(index / self.fps / self._stream.time_base) if self.fps else 0
+        self._container.seek(timestamp, stream=self._stream, backward=True)
+        self._frames = self._container.decode(self._stream)
+        self._seek_to = index
+        self.position = index
+
+    def grab(self):
+        return self._next() is not None
+
+    def read(self):
+        frame = self._next()
+        if frame is None:
+            return False, None
+        return True, frame.to_ndarray(format='bgr24')
+
+    def is_keyframe(self):
+        return bool(self._last is not None and self._last.key_frame)
+
+    def iter_keyframes(self, start=0, end=None):
+        """Yields (index, frame) for the keyframes in [start, end); the frames in between are not decoded"""
+        self._stream.codec_context.skip_frame = 'NONKEY'
+        if start:
+            self.seek(start)
+        while True:
+            frame = self._next()
+            if frame is None or (end is not None and self.position > end):
+                return
+            yield self.position - 1, frame.to_ndarray(format='bgr24')
+
+    def release(self):
+        self._container.close()
+
+BACKENDS = {'opencv': OpenCVDecoder, 'pyav': PyAVDecoder}
+
+def select_backend(codec, container_format, keyframes_only=False):
+    """Backend auto picks for a codec (FFmpeg name) and container format"""
+    if av is None:
+        return 'opencv'
+    if keyframes_only or codec in PYAV_CODECS or container_format in PYAV_CONTAINERS:
+        return 'pyav'
+    return 'opencv'
+
+def default_backend():
+    """Backend for jobs that do not choose one: DECODER_BACKEND, or auto"""
+    return os.environ.get('DECODER_BACKEND') or 'auto'
+
+def _default_threads():
+    """Decoding threads per decoder: DECODE_THREADS, or 0 to let FFmpeg decide"""
+    return int(os.environ.get('DECODE_THREADS', '0'))
+
+def open_decoder(source, backend=None, threads=None, keyframes_only=False):
+    """
+    Opens source with a backend from DECODER_BACKENDS.
+
+    auto reads the codec and container with PyAV; when that fails (no PyAV,
+    or a source only OpenCV can open) the video goes to OpenCV.
+    """
+    backend = backend or default_backend()
+    if backend not in DECODER_BACKENDS:
+        raise ValueError(f"Unknown decoder: {backend}")
+    threads = _default_threads() if threads is None else threads
+
+    if backend != 'auto':
+        return BACKENDS[backend](source, threads)
+    if av is None:
+        return OpenCVDecoder(source, threads)
+
+    try:
+        decoder = PyAVDecoder(source, threads)
+    except Exception as e:
+        logger.info(f"PyAV cannot open {source}, decoding with OpenCV: {str(e)}")
+        return OpenCVDecoder(source, threads)
+    if select_backend(decoder.codec, decoder.container_format, keyframes_only) == 'pyav':
+        return decoder
+    decoder.release()
+    return OpenCVDecoder(source, threads)
@@ -0,0 +1,72 @@
+import cv2
+
+# Output image formats: file extension and the imencode quality parameter
+OUTPUT_FORMATS = {
+    'jpeg': ('jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('webp', cv2.IMWRITE_WEBP_QUALITY),
+    'png': ('png', None),
+}
+
+# Encoding options, chosen per job with a spec such as
+#   {'format': 'webp', 'quality': 80, 'max_width': 1280, 'max_height': 720, 'grayscale': true}
+DEFAULT_OUTPUT = {'format': 'jpeg'}
+
+def _option(spec, name, minimum, maximum=None):
+    """Integer option of an output spec within [minimum, maximum], or None when absent"""
+    value = spec.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool) or value < minimum or \
+            (maximum is not None and value > maximum):
+        bounds = f"from {minimum} to {maximum}" if maximum is not None else f"of at least {minimum}"
+        raise ValueError(f"Output option {name} must be an integer {bounds}")
+    return value
+
+class FrameEncoder:
+    """
+    Encodes frames as configured by an output spec.
+
+    Frames larger than max_width x max_height are scaled down, keeping their
+    aspect ratio, and converted to grayscale before encoding, so the encoder
+    only works on the pixels that end up in the archive.
+    """
+
+    def __init__(self, spec=None):
+        spec = spec or DEFAULT_OUTPUT
+        if not isinstance(spec, dict):
+            raise ValueError("Output spec must be an object")
+        output_format = spec.get('format', 'jpeg')
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.extension, quality_param = OUTPUT_FORMATS[output_format]
+        self.max_width = _option(spec, 'max_width', 1)
+        self.max_height = _option(spec, 'max_height', 1)
+        quality = _option(spec, 'quality', 0, 100)
+        if not isinstance(spec.get('grayscale', False), bool):
+            raise ValueError("Output option grayscale must be true or false")
+        self.grayscale = spec.get('grayscale', False)
+        self.params = []
+        if quality_param is not None and quality is not None:
+            self.params = [quality_param, quality]
+
+    def _resize(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(self.max_width / width if self.max_width else 1.0,
+                    self.max_height / height if self.max_height else 1.0)
+        if scale >= 1.0:
+            return frame
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def encode(self, frame):
+        if self.max_width or self.max_height:
+            frame = self._resize(frame)
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        ok, buffer = cv2.imencode(f'.{self.extension}', frame, self.params)
+        if not ok:
+            raise Exception("Failed to encode frame")
+        return buffer.tobytes()
+
+    def filename(self, number):
+        return f"frame_{number:04d}.{self.extension}"
@@ -0,0 +1,126 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+class Metrics:
+    """
+    Stage timings and counters collected while processing one message.
+
+    Stages accumulate wall time across calls and threads, so work done on
+    encoder or upload threads can add up to more than the elapsed time, and
+    may nest (a merge includes downloading the chunks it merges).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed_iter(self, items, stage, counter=None):
+        """Yields from items, timing each step under stage and counting items under counter"""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            if counter:
+                self.count(counter)
+            yield item
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+                'counters': dict(self.counters)
+            }
+
+    def emf(self, namespace=None, **properties):
+        """
+        The metrics as a CloudWatch Embedded Metric Format record.
+
+        Stages become <stage>_ms millisecond metrics and counters keep their
+        names, counted in bytes when the name mentions bytes. properties are attached to the
+        record for log searches without becoming metric dimensions.
+        """
+        values = self.as_dict()
+        metrics = {f'{name}_ms': (value, 'Milliseconds') for name, value in values['stages_ms'].items()}
+        metrics.update({
+            name: (value, 'Bytes' if 'bytes' in name else 'Count')
+            for name, value in values['counters'].items()
+        })
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace or os.environ.get('METRICS_NAMESPACE', 'VideoProcessing'),
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            },
+            'Service': 'video_processor',
+            **properties,
+            **{name: value for name, (value, _) in metrics.items()}
+        }
+
+    def emit(self, **properties):
+        """Prints the EMF record; Lambda forwards stdout to CloudWatch Logs, which extracts the metrics"""
+        print(json.dumps(self.emf(**properties), default=str), flush=True)
+
+class _NullMetrics(Metrics):
+    """Discards everything; used when no message is being measured"""
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+_NULL = _NullMetrics()
+_current = ContextVar('metrics', default=_NULL)
+
+def current():
+    """The Metrics of the message being processed in this context"""
+    return _current.get()
+
+@contextmanager
+def recording(metrics):
+    """Makes metrics current for the duration of the block"""
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+def timed(stage):
+    """Decorator recording the duration of every call under stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with current().stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,232 @@
+import math
+import cv2
+import numpy as np
+
+# Sampling strategies, chosen per job with a spec such as
+#   {'mode': 'interval', 'frame_interval': 30}  every 30th frame
+#   {'mode': 'fps', 'fps': 1}                   one frame per second of video
+#   {'mode': 'scene', 'threshold': 0.15}        frames that start a new scene
+#   {'mode': 'keyframes'}                       the codec's keyframes only
+# Any mode also accepts 'dedup': frames whose perceptual hash is within that
+# many bits (out of 64; true means DEFAULT_DEDUP_DISTANCE) of the last kept
+# frame are dropped as near-duplicates.
+SAMPLING_MODES = ('interval', 'fps', 'scene', 'keyframes')
+
+DEFAULT_SAMPLING = {'mode': 'interval', 'frame_interval': 30}
+
+DEFAULT_DEDUP_DISTANCE = 6
+
+class IntervalSelector:
+    """Selects every frame_interval-th frame; sample n is frame n * frame_interval"""
+
+    def __init__(self, frame_interval):
+        if frame_interval < 1:
+            raise ValueError(f"Invalid frame interval: {frame_interval}")
+        self.frame_interval = frame_interval
+        self.alignment = frame_interval
+
+    def index_of(self, number):
+        return number * self.frame_interval
+
+    def number_at(self, index):
+        """Number of the first sample at or after frame index"""
+        return -(-index // self.frame_interval)
+
+class RateSelector:
+    """Selects the first frame at or after every 1/rate seconds of video time"""
+
+    def __init__(self, rate, source_fps):
+        if rate <= 0:
+            raise ValueError(f"Invalid sampling rate: {rate}")
+        if not source_fps or source_fps <= 0:
+            raise ValueError("Video frame rate is unknown")
+        # Sampling faster than the source would select the same frame twice
+        self.step = max(source_fps / rate, 1.0)
+        self.alignment = 1
+
+    def index_of(self, number):
+        return math.ceil(number * self.step - 1e-9)
+
+    def number_at(self, index):
+        return math.ceil(index / self.step - 1e-9)
+
+class KeyframeSelector:
+    """
+    Selects the keyframes, wherever the encoder put them.
+
+    Their positions are only known while decoding, so this selector has no
+    alignment: the video is sampled in a single pass and samples are numbered
+    in order. Decoders that support it skip the frames in between entirely.
+    """
+
+    keyframes_only = True
+    alignment = None
+
+class SceneChangeFilter:
+    """
+    Keeps a frame when it differs enough from the last kept one.
+
+    Frames are compared as small grayscale thumbnails: the mean absolute pixel
+    difference, scaled to [0, 1], must exceed threshold. The first frame is
+    always kept. A batch is compared with one array operation per kept frame:
+    the distances from the last kept frame to every frame after it.
+    """
+
+    def __init__(self, threshold=0.15, size=(64, 36)):
+        self.threshold = threshold
+        self.size = size
+        self.dropped = 0
+        self._last = None
+
+    def thumbnails(self, frames):
+        """Grayscale thumbnails of frames as an (n, height, width) int16 array"""
+        return np.stack([
+            cv2.resize(cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) if f.ndim == 3 else f, self.size,
+                       interpolation=cv2.INTER_AREA)
+            for f in frames
+        ]).astype(np.int16)
+
+    def accept(self, frame):
+        return self.select([frame])[0]
+
+    def select(self, frames):
+        if not frames:
+            return []
+        thumbnails = self.thumbnails(frames)
+        keep = [False] * len(frames)
+        start = 0
+        if self._last is None:
+            keep[0] = True
+            self._last = thumbnails[0]
+            start = 1
+        while start < len(frames):
+            distances = np.abs(thumbnails[start:] - self._last).mean(axis=(1, 2)) / 255.0
+            changed = np.flatnonzero(distances > self.threshold)
+            if not len(changed):
+                break
+            start += int(changed[0])
+            keep[start] = True
+            self._last = thumbnails[start]
+            start += 1
+        self.dropped += keep.count(False)
+        return keep
+
+class DuplicateFilter:
+    """
+    Drops frames whose perceptual hash is within max_distance bits of the last kept frame.
+
+    The hash is a 64-bit difference hash: each bit tells whether a pixel of a
+    9x8 grayscale thumbnail is brighter than its left neighbour, which
+    survives re-encoding noise and small lighting changes. Hashes for a batch
+    of frames are computed with one set of array operations.
+    """
+
+    def __init__(self, max_distance=DEFAULT_DEDUP_DISTANCE):
+        self.max_distance = max_distance
+        self.dropped = 0
+        self._last = None
+
+    @staticmethod
+    def hashes(frames):
+        """Difference hashes of frames as an (n, 8) uint8 array"""
+        thumbnails = np.stack([
+            cv2.resize(cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) if f.ndim == 3 else f, (9, 8),
+                       interpolation=cv2.INTER_AREA)
+            for f in frames
+        ])
+        bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+        return np.packbits(bits.reshape(len(frames), 64), axis=1)
+
+    def select(self, frames):
+        if not frames:
+            return []
+        keep = []
+        for frame_hash in self.hashes(frames):
+            if self._last is not None and np.unpackbits(frame_hash ^ self._last).sum() <= self.max_distance:
+                self.dropped += 1
+                keep.append(False)
+            else:
+                self._last = frame_hash
+                keep.append(True)
+        return keep
+
+def _number(spec, name, default, minimum, maximum=None, integer=False, inclusive=True):
+    value = spec.get(name, default)
+    kinds = int if integer else (int, float)
+    if not isinstance(value, kinds) or isinstance(value, bool) or \
+            value < minimum or (value == minimum and not inclusive) or \
+            (maximum is not None and value > maximum):
+        raise ValueError(f"Invalid sampling option {name}: {value!r}")
+    return value
+
+def check_sampling(spec):
+    """
+    Raises ValueError unless spec is a sampling spec build_sampler accepts for
+    any video, so a bad one can be turned away before the video is fetched.
+    """
+    spec = spec or DEFAULT_SAMPLING
+    if not isinstance(spec, dict):
+        raise ValueError("Sampling spec must be an object")
+    mode = spec.get('mode', 'interval')
+    if mode not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode: {mode}")
+    if mode == 'interval':
+        _number(spec, 'frame_interval', DEFAULT_SAMPLING['frame_interval'], 1, integer=True)
+    elif mode == 'fps':
+        _number(spec, 'fps', 1, 0, inclusive=False)
+    elif mode == 'scene':
+        _number(spec, 'check_fps', 5, 0, inclusive=False)
+        _number(spec, 'threshold', 0.15, 0, 1)
+    if spec.get('dedup') not in (None, True, False):
+        _number(spec, 'dedup', None, 0, 64, integer=True)
+
+def build_sampler(spec, source_fps):
+    """
+    Turns a sampling spec into (selector, filters).
+
+    The selector picks candidate frames by index, so they can be reached with
+    grab/seek and split across segments. Filters then look at batches of the
+    decoded candidates in order and are inherently sequential.
+    """
+    spec = spec or DEFAULT_SAMPLING
+    check_sampling(spec)
+    mode = spec.get('mode', 'interval')
+    filters = []
+    if mode == 'interval':
+        selector = IntervalSelector(int(spec.get('frame_interval', DEFAULT_SAMPLING['frame_interval'])))
+    elif mode == 'fps':
+        selector = RateSelector(float(spec.get('fps', 1)), source_fps)
+    elif mode == 'scene':
+        # Candidates are checked check_fps times per second of video
+        selector = RateSelector(float(spec.get('check_fps', 5)), source_fps)
+        filters.append(SceneChangeFilter(float(spec.get('threshold', 0.15))))
+    elif mode == 'keyframes':
+        selector = KeyframeSelector()
+    else:
+        raise ValueError(f"Unknown sampling mode: {mode}")
+
+    dedup = _dedup_distance(spec)
+    if dedup is not None:
+        filters.append(DuplicateFilter(dedup))
+    return selector, filters
+
+def _dedup_distance(spec):
+    dedup = spec.get('dedup')
+    if dedup is None or dedup is False:
+        return None
+    return DEFAULT_DEDUP_DISTANCE if dedup is True else int(dedup)
+
+def split_alignment(spec):
+    """
+    Frame multiple that ranges of a video must start on for the spec, or None
+    when its frames can only be chosen in a single sequential pass.
+    """
+    spec = spec or DEFAULT_SAMPLING
+    mode = spec.get('mode', 'interval')
+    if _dedup_distance(spec) is not None:
+        return None
+    if mode == 'interval':
+        return int(spec.get('frame_interval', DEFAULT_SAMPLING['frame_interval']))
+    if mode == 'fps':
+        return 1
+    return None
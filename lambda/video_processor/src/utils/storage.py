@@ -1,67 +1,616 @@
-import boto3
+import hashlib
+import io
 import json
+import contextvars
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from utils.clients import get_client, get_resource
+from utils.mp4 import cached_reader, is_faststart, probe
+from utils.metrics import current as current_metrics, timed
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+def _count_file_bytes(counter, path):
+    if os.path.exists(path):
+        current_metrics().count(counter, os.path.getsize(path))
+
+def _dynamodb_value(value):
+    """DynamoDB takes numbers as Decimal, not float"""
+    if isinstance(value, float):
+        return Decimal(str(round(value, 3)))
+    if isinstance(value, dict):
+        return {k: _dynamodb_value(v) for k, v in value.items()}
+    return value
+
+class MultipartUploadWriter:
+    """
+    Write-only file object that streams its contents to S3 as a multipart upload.
+
+    Parts of part_size bytes are uploaded in the background while the caller
+    keeps writing, with at most max_concurrency parts in flight. Leaving the
+    context manager completes the upload, or aborts it if an exception was raised.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 * 1024, max_concurrency=4):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+        self._parts = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        # Parts are uploaded on executor threads, outside the caller's context
+        self._metrics = current_metrics()
+
+    def _upload_part(self, part_number, data):
+        with self._metrics.stage('s3_upload_part'):
+            response = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data
+            )
+        self._metrics.count('bytes_out', len(data))
+        return response['ETag']
+
+    def _submit_part(self, data):
+        in_flight = [f for f in self._parts.values() if not f.done()]
+        if len(in_flight) >= self.max_concurrency:
+            wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in self._parts.values():
+            if future.done():
+                future.result()  # surface failed parts early
+        part_number = len(self._parts) + 1
+        self._parts[part_number] = self._executor.submit(self._upload_part, part_number, data)
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("MultipartUploadWriter is not seekable")
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed MultipartUploadWriter")
+        self._buffer.extend(data)
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Uploads the remaining bytes and completes the multipart upload"""
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._parts:
+                self._submit_part(bytes(self._buffer))
+                self._buffer.clear()
+            parts = [
+                {'PartNumber': number, 'ETag': future.result()}
+                for number, future in sorted(self._parts.items())
+            ]
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self._executor.shutdown()
+
+    def abort(self):
+        """Cancels pending parts and aborts the multipart upload"""
+        if self.closed:
+            return
+        self.closed = True
+        for future in self._parts.values():
+            future.cancel()
+        self._executor.shutdown()
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+class ProgressReporter:
+    """
+    Coalesces progress callbacks from the decode loop into occasional writes.
+
+    Calling the reporter with (frames_done, frames_total) is cheap: a write is
+    only issued when at least min_interval seconds and min_percent points
+    have passed since the last one, and runs on a background thread. While a
+    write is in flight further updates are skipped, so a slow DynamoDB never
+    holds up decoding. write(done, total, percent) does the actual update.
+    """
+
+    def __init__(self, write, min_interval=5.0, min_percent=1, flush_on_close=False):
+        self.write = write
+        self.min_interval = min_interval
+        self.min_percent = min_percent
+        self.flush_on_close = flush_on_close
+        self.writes = 0
+        self._last = (0, 0, time.monotonic())  # done, percent and time of the last write
+        self._latest = None
+        self._pending = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __call__(self, done, total):
+        if not total or total <= 0:
+            return
+        # The total is an estimate, so 100 is left for the final status
+        percent = min(done * 100 // total, 99)
+        self._latest = (done, total, percent)
+
+        last_done, last_percent, last_time = self._last
+        now = time.monotonic()
+        if percent - last_percent < self.min_percent:
+            return
+        if now - last_time < self.min_interval or (self._pending and not self._pending.done()):
+            return
+        self._submit(done, total, percent, now)
+
+    def _submit(self, done, total, percent, now):
+        self._last = (done, percent, now)
+        self.writes += 1
+        # Run in the caller's context so the write is timed with its message
+        self._pending = self._executor.submit(contextvars.copy_context().run, self.write, done, total, percent)
+
+    def close(self):
+        """Waits for the write in flight; with flush_on_close, also writes the latest state"""
+        if self.flush_on_close and self._latest and self._latest[0] != self._last[0]:
+            self._submit(*self._latest, time.monotonic())
+        self._executor.shutdown(wait=True)
 
 class StorageManager:
     def __init__(self):
-        self.s3 = boto3.client('s3')
-        self.dynamodb = boto3.resource('dynamodb')
-        self.sns = boto3.client('sns')
-        self.table = self.dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+        self.s3 = get_client('s3')
+        self.sns = get_client('sns')
+        self.sqs = get_client('sqs')
+        self.table_name = os.environ['DYNAMODB_TABLE']
+
+    @property
+    def table(self):
+        """
+        The jobs table, through the calling thread's DynamoDB resource: progress
+        writes run on a thread of their own, and records may run concurrently
+        """
+        return get_resource('dynamodb').Table(self.table_name)
 
+    @timed('s3_download')
     def download_video(self, bucket, key, local_path):
         """Downloads video from S3"""
         try:
             self.s3.download_file(bucket, key, local_path)
+            _count_file_bytes('bytes_in', local_path)
             return True
         except Exception as e:
             return False
 
+    @timed('s3_upload')
     def upload_zip(self, local_path, bucket, key):
         """Uploads ZIP file to S3"""
         try:
             self.s3.upload_file(local_path, bucket, key)
+            _count_file_bytes('bytes_out', local_path)
             return True
         except Exception as e:
             return False
 
-    def update_status(self, user_id, video_id, status, output_url=None, error=None):
-        """Updates processing status in DynamoDB"""
+    def open_zip_upload(self, bucket, key, part_size=None, max_concurrency=None):
+        """
+        Opens a streaming multipart upload to S3.
+
+        part_size and max_concurrency default to the UPLOAD_PART_SIZE_MB and
+        UPLOAD_MAX_CONCURRENCY environment variables.
+        """
+        if part_size is None:
+            part_size = int(os.environ.get('UPLOAD_PART_SIZE_MB', '8')) * 1024 * 1024
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get('UPLOAD_MAX_CONCURRENCY', '4'))
+        return MultipartUploadWriter(self.s3, bucket, key, part_size, max_concurrency)
+
+    def get_video_url(self, bucket, key, expires_in=3600):
+        """Returns a presigned GET URL the decoder can read the video from"""
+        return self.s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=expires_in
+        )
+
+    @timed('s3_read_range')
+    def read_range(self, bucket, key, offset, length):
+        """Reads up to length bytes at offset of an S3 object with a ranged GET"""
         try:
-            item = {
+            response = self.s3.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f'bytes={offset}-{offset + length - 1}'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b''
+            raise
+        data = response['Body'].read()
+        current_metrics().count('bytes_in', len(data))
+        return data
+
+    def is_streamable(self, bucket, key):
+        """True when the video can be decoded while it downloads (faststart MP4/MOV)"""
+        try:
+            return is_faststart(lambda offset, length: self.read_range(bucket, key, offset, length))
+        except Exception as e:
+            return False
+
+    @timed('s3_probe')
+    def read_video_info(self, bucket, key, size=None):
+        """
+        Container metadata of an MP4/MOV object (see utils.mp4.probe), read with
+        a few ranged GETs of its headers; None for other formats or on errors
+        """
+        try:
+            if size is None:
+                size = self.head_object(bucket, key)['ContentLength']
+            return probe(cached_reader(lambda offset, length: self.read_range(bucket, key, offset, length)), size)
+        except Exception as e:
+            return None
+
+    @timed('s3_head')
+    def head_object(self, bucket, key):
+        """Returns the S3 metadata of an object"""
+        return self.s3.head_object(Bucket=bucket, Key=key)
+
+    @timed('s3_hash')
+    def hash_object(self, bucket, key):
+        """Streams an object from S3 through SHA-256, without storing it"""
+        digest = hashlib.sha256()
+        body = self.s3.get_object(Bucket=bucket, Key=key)['Body']
+        for chunk in body.iter_chunks(1024 * 1024):
+            digest.update(chunk)
+            current_metrics().count('bytes_in', len(chunk))
+        return digest.hexdigest()
+
+    @timed('s3_copy')
+    def copy_object(self, source_bucket, source_key, bucket, key):
+        """Server-side copy between S3 locations; returns False if the source is gone"""
+        try:
+            self.s3.copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key)
+            return True
+        except Exception as e:
+            return False
+
+    @timed('s3_download')
+    def download_object(self, bucket, key, local_path):
+        """Downloads any object from S3, raising on failure"""
+        self.s3.download_file(bucket, key, local_path)
+        _count_file_bytes('bytes_in', local_path)
+
+    @timed('s3_delete')
+    def delete_objects(self, bucket, keys):
+        """Deletes objects from S3 in batches of 1000"""
+        for i in range(0, len(keys), 1000):
+            self.s3.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True}
+            )
+
+    @timed('sqs_send')
+    def enqueue_messages(self, queue_url, messages):
+        """Sends messages to SQS in batches of 10"""
+        for i in range(0, len(messages), 10):
+            response = self.sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {'Id': str(i + j), 'MessageBody': json.dumps(message)}
+                    for j, message in enumerate(messages[i:i + 10])
+                ]
+            )
+            if response.get('Failed'):
+                raise Exception(f"Failed to enqueue {len(response['Failed'])} messages")
+
+    def _update_item(self, user_id, video_id, values, add=None, return_values='NONE', condition=None,
+                     condition_values=None):
+        """
+        SETs values (and ADDs to add) on a job item, returning the DynamoDB response.
+
+        condition is a ConditionExpression over the same #name placeholders,
+        plus #status; condition_values supplies any :values only it uses.
+        """
+        names = {'#status': 'status'} if condition else {}
+        expression_values = dict(condition_values or {})
+        clauses = []
+        for action, attributes in (('SET', values), ('ADD', add or {})):
+            parts = []
+            for name, value in attributes.items():
+                names[f'#{name}'] = name
+                expression_values[f':{name}'] = _dynamodb_value(value)
+                parts.append(f'#{name} = :{name}' if action == 'SET' else f'#{name} :{name}')
+            if parts:
+                clauses.append(f"{action} {', '.join(parts)}")
+
+        kwargs = {'ConditionExpression': condition} if condition else {}
+        return self.table.update_item(
+            Key={
                 'user_id': user_id,
-                'video_id': video_id,
+                'video_id': video_id
+            },
+            UpdateExpression=' '.join(clauses),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=expression_values,
+            ReturnValues=return_values,
+            **kwargs
+        )
+
+    @timed('dynamodb_update')
+    def update_status(self, user_id, video_id, status, output_url=None, error=None, **attributes):
+        """Updates processing status in DynamoDB, storing any extra attributes alongside it"""
+        try:
+            values = {
                 'status': status,
                 'updated_at': datetime.now().isoformat()
             }
             if output_url:
-                item['output_url'] = output_url
+                values['output_url'] = output_url
             if error:
-                item['error'] = error
+                values['error'] = error
+            values.update(attributes)
+
+            self._update_item(user_id, video_id, values)
+            return True
+        except Exception as e:
+            return False
+
+    @timed('dynamodb_update')
+    def fail_job(self, user_id, video_id, error):
+        """
+        Moves a job to ERROR. Returns False when it already was, as when another
+        chunk of the same video failed first, so the failure is reported once.
+        """
+        try:
+            self._update_item(user_id, video_id, {
+                'status': 'ERROR',
+                'error': error,
+                'updated_at': datetime.now().isoformat()
+            }, condition='attribute_not_exists(#status) OR #status <> :status')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            # Better a second notification than none at all
+            return True
+        except Exception as e:
+            return True
+
+    @timed('dynamodb_update')
+    def report_progress(self, user_id, video_id, frames_done, frames_total, percent):
+        """Records how far extraction of a whole video has got"""
+        try:
+            self._update_item(user_id, video_id, {
+                'progress': percent,
+                'frames_processed': frames_done,
+                'frames_total': frames_total,
+                'updated_at': datetime.now().isoformat()
+            })
+            return True
+        except Exception as e:
+            return False
 
+    @timed('dynamodb_update')
+    def add_frames_processed(self, user_id, video_id, chunk_index, frames_done, previous):
+        """
+        Moves a chunk's entry in the job's chunk_frames map from previous to
+        frames_done, adding the difference to the frames_processed count shared
+        by the chunks of a fanned-out job.
+
+        Both happen only while the entry still holds previous, so a redelivered
+        chunk, which starts again from 0, cannot count its frames twice; it gets
+        the earlier attempt's count back instead and adds nothing until it passes
+        it. Returns the count now stored for the chunk, or None on errors.
+        """
+        try:
             self.table.update_item(
                 Key={
                     'user_id': user_id,
                     'video_id': video_id
                 },
-                UpdateExpression='SET #status = :status, updated_at = :updated_at' + 
-                                (', output_url = :output_url' if output_url else '') +
-                                (', error = :error' if error else ''),
+                UpdateExpression='SET #chunk_frames.#chunk = :done, #updated_at = :updated_at '
+                                 'ADD #frames_processed :delta',
+                ConditionExpression='attribute_not_exists(#chunk_frames.#chunk) OR #chunk_frames.#chunk = :previous',
                 ExpressionAttributeNames={
-                    '#status': 'status'
+                    '#chunk_frames': 'chunk_frames',
+                    '#chunk': str(chunk_index),
+                    '#updated_at': 'updated_at',
+                    '#frames_processed': 'frames_processed'
                 },
                 ExpressionAttributeValues={
-                    ':status': status,
-                    ':updated_at': item['updated_at'],
-                    **(dict([(':output_url', output_url)]) if output_url else {}),
-                    **(dict([(':error', error)]) if error else {})
+                    ':done': frames_done,
+                    ':previous': previous,
+                    ':delta': frames_done - previous,
+                    ':updated_at': datetime.now().isoformat()
                 }
             )
+            return frames_done
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                return None
+        except Exception as e:
+            return None
+
+        try:
+            item = self.table.get_item(
+                Key={'user_id': user_id, 'video_id': video_id},
+                ProjectionExpression='#chunk_frames.#chunk',
+                ExpressionAttributeNames={'#chunk_frames': 'chunk_frames', '#chunk': str(chunk_index)}
+            ).get('Item') or {}
+            return int(item.get('chunk_frames', {}).get(str(chunk_index), previous))
+        except Exception as e:
+            return None
+
+    def progress_reporter(self, user_id, video_id, chunk_index=None):
+        """
+        Returns a ProgressReporter for a job, throttled by PROGRESS_INTERVAL_SECONDS
+        (default 5) and PROGRESS_MIN_PERCENT (default 1).
+
+        A whole video records its percent complete. Chunk chunk_index of a
+        fanned-out job instead adds the frames it processed since its last write
+        to the job's frames_processed (see add_frames_processed), next to the
+        frames_total set when it was split; the remainder is added when the
+        reporter is closed.
+        """
+        min_interval = float(os.environ.get('PROGRESS_INTERVAL_SECONDS', '5'))
+        min_percent = int(os.environ.get('PROGRESS_MIN_PERCENT', '1'))
+        if chunk_index is None:
+            return ProgressReporter(
+                lambda done, total, percent: self.report_progress(user_id, video_id, done, total, percent),
+                min_interval, min_percent
+            )
+
+        reported = [0]
+        def add_delta(done, total, percent):
+            if done > reported[0]:
+                stored = self.add_frames_processed(user_id, video_id, chunk_index, done, reported[0])
+                if stored is not None:
+                    reported[0] = stored
+        return ProgressReporter(add_delta, min_interval, min_percent, flush_on_close=True)
+
+    @timed('dynamodb_get')
+    def get_checkpoint(self, user_id, video_id):
+        """
+        The checkpoint a job left when it ran out of time, as {'next_frame', 'parts'},
+        or None when it has to start from the beginning
+        """
+        item = self.table.get_item(Key={'user_id': user_id, 'video_id': video_id}).get('Item') or {}
+        checkpoint = item.get('checkpoint')
+        if not checkpoint:
+            return None
+        return {'next_frame': int(checkpoint['next_frame']), 'parts': int(checkpoint['parts'])}
+
+    @timed('dynamodb_update')
+    def save_checkpoint(self, user_id, video_id, next_frame, parts):
+        """Records that a job has parts archives covering the frames before next_frame; raises on failure"""
+        self._update_item(user_id, video_id, {
+            'checkpoint': {'next_frame': next_frame, 'parts': parts},
+            'updated_at': datetime.now().isoformat()
+        })
+
+    @timed('dynamodb_update')
+    def clear_checkpoint(self, user_id, video_id):
+        self.table.update_item(
+            Key={
+                'user_id': user_id,
+                'video_id': video_id
+            },
+            UpdateExpression='REMOVE #checkpoint',
+            ExpressionAttributeNames={'#checkpoint': 'checkpoint'}
+        )
+
+    @timed('dynamodb_update')
+    def complete_chunk(self, user_id, video_id, chunk_index, chunk_total):
+        """
+        Records a finished chunk of a fanned-out job.
+
+        Chunk indexes are added to a set, so redelivered chunks are counted once.
+        Returns True whenever the set is complete after the call, including for a
+        redelivered chunk, as the invocation that was merging may have timed
+        out; the caller then competes for the merge with claim_merge. Once a
+        sibling chunk has failed the job (see fail_job) nothing is recorded and
+        False is returned, so the job stays in ERROR and is never merged.
+        """
+        try:
+            response = self._update_item(
+                user_id,
+                video_id,
+                {'updated_at': datetime.now().isoformat()},
+                add={'completed_chunks': {chunk_index}},
+                return_values='UPDATED_OLD',
+                condition='attribute_not_exists(#status) OR #status <> :error',
+                condition_values={':error': 'ERROR'}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        completed = response.get('Attributes', {}).get('completed_chunks', set())
+        return len(set(completed) | {chunk_index}) == chunk_total
+
+    @timed('dynamodb_update')
+    def claim_merge(self, user_id, video_id, lease_seconds):
+        """
+        Claims the merge of a fanned-out job for lease_seconds, so that one
+        invocation at a time merges it.
+
+        The claim is granted while the job is PROCESSING and nobody holds an
+        unexpired lease: a holder that timed out mid-merge leaves the merge to
+        whoever claims it next. Returns the job item as it was before the claim
+        (see record_merge for what it can hold), or None when not granted.
+        """
+        now = time.time()
+        try:
+            response = self._update_item(
+                user_id,
+                video_id,
+                {'merge_expires': int(now + lease_seconds), 'updated_at': datetime.now().isoformat()},
+                return_values='ALL_OLD',
+                condition='#status = :processing AND (attribute_not_exists(#merge_expires) OR #merge_expires < :now)',
+                condition_values={':processing': 'PROCESSING', ':now': int(now)}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+        return response.get('Attributes', {})
+
+    @timed('dynamodb_update')
+    def record_merge(self, user_id, video_id, frame_count):
+        """
+        Records that frames.zip of a fanned-out job is complete, before its chunk
+        archives are deleted, so a later claimant skips straight to the cleanup
+        """
+        self._update_item(user_id, video_id, {
+            'merge_state': 'MERGED',
+            'merged_frames': frame_count,
+            'updated_at': datetime.now().isoformat()
+        })
+
+    @timed('dynamodb_update')
+    def release_merge(self, user_id, video_id):
+        """Gives up a merge claim after a failure, so the next redelivery can take it at once"""
+        try:
+            self._update_item(user_id, video_id, {'merge_expires': 0})
             return True
         except Exception as e:
             return False
 
+    @timed('sns_publish')
     def notify_completion(self, user_id, video_id, status, output_url=None, error=None):
         """Sends notification via SNS"""
         try:
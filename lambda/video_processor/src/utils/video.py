@@ -2,40 +2,511 @@ import cv2
 import os
 import zipfile
 import logging
+import multiprocessing
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from utils.sampling import build_sampler
+from utils.decoders import open_decoder
+from utils.encoding import FrameEncoder
+from utils.metrics import current as current_metrics, timed
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def extract_frames(video_path, output_dir, frame_interval=30):
+# How extract_frames moves between sampled frames:
+#   read - decode and convert every frame (original behaviour)
+#   grab - decode every frame but only convert the sampled ones
+#   seek - jump straight to every sampled frame
+#   auto - grab, but seek across gaps of at least one keyframe interval
+FRAME_STRATEGIES = ('read', 'grab', 'seek', 'auto')
+
+# Shortest timeline slice worth handing to its own decoder process
+MIN_SEGMENT_FRAMES = 900
+
+# Encoded frames the parent holds for a segment that is not yet being
+# streamed; past that, its decoder blocks on the pipe until its turn
+MAX_BUFFERED_FRAMES = 16
+
+# Decoded frames handed to content filters at once
+FILTER_BATCH_SIZE = 8
+
+# Decoder processes are forked from a single-threaded server process rather
+# than from the handler, whose other threads (records processed concurrently,
+# uploads, progress writes) may hold locks inside cv2, boto3 or logging that a
+# plain fork would copy in their locked state
+DECODE_START_METHOD = 'forkserver'
+
+def _iter_sampled_frames(decoder, selector, strategy='auto', keyframe_interval=None, start=0, end=None):
+    """
+    Yields (number, frame) for every frame the selector picks from an open decoder (see utils.decoders).
+
+    Seeking restarts decoding at the keyframe preceding the target, so it only
+    pays off when the gap between samples is at least one GOP long. When the
+    keyframe spacing is not given, 'auto' learns it from the frame types the
+    decoder reports while grabbing.
+
+    start and end restrict sampling to frames in [start, end); samples keep
+    the number they have in the whole video.
+    """
+    if not decoder.is_opened():
+        return
+
+    if start:
+        decoder.seek(start)
+
+    number = selector.number_at(start)
+    target = selector.index_of(number)
+
+    if strategy == 'read' or (strategy == 'auto' and selector.index_of(1) <= 1):
+        index = start
+        while end is None or target < end:
+            ret, frame = decoder.read()
+            if not ret:
+                return
+            if index == target:
+                yield number, frame
+                number += 1
+                target = selector.index_of(number)
+            index += 1
+        return
+
+    track_keyframes = strategy == 'auto' and not keyframe_interval and decoder.reports_keyframes
+    last_keyframe = None
+
+    position = start  # index of the next frame the capture will return
+    while end is None or target < end:
+        gap = target - position
+        if gap > 0 and (strategy == 'seek' or (strategy == 'auto' and keyframe_interval and gap >= keyframe_interval)):
+            decoder.seek(target)
+            position = target
+
+        while position <= target:
+            if position < target:
+                if not decoder.grab():
+                    return
+                frame = None
+            else:
+                ret, frame = decoder.read()
+                if not ret:
+                    return
+
+            if track_keyframes and decoder.is_keyframe():
+                if last_keyframe is not None:
+                    keyframe_interval = position - last_keyframe
+                    track_keyframes = False
+                last_keyframe = position
+            position += 1
+
+        yield number, frame
+        number += 1
+        target = selector.index_of(number)
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _filter_frames(frames, filters):
+    """
+    Passes (number, frame) through content filters, renumbering the frames kept.
+
+    Filters see FILTER_BATCH_SIZE frames at a time so they can vectorize their
+    work; each filter only sees the frames the previous ones kept.
+    """
+    metrics = current_metrics()
+    kept = 0
+    for batch in _batched((frame for _, frame in frames), FILTER_BATCH_SIZE):
+        with metrics.stage('filter'):
+            for content_filter in filters:
+                batch = [frame for frame, keep in zip(batch, content_filter.select(batch)) if keep]
+        for frame in batch:
+            yield kept, frame
+            kept += 1
+
+def _reporting_progress(items, frames_done, total, progress):
+    """Passes (key, value) items through, calling progress(frames_done(key), total) for each"""
+    for key, value in items:
+        progress(frames_done(key), total)
+        yield key, value
+
+def _stopping(items, stop, resume_frame, stats):
+    """
+    Passes (key, value) items through until stop() is true, recording in
+    stats['resume_frame'] the frame (resume_frame(key) of the first item held
+    back) where extraction should carry on
+    """
+    for key, value in items:
+        if stop():
+            if stats is not None:
+                stats['resume_frame'] = resume_frame(key)
+            return
+        yield key, value
+
+def _sampling_spec(frame_interval, sampling):
+    return sampling or {'mode': 'interval', 'frame_interval': frame_interval}
+
+def _default_encode_workers():
+    """Number of encoder threads: ENCODE_WORKERS, or one per available CPU"""
+    return int(os.environ.get('ENCODE_WORKERS', '0')) or os.cpu_count() or 1
+
+def _default_decode_workers():
+    """Number of decoder processes: DECODE_WORKERS, or one per available CPU"""
+    return int(os.environ.get('DECODE_WORKERS', '0')) or os.cpu_count() or 1
+
+def _map_ordered(func, items, workers, max_pending=None):
+    """
+    Applies func to items on a pool of worker threads, yielding results in input order.
+
+    At most max_pending items (twice the worker count by default) are in flight,
+    which bounds the number of decoded frames held in memory. OpenCV releases
+    the GIL while encoding, so threads are enough to use every core.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    max_pending = max_pending or workers * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _plan_segments(frame_count, frame_interval, workers, min_segment_frames=None, start=0, end=None):
+    """
+    Splits frames [start, end) of the timeline into at most workers ranges.
+
+    Boundaries fall on multiples of frame_interval (the selector's alignment)
+    so every segment samples exactly the frames a single pass would. When end is None the last range is
+    open-ended, because the container's frame count is only an estimate.
+    """
+    min_segment_frames = min_segment_frames or MIN_SEGMENT_FRAMES
+    stop = end if end is not None else frame_count
+    span = stop - start
+    segment_count = min(workers, span // min_segment_frames)
+    if segment_count <= 1:
+        return [(start, end)]
+
+    samples = -(-span // frame_interval)
+    length = -(-samples // segment_count) * frame_interval
+    starts = list(range(start, stop, length))
+    return [(s, s + length) for s in starts[:-1]] + [(starts[-1], end)]
+
+def plan_chunks(frame_count, frame_interval, chunk_frames):
+    """
+    Splits a video into [start, end) ranges of about chunk_frames frames.
+
+    Like _plan_segments, boundaries fall on sampled frames and the last range
+    is open-ended.
+    """
+    length = max(chunk_frames // frame_interval, 1) * frame_interval
+    starts = list(range(0, frame_count, length)) or [0]
+    return [(s, s + length) for s in starts[:-1]] + [(starts[-1], None)]
+
+def probe_video(source):
+    """Reads frame count, fps and resolution from the container headers"""
+    cap = cv2.VideoCapture(source)
+    try:
+        if not cap.isOpened():
+            raise Exception(f"Could not open video: {source}")
+        return {
+            'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            'fps': cap.get(cv2.CAP_PROP_FPS),
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        }
+    finally:
+        cap.release()
+
+def _decode_segment(conn, video_path, start, end, sampling, output, strategy, keyframe_interval, decoder, threads):
+    """Worker process: decodes and encodes one segment, sending frames to the parent"""
+    try:
+        encoder = FrameEncoder(output)
+        source = open_decoder(video_path, decoder, threads)
+        try:
+            selector, _ = build_sampler(sampling, source.fps)
+            for number, frame in _iter_sampled_frames(source, selector, strategy, keyframe_interval, start, end):
+                conn.send(('frame', encoder.filename(number), encoder.encode(frame)))
+        finally:
+            source.release()
+        conn.send(('done',))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
+
+def _iter_segments_parallel(video_path, segments, sampling, output, strategy, keyframe_interval, decoder):
+    """
+    Decodes each segment in its own process and yields (filename, data) in single-pass order.
+
+    Every process opens the video with the backend the parent chose, and
+    splits the CPUs with the others for its decoding threads. Processes are
+    started with DECODE_START_METHOD.
+
+    Workers talk to the parent over pipes rather than a multiprocessing
+    Pool/Queue, which need /dev/shm and are unavailable on Lambda. Frames
+    of the segment at the head are streamed through; later segments are
+    buffered until their turn, up to MAX_BUFFERED_FRAMES each: the parent
+    stops reading a segment that is that far ahead, so its process blocks
+    on the full pipe and memory stays bounded however long the video is.
+    """
+    threads = max((os.cpu_count() or 1) // len(segments), 1)
+    context = multiprocessing.get_context(DECODE_START_METHOD)
+    if DECODE_START_METHOD == 'forkserver':
+        # Start the server with this module (and cv2) loaded, instead of the runtime's __main__
+        context.set_forkserver_preload([__name__])
+    connections = {}
+    processes = []
+    for i, (start, end) in enumerate(segments):
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_decode_segment,
+            args=(child_conn, video_path, start, end, sampling, output, strategy, keyframe_interval, decoder, threads),
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        connections[parent_conn] = i
+        processes.append(process)
+
+    buffered = [deque() for _ in segments]
+    finished = [False] * len(segments)
+    current = 0
+    try:
+        while current < len(segments):
+            while buffered[current]:
+                yield buffered[current].popleft()
+            if finished[current]:
+                current += 1
+                continue
+
+            readable = [conn for conn, i in connections.items()
+                        if i == current or len(buffered[i]) < MAX_BUFFERED_FRAMES]
+            for conn in wait(readable):
+                i = connections[conn]
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    raise Exception(f"Decoder for segment {i} exited unexpectedly")
+                if message[0] == 'frame':
+                    buffered[i].append(message[1:])
+                elif message[0] == 'done':
+                    finished[i] = True
+                    del connections[conn]
+                    conn.close()
+                else:
+                    raise Exception(f"Decoder for segment {i} failed: {message[1]}")
+    finally:
+        for conn in connections:
+            conn.close()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def _iter_encoded_frames(video_path, sampling, output, strategy, keyframe_interval, encode_workers, decode_workers,
+                         start=0, end=None, stats=None, progress=None, stop=None, decoder=None):
+    """
+    Yields (filename, data) for every sampled frame in [start, end) of a video, in order.
+
+    Frames are encoded as the output spec asks (see utils.encoding) and named
+    after their sample number.
+
+    Frames picked by index are numbered by their position in the whole video,
+    so ranges of the same video can be extracted separately. Long ranges are
+    split across decode_workers processes; otherwise frames are decoded here
+    and encoded on encode_workers threads. Content filters compare each frame
+    with the ones before it, so sampling specs that use them are decoded in a
+    single pass and numbered by the frames kept; the number they drop is
+    recorded in stats['frames_dropped'].
+
+    progress, when given, is called with (frames_done, frames_total) of the
+    range as sampled frames are decoded; the total is the container's
+    estimate.
+
+    stop, when given, is called before each sampled frame is encoded; once it
+    returns True no more frames are yielded and stats['resume_frame'] is set
+    to the frame a later extraction of [resume_frame, end) should start at.
+    Frames kept by content filters or keyframe sampling are numbered from the
+    start of the range, so those sampling specs cannot be stopped.
+
+    decoder names the backend that decodes the video (see utils.decoders).
+    """
+    if strategy not in FRAME_STRATEGIES:
+        raise ValueError(f"Unknown frame strategy: {strategy}")
+
+    encoder = FrameEncoder(output)
+    # Encoding runs on pool threads, which do not inherit the current context
+    metrics = current_metrics()
+
+    def encode(item):
+        number, frame = item
+        with metrics.stage('encode'):
+            data = encoder.encode(frame)
+        metrics.count('encoded_bytes', len(data))
+        return encoder.filename(number), data
+
+    source = open_decoder(video_path, decoder, keyframes_only=sampling.get('mode') == 'keyframes')
+    try:
+        selector, filters = build_sampler(sampling, source.fps)
+        keyframes_only = getattr(selector, 'keyframes_only', False)
+        if stop and (filters or keyframes_only):
+            raise ValueError("Extraction with content filters or keyframe sampling cannot be stopped and resumed")
+        if stats is not None:
+            stats['frames_dropped'] = 0
+        frame_count = source.frame_count
+        total = (end if end is not None else frame_count) - start
+        segments = [(start, end)]
+        decode_workers = decode_workers or _default_decode_workers()
+        if decode_workers > 1 and not filters and selector.alignment:
+            segments = _plan_segments(frame_count, selector.alignment, decode_workers, start=start, end=end)
+
+        if keyframes_only:
+            frames = metrics.timed_iter(source.iter_keyframes(start, end), 'decode', 'frames_decoded')
+            if progress:
+                frames = _reporting_progress(frames, lambda index: index - start + 1, total, progress)
+            frames = enumerate(frame for _, frame in frames)
+        elif len(segments) == 1:
+            frames = metrics.timed_iter(_iter_sampled_frames(source, selector, strategy, keyframe_interval, start, end),
+                                        'decode', 'frames_decoded')
+            if progress:
+                frames = _reporting_progress(frames, lambda number: selector.index_of(number) - start + 1,
+                                             total, progress)
+            if stop:
+                frames = _stopping(frames, stop, selector.index_of, stats)
+
+        if len(segments) == 1:
+            if filters:
+                frames = _filter_frames(frames, filters)
+            yield from _map_ordered(encode, frames, encode_workers or _default_encode_workers())
+            dropped = sum(f.dropped for f in filters)
+            metrics.count('frames_dropped', dropped)
+            if stats is not None:
+                stats['frames_dropped'] = dropped
+            return
+    finally:
+        decoder_name = source.name
+        source.release()
+
+    # Decoder processes also encode, so their time is recorded as a single stage
+    frames = metrics.timed_iter(
+        _iter_segments_parallel(video_path, segments, sampling, output, strategy, keyframe_interval, decoder_name),
+        'decode_parallel', 'frames_decoded'
+    )
+    # Without filters the k-th frame out is sample number_at(start) + k
+    first = selector.number_at(start)
+    frames = enumerate(frames)
+    if progress:
+        frames = _reporting_progress(frames, lambda k: selector.index_of(first + k) - start + 1, total, progress)
+    if stop:
+        frames = _stopping(frames, stop, lambda k: selector.index_of(first + k), stats)
+    yield from (item for _, item in frames)
+
+def extract_frames(video_path, output_dir, frame_interval=30, strategy='auto', keyframe_interval=None,
+                   encode_workers=None, decode_workers=None, start=0, end=None, sampling=None, output=None,
+                   stats=None, progress=None, stop=None, decoder=None):
     """
     Extracts frames from a video and saves them to a directory.
+
+    sampling selects which frames are kept (see utils.sampling); without it
+    every frame_interval-th frame is. strategy selects how unsampled frames
+    are skipped (see FRAME_STRATEGIES); keyframe_interval is the codec GOP
+    size, when known up front. encode_workers sets the number of JPEG encoder
+    threads and decode_workers the number of processes a long video is split
+    across. start and end limit extraction to a range of frames. output sets
+    the image format, quality and size (see utils.encoding). When a stats
+    dict is given, it receives the number of sampled frames that content
+    filters dropped. progress is called with (frames_done, frames_total) as
+    the video is decoded. stop is polled between frames; when it returns
+    True extraction ends early and stats['resume_frame'] says where to resume.
+    decoder selects the decoding backend (see utils.decoders.DECODER_BACKENDS);
+    by default DECODER_BACKEND, or auto.
     """
     try:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        
-        cap = cv2.VideoCapture(video_path)
-        frame_count = 0
+
         saved_count = 0
-        
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            if frame_count % frame_interval == 0:
-                frame_name = os.path.join(output_dir, f"frame_{saved_count:04d}.jpg")
-                cv2.imwrite(frame_name, frame)
+        for name, data in _iter_encoded_frames(video_path, _sampling_spec(frame_interval, sampling), output, strategy,
+                                               keyframe_interval, encode_workers, decode_workers, start, end, stats,
+                                               progress, stop, decoder):
+            with current_metrics().stage('write'):
+                with open(os.path.join(output_dir, name), 'wb') as f:
+                    f.write(data)
+            saved_count += 1
+        current_metrics().count('frames_saved', saved_count)
+
+        return True, saved_count
+    except Exception as e:
+        logger.error(f"Error extracting frames: {str(e)}")
+        return False, 0
+
+def extract_frames_to_zip(video_path, zip_path, frame_interval=30, strategy='auto', keyframe_interval=None,
+                          encode_workers=None, decode_workers=None, start=0, end=None, sampling=None, output=None,
+                          stats=None, progress=None, stop=None, decoder=None):
+    """
+    Extracts frames from a video straight into a ZIP archive.
+
+    Each sampled frame is encoded in memory and appended to the archive as
+    soon as it is decoded, so no frames directory is staged on disk. Images
+    are already compressed, so entries are stored rather than deflated.
+    zip_path may also be a writable file object. Parameters are as for
+    extract_frames; an archive cut short by stop holds the frames before
+    stats['resume_frame'].
+    """
+    metrics = current_metrics()
+    try:
+        saved_count = 0
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zipf:
+            for name, data in _iter_encoded_frames(video_path, _sampling_spec(frame_interval, sampling), output,
+                                                   strategy, keyframe_interval, encode_workers, decode_workers,
+                                                   start, end, stats, progress, stop, decoder):
+                with metrics.stage('zip_write'):
+                    zipf.writestr(name, data)
                 saved_count += 1
-            
-            frame_count += 1
-        
-        cap.release()
+        metrics.count('frames_saved', saved_count)
+
         return True, saved_count
     except Exception as e:
         logger.error(f"Error extracting frames: {str(e)}")
         return False, 0
 
+@timed('merge')
+def merge_zips(sources, zip_path):
+    """
+    Concatenates the entries of several ZIP archives into one, in order.
+
+    Entries keep their compression method. sources and zip_path may be
+    paths or file objects.
+    """
+    try:
+        entry_count = 0
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zipf:
+            for source in sources:
+                with zipfile.ZipFile(source) as part:
+                    for info in part.infolist():
+                        entry = zipfile.ZipInfo(info.filename, info.date_time)
+                        entry.compress_type = info.compress_type
+                        with part.open(info) as src, zipf.open(entry, 'w') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                        entry_count += 1
+        return True, entry_count
+    except Exception as e:
+        logger.error(f"Error merging ZIPs: {str(e)}")
+        return False, 0
+
+@timed('zip')
 def create_zip(source_dir, zip_path):
     """
     Creates a ZIP file from a directory.
@@ -50,4 +521,4 @@ def create_zip(source_dir, zip_path):
         return True
     except Exception as e:
         logger.error(f"Error creating ZIP: {str(e)}")
-        return False
\ No newline at end of file
+        return False
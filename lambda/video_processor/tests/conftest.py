@@ -0,0 +1,29 @@
+import os
+import sys
+import pytest
+
+# Lambda runs main.py from the package root, so src/ modules import each other
+# as top-level modules (e.g. utils.storage); mirror that layout here.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils import clients
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    clients.reset()
+    yield
+    clients.reset()
+
+@pytest.fixture
+def sample_video(tmp_path):
+    import cv2
+    import numpy as np
+
+    video_path = str(tmp_path / "sample.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 30, (160, 120))
+    for i in range(95):
+        frame = np.full((120, 160, 3), (i * 7) % 256, dtype=np.uint8)
+        cv2.putText(frame, str(i), (10, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+    return video_path
@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import run as benchmarks
+
+def test_quick_benchmark_runs_and_compares(tmp_path):
+    results = str(tmp_path / "results.json")
+
+    assert benchmarks.main(['run', '--quick', '--cases', 'extract_frames_to_zip,handler',
+                            '--video-dir', str(tmp_path / "videos"), '--output', results]) == 0
+
+    report = json.load(open(results))
+    assert [r['case'] for r in report['results']] == ['extract_frames_to_zip', 'handler']
+    for result in report['results']:
+        assert result['success']
+        assert result['frames_out'] == 5
+        assert result['peak_rss_mb'] > 0
+    assert benchmarks.main(['compare', results, results]) == 0
+
+def test_compare_flags_regressions(tmp_path):
+    def write(name, seconds):
+        path = str(tmp_path / name)
+        result = {'id': 'handler/v.mp4/default', 'success': True, 'seconds': seconds,
+                  'peak_rss_mb': 100, 'peak_tmp_mb': 10, 'output_mb': 5}
+        json.dump({'meta': {}, 'results': [result]}, open(path, 'w'))
+        return path
+
+    assert benchmarks.main(['compare', write('a.json', 2.0), write('b.json', 2.1)]) == 0
+    assert benchmarks.main(['compare', write('a.json', 2.0), write('b.json', 3.0)]) == 1
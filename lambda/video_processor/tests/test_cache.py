@@ -0,0 +1,42 @@
+import pytest
+import time
+from unittest.mock import Mock
+from utils import clients
+from src.utils.cache import ResultCache
+
+@pytest.fixture
+def cache_table():
+    dynamodb = Mock()
+    table = dynamodb.Table.return_value
+    clients.set_resource('dynamodb', dynamodb)
+    return table
+
+def test_content_key_depends_on_content_and_params():
+    key = ResultCache.content_key('"etag-1"', 1000, {'frame_interval': 30})
+
+    assert key == ResultCache.content_key('"etag-1"', 1000, {'frame_interval': 30})
+    assert key != ResultCache.content_key('"etag-2"', 1000, {'frame_interval': 30})
+    assert key != ResultCache.content_key('"etag-1"', 1000, {'frame_interval': 15})
+
+def test_disabled_without_table(monkeypatch):
+    monkeypatch.delenv('RESULT_CACHE_TABLE', raising=False)
+
+    assert not ResultCache().enabled
+
+def test_lookup_hit_extends_expiry(cache_table):
+    cache_table.get_item.return_value = {
+        'Item': {'cache_key': 'k', 'bucket': 'out', 'key': 'outputs/a/b/frames.zip', 'expires_at': time.time() + 60}
+    }
+    cache = ResultCache('cache-table', ttl_seconds=3600)
+
+    entry = cache.lookup('k')
+
+    assert entry['key'] == 'outputs/a/b/frames.zip'
+    new_expiry = cache_table.update_item.call_args.kwargs['ExpressionAttributeValues'][':expires_at']
+    assert new_expiry >= time.time() + 3599
+
+def test_lookup_ignores_expired_entries(cache_table):
+    cache_table.get_item.return_value = {'Item': {'cache_key': 'k', 'expires_at': time.time() - 1}}
+
+    assert ResultCache('cache-table').lookup('k') is None
+    cache_table.update_item.assert_not_called()
@@ -0,0 +1,201 @@
+import pytest
+import zipfile
+import cv2
+import numpy as np
+from unittest.mock import patch
+from utils import decoders
+from utils.decoders import open_decoder, select_backend, OpenCVDecoder, PyAVDecoder
+from src.utils.video import extract_frames_to_zip, FRAME_STRATEGIES
+
+# Every backend must pass the same tests; PyAV ones are skipped without the av package
+BACKENDS = [
+    'opencv',
+    pytest.param('pyav', marks=pytest.mark.skipif(decoders.av is None, reason='PyAV is not installed')),
+]
+
+KEYFRAME_INTERVAL = 12
+
+# Keyframes of sample_video: one every KEYFRAME_INTERVAL frames, and the
+# encoder starts more around the frames where the brightness wraps around
+KEYFRAMES = [0, 12, 24, 33, 34, 35, 36, 37, 49, 61, 70, 71, 72, 73, 74, 86]
+
+@pytest.fixture
+def reference_frames(sample_video):
+    cap = cv2.VideoCapture(sample_video)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+def same_image(a, b):
+    # Backends share FFmpeg's colour conversion, but allow for rounding differences
+    return a.shape == b.shape and np.abs(a.astype(np.int16) - b).mean() < 1.0
+
+def decode_entry(zipf, name):
+    return cv2.imdecode(np.frombuffer(zipf.read(name), np.uint8), cv2.IMREAD_UNCHANGED)
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decoder_reads_properties(sample_video, backend):
+    decoder = open_decoder(sample_video, backend)
+    try:
+        assert decoder.name == backend
+        assert decoder.is_opened()
+        assert decoder.fps == pytest.approx(30)
+        assert decoder.frame_count == 95
+    finally:
+        decoder.release()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decoder_reads_every_frame_in_order(sample_video, reference_frames, backend):
+    decoder = open_decoder(sample_video, backend)
+    try:
+        for expected in reference_frames:
+            ret, frame = decoder.read()
+            assert ret and same_image(frame, expected)
+        assert decoder.read() == (False, None)
+        assert not decoder.grab()
+    finally:
+        decoder.release()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('index', [1, 12, 50, 94])
+def test_decoder_seek_lands_on_frame(sample_video, reference_frames, backend, index):
+    decoder = open_decoder(sample_video, backend)
+    try:
+        assert decoder.grab()
+        decoder.seek(index)
+        ret, frame = decoder.read()
+        assert ret and same_image(frame, reference_frames[index])
+        # Decoding carries on from there
+        assert decoder.grab() == (index + 1 < len(reference_frames))
+    finally:
+        decoder.release()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decoder_reports_keyframes(sample_video, backend):
+    decoder = open_decoder(sample_video, backend)
+    try:
+        keyframes = []
+        for index in range(30):
+            assert decoder.grab()
+            if decoder.is_keyframe():
+                keyframes.append(index)
+        assert keyframes == [0, 12, 24]
+    finally:
+        decoder.release()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decoder_iter_keyframes(sample_video, reference_frames, backend):
+    decoder = open_decoder(sample_video, backend)
+    try:
+        keyframes = list(decoder.iter_keyframes(start=20, end=80))
+    finally:
+        decoder.release()
+
+    assert [index for index, _ in keyframes] == [k for k in KEYFRAMES if 20 <= k < 80]
+    for index, frame in keyframes:
+        assert same_image(frame, reference_frames[index])
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('strategy', FRAME_STRATEGIES)
+def test_extraction_matches_across_backends(sample_video, tmp_path, backend, strategy):
+    expected_zip = str(tmp_path / "expected.zip")
+    actual_zip = str(tmp_path / "actual.zip")
+
+    assert extract_frames_to_zip(sample_video, expected_zip, frame_interval=7, strategy='read',
+                                 decoder='opencv', decode_workers=1) == (True, 14)
+    assert extract_frames_to_zip(sample_video, actual_zip, frame_interval=7, strategy=strategy,
+                                 keyframe_interval=KEYFRAME_INTERVAL if strategy == 'auto' else None,
+                                 start=10, decoder=backend, decode_workers=1) == (True, 12)
+
+    with zipfile.ZipFile(expected_zip) as expected, zipfile.ZipFile(actual_zip) as actual:
+        assert actual.namelist() == expected.namelist()[2:]
+        for name in actual.namelist():
+            assert same_image(decode_entry(actual, name), decode_entry(expected, name))
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_parallel_extraction_matches_across_backends(sample_video, tmp_path, backend):
+    expected_zip = str(tmp_path / "expected.zip")
+    actual_zip = str(tmp_path / "actual.zip")
+
+    assert extract_frames_to_zip(sample_video, expected_zip, frame_interval=7, decoder='opencv',
+                                 decode_workers=1) == (True, 14)
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20):
+        assert extract_frames_to_zip(sample_video, actual_zip, frame_interval=7, decoder=backend,
+                                     decode_workers=3) == (True, 14)
+
+    with zipfile.ZipFile(expected_zip) as expected, zipfile.ZipFile(actual_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+        for name in actual.namelist():
+            assert same_image(decode_entry(actual, name), decode_entry(expected, name))
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_keyframe_sampling(sample_video, tmp_path, backend):
+    zip_path = str(tmp_path / "frames.zip")
+    progress = []
+
+    assert extract_frames_to_zip(sample_video, zip_path, sampling={'mode': 'keyframes'}, decoder=backend,
+                                 progress=lambda done, total: progress.append(done)) == (True, len(KEYFRAMES))
+
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert len(zipf.namelist()) == len(KEYFRAMES)
+    assert progress == [k + 1 for k in KEYFRAMES]
+
+def test_keyframe_sampling_cannot_stop(sample_video, tmp_path):
+    assert extract_frames_to_zip(sample_video, str(tmp_path / "frames.zip"), sampling={'mode': 'keyframes'},
+                                 stop=lambda: False) == (False, 0)
+
+def test_select_backend():
+    with patch.object(decoders, 'av', object()):
+        assert select_backend('h264', 'mov,mp4,m4a,3gp,3g2,mj2') == 'opencv'
+        assert select_backend('hevc', 'mov,mp4,m4a,3gp,3g2,mj2') == 'pyav'
+        assert select_backend('h264', 'matroska,webm') == 'pyav'
+        assert select_backend('h264', 'mov,mp4,m4a,3gp,3g2,mj2', keyframes_only=True) == 'pyav'
+    with patch.object(decoders, 'av', None):
+        assert select_backend('hevc', 'matroska,webm') == 'opencv'
+
+@pytest.mark.skipif(decoders.av is None, reason='PyAV is not installed')
+def test_auto_backend_picks_by_codec(sample_video):
+    decoder = open_decoder(sample_video, 'auto')
+    assert isinstance(decoder, OpenCVDecoder)
+    decoder.release()
+
+    decoder = open_decoder(sample_video, 'auto', keyframes_only=True)
+    assert isinstance(decoder, PyAVDecoder)
+    decoder.release()
+
+    with patch.object(decoders, 'PYAV_CODECS', ('mpeg4',)):
+        decoder = open_decoder(sample_video, 'auto')
+        assert isinstance(decoder, PyAVDecoder)
+        decoder.release()
+
+def test_auto_backend_falls_back_to_opencv(sample_video, tmp_path):
+    with patch.object(decoders, 'av', None):
+        decoder = open_decoder(sample_video, 'auto')
+        assert isinstance(decoder, OpenCVDecoder)
+        decoder.release()
+
+    # Sources PyAV cannot open are left to OpenCV
+    decoder = open_decoder(str(tmp_path / "missing.mp4"), 'auto')
+    assert isinstance(decoder, OpenCVDecoder)
+    assert not decoder.is_opened()
+    decoder.release()
+
+def test_backend_from_environment(sample_video, monkeypatch):
+    monkeypatch.setenv('DECODER_BACKEND', 'opencv')
+    decoder = open_decoder(sample_video)
+    assert isinstance(decoder, OpenCVDecoder)
+    decoder.release()
+
+    monkeypatch.setenv('DECODER_BACKEND', 'gstreamer')
+    with pytest.raises(ValueError):
+        open_decoder(sample_video)
+
+def test_pyav_backend_requires_av(sample_video):
+    with patch.object(decoders, 'av', None):
+        with pytest.raises(ValueError):
+            open_decoder(sample_video, 'pyav')
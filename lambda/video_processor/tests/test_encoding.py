@@ -0,0 +1,49 @@
+import pytest
+import cv2
+import numpy as np
+from src.utils.encoding import FrameEncoder
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+def test_default_is_jpeg_at_source_resolution(frame):
+    encoder = FrameEncoder()
+
+    assert encoder.filename(7) == 'frame_0007.jpg'
+    assert decode(encoder.encode(frame)).shape == (1080, 1920, 3)
+
+def test_downscale_keeps_aspect_ratio(frame):
+    assert decode(FrameEncoder({'max_width': 640}).encode(frame)).shape == (360, 640, 3)
+    assert decode(FrameEncoder({'max_width': 1280, 'max_height': 360}).encode(frame)).shape == (360, 640, 3)
+    # never upscaled
+    assert decode(FrameEncoder({'max_width': 4000}).encode(frame)).shape == (1080, 1920, 3)
+
+def test_grayscale(frame):
+    assert decode(FrameEncoder({'grayscale': True, 'max_height': 100}).encode(frame)).ndim == 2
+
+def test_quality_and_format(frame):
+    small = FrameEncoder({'quality': 30}).encode(frame)
+    large = FrameEncoder({'quality': 95}).encode(frame)
+    assert len(small) < len(large)
+
+    for output_format, extension in (('webp', 'webp'), ('png', 'png')):
+        encoder = FrameEncoder({'format': output_format, 'quality': 80, 'max_width': 320})
+        assert encoder.filename(0) == f'frame_0000.{extension}'
+        assert decode(encoder.encode(frame)).shape == (180, 320, 3)
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        FrameEncoder({'format': 'gif'})
+
+@pytest.mark.parametrize('spec', [
+    {'quality': 'high'}, {'quality': 101}, {'quality': 80.5}, {'max_width': '1280'}, {'max_width': 0},
+    {'max_height': True}, {'grayscale': 'yes'}, ['jpeg'],
+])
+def test_invalid_options(spec):
+    with pytest.raises(ValueError):
+        FrameEncoder(spec)
@@ -0,0 +1,62 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import Metrics, current, recording, timed
+
+@timed('work')
+def work(value):
+    return value * 2
+
+def test_stages_and_counters():
+    metrics = Metrics()
+    with metrics.stage('decode'):
+        pass
+    with metrics.stage('decode'):
+        pass
+    metrics.count('frames_saved', 3)
+    metrics.count('frames_saved')
+
+    values = metrics.as_dict()
+    assert set(values['stages_ms']) == {'decode'}
+    assert values['counters'] == {'frames_saved': 4}
+
+def test_timed_records_into_current_metrics_only():
+    assert work(1) == 2  # nothing is recording: discarded
+
+    with recording(Metrics()) as metrics:
+        assert current() is metrics
+        work(2)
+
+    assert 'work' in metrics.as_dict()['stages_ms']
+    assert current() is not metrics
+
+def test_threads_share_an_explicit_recorder():
+    metrics = Metrics()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: metrics.count('encoded'), range(100)))
+
+    assert metrics.counters['encoded'] == 100
+
+def test_timed_iter_counts_items():
+    metrics = Metrics()
+
+    assert list(metrics.timed_iter(iter([1, 2, 3]), 'decode', 'frames_decoded')) == [1, 2, 3]
+    assert metrics.counters['frames_decoded'] == 3
+    assert 'decode' in metrics.stages
+
+def test_emf_record(capsys, monkeypatch):
+    monkeypatch.setenv('METRICS_NAMESPACE', 'Test')
+    metrics = Metrics()
+    metrics.add_time('download', 0.25)
+    metrics.count('bytes_in', 1024)
+    metrics.count('frames_saved', 10)
+
+    metrics.emit(video_id='v1')
+
+    record = json.loads(capsys.readouterr().out)
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'Test'
+    assert directive['Dimensions'] == [['Service']]
+    assert {m['Name']: m['Unit'] for m in directive['Metrics']} == {
+        'download_ms': 'Milliseconds', 'bytes_in': 'Bytes', 'frames_saved': 'Count'
+    }
+    assert (record['download_ms'], record['bytes_in'], record['video_id']) == (250.0, 1024, 'v1')
@@ -0,0 +1,101 @@
+import pytest
+import numpy as np
+from src.utils.sampling import IntervalSelector, RateSelector, SceneChangeFilter, DuplicateFilter, build_sampler, check_sampling, split_alignment
+
+def test_interval_selector():
+    selector = IntervalSelector(30)
+
+    assert [selector.index_of(n) for n in range(3)] == [0, 30, 60]
+    assert selector.number_at(0) == 0
+    assert selector.number_at(31) == 2
+
+def test_rate_selector_follows_video_time():
+    # NTSC frame rate: one frame per second lands on the first frame of each second
+    selector = RateSelector(1, 30000 / 1001)
+
+    assert [selector.index_of(n) for n in range(4)] == [0, 30, 60, 90]
+    assert selector.index_of(100) == 2998
+    assert selector.index_of(selector.number_at(31)) == 60
+
+def test_rate_selector_never_repeats_frames():
+    selector = RateSelector(60, 30)
+
+    assert [selector.index_of(n) for n in range(3)] == [0, 1, 2]
+
+def test_rate_selector_needs_frame_rate():
+    with pytest.raises(ValueError):
+        RateSelector(1, 0)
+
+def test_scene_change_filter():
+    scene_filter = SceneChangeFilter(threshold=0.1)
+    dark = np.zeros((120, 160, 3), dtype=np.uint8)
+    bright = np.full((120, 160, 3), 200, dtype=np.uint8)
+
+    assert [scene_filter.accept(f) for f in (dark, dark + 5, bright, bright)] == [True, False, True, False]
+    assert scene_filter.dropped == 2
+
+def test_scene_change_filter_batches_match_single_frames():
+    rng = np.random.default_rng(0)
+    levels = np.cumsum(rng.integers(0, 40, 40)) % 256
+    frames = [np.full((120, 160, 3), level, dtype=np.uint8) for level in levels]
+
+    # Frame by frame against the last kept level; the frames are flat, so
+    # their thumbnails keep the same level
+    expected, last = [], None
+    for level in levels:
+        expected.append(last is None or abs(int(level) - last) / 255.0 > 0.05)
+        last = int(level) if expected[-1] else last
+
+    batched = SceneChangeFilter(threshold=0.05)
+    keep = batched.select(frames[:7]) + batched.select(frames[7:8]) + batched.select(frames[8:])
+
+    assert keep == expected
+    assert True in expected[1:] and False in expected
+    assert batched.dropped == expected.count(False)
+    assert batched.thumbnails(frames[:3]).shape == (3, 36, 64)
+
+def test_duplicate_filter_compares_with_last_kept_frame():
+    duplicate_filter = DuplicateFilter(max_distance=4)
+    ramp = np.tile(np.linspace(0, 200, 160, dtype=np.uint8), (120, 1))
+    brighter = ramp + 40
+    reversed_ramp = ramp[:, ::-1].copy()
+
+    assert duplicate_filter.select([ramp, brighter, reversed_ramp]) == [True, False, True]
+    assert duplicate_filter.select([reversed_ramp, ramp]) == [False, True]
+    assert duplicate_filter.dropped == 2
+
+def test_duplicate_hashes_are_batched():
+    frames = [np.full((120, 160), i * 40, dtype=np.uint8) for i in range(3)]
+
+    assert DuplicateFilter.hashes(frames).shape == (3, 8)
+
+def test_build_sampler():
+    assert isinstance(build_sampler(None, 30)[0], IntervalSelector)
+    selector, filters = build_sampler({'mode': 'scene', 'threshold': 0.3}, 30)
+    assert isinstance(selector, RateSelector)
+    assert filters[0].threshold == 0.3
+    assert build_sampler({'mode': 'interval', 'dedup': 0}, 30)[1][0].max_distance == 0
+    with pytest.raises(ValueError):
+        build_sampler({'mode': 'random'}, 30)
+
+def test_split_alignment():
+    assert split_alignment({'mode': 'interval', 'frame_interval': 15}) == 15
+    assert split_alignment({'mode': 'fps', 'fps': 2}) == 1
+    assert split_alignment({'mode': 'scene'}) is None
+    assert split_alignment({'mode': 'keyframes'}) is None
+    assert split_alignment({'mode': 'fps', 'fps': 2, 'dedup': True}) is None
+
+@pytest.mark.parametrize('spec', [
+    {'mode': 'random'}, {'mode': 'fps', 'fps': 0}, {'mode': 'fps', 'fps': '1'},
+    {'mode': 'interval', 'frame_interval': 0}, {'mode': 'interval', 'frame_interval': 2.5},
+    {'mode': 'scene', 'threshold': 1.5}, {'mode': 'scene', 'check_fps': -1},
+    {'mode': 'keyframes', 'dedup': 65}, {'dedup': 'yes'}, ['interval'],
+])
+def test_check_sampling_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        check_sampling(spec)
+
+def test_check_sampling_accepts_valid_specs():
+    for spec in (None, {'mode': 'fps', 'fps': 0.5}, {'mode': 'scene', 'threshold': 0.2, 'dedup': True},
+                 {'mode': 'interval', 'frame_interval': 1, 'dedup': 0}, {'mode': 'keyframes'}):
+        check_sampling(spec)
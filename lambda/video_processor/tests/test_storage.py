@@ -1,8 +1,10 @@
 import pytest
 import os
 import json
+import struct
 from unittest.mock import Mock, patch, MagicMock
-from src.utils.storage import StorageManager
+from utils import clients
+from src.utils.storage import StorageManager, MultipartUploadWriter, ProgressReporter, MIN_PART_SIZE
 
 def test_storage_manager():
     with patch('boto3.client') as mock_client, \
@@ -21,4 +23,356 @@ def test_storage_manager():
         # Test upload
         s3.upload_file.return_value = None
         assert storage.upload_zip('local_path', 'bucket', 'key')
-        s3.upload_file.assert_called_with('local_path', 'bucket', 'key')
\ No newline at end of file
+        s3.upload_file.assert_called_with('local_path', 'bucket', 'key')
+
+def test_multipart_upload_writer():
+    s3 = Mock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+    with MultipartUploadWriter(s3, 'bucket', 'key', part_size=MIN_PART_SIZE, max_concurrency=2) as writer:
+        writer.write(b'a' * (MIN_PART_SIZE + 10))
+        writer.write(b'b' * MIN_PART_SIZE)
+        assert writer.tell() == 2 * MIN_PART_SIZE + 10
+
+    sizes = {c.kwargs['PartNumber']: len(c.kwargs['Body']) for c in s3.upload_part.call_args_list}
+    assert sizes == {1: MIN_PART_SIZE, 2: MIN_PART_SIZE, 3: 10}
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket='bucket',
+        Key='key',
+        UploadId='upload-1',
+        MultipartUpload={'Parts': [
+            {'PartNumber': 1, 'ETag': 'etag-1'},
+            {'PartNumber': 2, 'ETag': 'etag-2'},
+            {'PartNumber': 3, 'ETag': 'etag-3'}
+        ]}
+    )
+    s3.abort_multipart_upload.assert_not_called()
+
+def test_storage_records_metrics(tmp_path):
+    from utils.metrics import Metrics, recording
+
+    s3 = Mock()
+    s3.download_file.side_effect = lambda bucket, key, path: open(path, 'wb').write(b'x' * 100)
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.return_value = {'ETag': 'etag'}
+    clients.set_client('s3', s3)
+
+    with recording(Metrics()) as metrics:
+        storage = StorageManager()
+        assert storage.download_video('bucket', 'key', str(tmp_path / "video.mp4"))
+        with storage.open_zip_upload('bucket', 'out.zip') as upload:
+            upload.write(b'z' * 42)
+
+    values = metrics.as_dict()
+    assert {'s3_download', 's3_upload_part'} <= set(values['stages_ms'])
+    assert values['counters'] == {'bytes_in': 100, 'bytes_out': 42}
+
+def test_multipart_upload_writer_aborts_on_error():
+    s3 = Mock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+
+    with pytest.raises(RuntimeError):
+        with MultipartUploadWriter(s3, 'bucket', 'key') as writer:
+            writer.write(b'partial')
+            raise RuntimeError('extraction failed')
+
+    s3.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key', UploadId='upload-1')
+    s3.complete_multipart_upload.assert_not_called()
+
+def test_complete_chunk():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        table.update_item.return_value = {'Attributes': {'completed_chunks': {0, 2}}}
+        assert storage.complete_chunk('user', 'video', 1, 3)
+        kwargs = table.update_item.call_args.kwargs
+        assert kwargs['UpdateExpression'] == 'SET #updated_at = :updated_at ADD #completed_chunks :completed_chunks'
+        assert kwargs['ExpressionAttributeValues'][':completed_chunks'] == {1}
+        # A chunk finishing after a sibling failed must not revive the job
+        assert kwargs['ConditionExpression'] == 'attribute_not_exists(#status) OR #status <> :error'
+        assert kwargs['ExpressionAttributeValues'][':error'] == 'ERROR'
+
+        # A redelivered chunk may find the set complete, as when the merging
+        # invocation timed out; claim_merge decides who merges
+        table.update_item.return_value = {'Attributes': {'completed_chunks': {0, 1, 2}}}
+        assert storage.complete_chunk('user', 'video', 1, 3)
+
+        table.update_item.return_value = {'Attributes': {'completed_chunks': {0}}}
+        assert not storage.complete_chunk('user', 'video', 1, 3)
+
+def conditional_check_failed():
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+def test_complete_chunk_after_job_failed():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        table.update_item.side_effect = conditional_check_failed()
+
+        assert not StorageManager().complete_chunk('user', 'video', 2, 3)
+
+def test_claim_merge():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource, patch('time.time', return_value=1000.0):
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        table.update_item.return_value = {'Attributes': {'status': 'PROCESSING', 'merge_expires': 900}}
+        assert storage.claim_merge('user', 'video', 600) == {'status': 'PROCESSING', 'merge_expires': 900}
+        kwargs = table.update_item.call_args.kwargs
+        assert kwargs['ConditionExpression'] == \
+            '#status = :processing AND (attribute_not_exists(#merge_expires) OR #merge_expires < :now)'
+        assert kwargs['ExpressionAttributeValues'][':merge_expires'] == 1600
+        assert kwargs['ExpressionAttributeValues'][':now'] == 1000
+        assert kwargs['ReturnValues'] == 'ALL_OLD'
+
+        # Someone else holds the lease, or the job is no longer PROCESSING
+        table.update_item.side_effect = conditional_check_failed()
+        assert storage.claim_merge('user', 'video', 600) is None
+
+def test_record_and_release_merge():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        storage.record_merge('user', 'video', 1400)
+        values = table.update_item.call_args.kwargs['ExpressionAttributeValues']
+        assert (values[':merge_state'], values[':merged_frames']) == ('MERGED', 1400)
+
+        assert storage.release_merge('user', 'video')
+        assert table.update_item.call_args.kwargs['ExpressionAttributeValues'] == {':merge_expires': 0}
+
+def test_fail_job_reports_first_failure_only():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        assert storage.fail_job('user', 'video', 'boom')
+        kwargs = table.update_item.call_args.kwargs
+        assert kwargs['ConditionExpression'] == 'attribute_not_exists(#status) OR #status <> :status'
+        assert kwargs['ExpressionAttributeValues'][':status'] == 'ERROR'
+        assert kwargs['ExpressionAttributeValues'][':error'] == 'boom'
+
+        table.update_item.side_effect = conditional_check_failed()
+        assert not storage.fail_job('user', 'video', 'boom again')
+
+def test_checkpoint():
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        table.get_item.return_value = {'Item': {'status': 'PROCESSING'}}
+        assert storage.get_checkpoint('user', 'video') is None
+
+        storage.save_checkpoint('user', 'video', 4500, 2)
+        values = table.update_item.call_args.kwargs['ExpressionAttributeValues']
+        assert values[':checkpoint'] == {'next_frame': 4500, 'parts': 2}
+
+        table.get_item.return_value = {'Item': {'checkpoint': values[':checkpoint']}}
+        assert storage.get_checkpoint('user', 'video') == {'next_frame': 4500, 'parts': 2}
+        table.get_item.assert_called_with(Key={'user_id': 'user', 'video_id': 'video'})
+
+        storage.clear_checkpoint('user', 'video')
+        assert table.update_item.call_args.kwargs['UpdateExpression'] == 'REMOVE #checkpoint'
+
+def test_storage_manager_reuses_shared_clients():
+    with patch('boto3.client') as mock_client, \
+         patch('boto3.resource') as mock_resource:
+        first = StorageManager()
+        second = StorageManager()
+
+        assert first.s3 is second.s3
+        assert first.table is not None
+        assert mock_client.call_count == 3  # s3, sns, sqs
+        assert mock_resource.call_count == 1
+        assert mock_client.call_args.kwargs['config'].retries['mode'] == 'standard'
+
+def test_dynamodb_resource_per_thread():
+    from concurrent.futures import ThreadPoolExecutor
+
+    with patch('boto3.client'), patch('boto3.resource', side_effect=lambda *args, **kwargs: Mock()):
+        storage = StorageManager()
+        here = clients.get_resource('dynamodb')
+        assert clients.get_resource('dynamodb') is here
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            there = executor.submit(clients.get_resource, 'dynamodb').result()
+            # Progress writes run on another thread, with that thread's resource
+            table = executor.submit(lambda: storage.table).result()
+        assert there is not here
+        assert table is there.Table.return_value
+        assert StorageManager().s3 is storage.s3
+
+def test_storage_manager_uses_injected_clients():
+    fake_s3 = Mock()
+    clients.set_client('s3', fake_s3)
+    clients.set_client('sns', Mock())
+    clients.set_client('sqs', Mock())
+    clients.set_resource('dynamodb', Mock())
+
+    storage = StorageManager()
+    assert storage.download_video('bucket', 'key', 'local_path')
+    fake_s3.download_file.assert_called_with('bucket', 'key', 'local_path')
+
+def mp4_bytes(*boxes):
+    return b''.join(struct.pack('>I4s', 8 + len(body), name.encode()) + body for name, body in boxes)
+
+def fake_ranged_s3(data):
+    s3 = Mock()
+
+    def get_object(Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': Mock(read=Mock(return_value=data[start:end + 1]))}
+
+    s3.get_object.side_effect = get_object
+    return s3
+
+def test_is_streamable():
+    faststart = mp4_bytes(('ftyp', b'isom0000'), ('moov', b'\0' * 40), ('mdat', b'\1' * 1000))
+    index_at_end = mp4_bytes(('ftyp', b'isom0000'), ('free', b''), ('mdat', b'\1' * 1000), ('moov', b'\0' * 40))
+
+    clients.set_resource('dynamodb', Mock())
+    for data, expected in ((faststart, True), (index_at_end, False), (b'not a video', False)):
+        s3 = fake_ranged_s3(data)
+        clients.set_client('s3', s3)
+        assert StorageManager().is_streamable('bucket', 'key') is expected
+
+        # only box headers are fetched, never the media data
+        for c in s3.get_object.call_args_list:
+            start, end = map(int, c.kwargs['Range'][len('bytes='):].split('-'))
+            assert end - start + 1 == 16
+
+def test_read_video_info(tmp_path):
+    import cv2
+    import numpy as np
+
+    video_path = str(tmp_path / "sample.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 25, (320, 240))
+    for i in range(50):
+        frame = np.full((240, 320, 3), 100, dtype=np.uint8)
+        cv2.putText(frame, str(i), (10, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+    with open(video_path, 'rb') as f:
+        video = f.read()
+    # Put 2 MB in front of the index, as a long video's media data would be
+    moov = video.index(b'moov') - 4
+    data = video[:moov] + mp4_bytes(('free', b'\0' * 2 * 1024 * 1024)) + video[moov:]
+
+    clients.set_resource('dynamodb', Mock())
+    s3 = fake_ranged_s3(data)
+    s3.head_object.return_value = {'ContentLength': len(data)}
+    clients.set_client('s3', s3)
+    info = StorageManager().read_video_info('bucket', 'key')
+
+    assert info['codec'] == 'mpeg4'
+    assert info['container'] == 'mov,mp4,m4a,3gp,3g2,mj2'
+    assert (info['width'], info['height']) == (320, 240)
+    assert info['frame_count'] == 50
+    assert info['fps'] == pytest.approx(25)
+    assert info['duration'] == pytest.approx(2, abs=0.01)
+    assert info['keyframe_interval'] == 10  # keyframes at 0, 12, 24, 36 and 48
+    assert info['bitrate'] == pytest.approx(len(data) * 8 / 2, rel=0.01)
+    # A couple of blocks around the box headers, never the 2 MB in between
+    assert s3.get_object.call_count <= 3
+
+    clients.set_client('s3', fake_ranged_s3(b'not a video'))
+    assert StorageManager().read_video_info('bucket', 'key', size=11) is None
+
+def test_update_status_stores_floats_as_decimal():
+    from decimal import Decimal
+
+    with patch('boto3.client'), patch('boto3.resource') as mock_resource:
+        table = mock_resource.return_value.Table.return_value
+        storage = StorageManager()
+
+        assert storage.update_status('user', 'video', 'PROCESSING', video_info={'fps': 29.97003, 'width': 1920})
+        values = table.update_item.call_args.kwargs['ExpressionAttributeValues']
+        assert values[':video_info'] == {'fps': Decimal('29.97'), 'width': 1920}
+
+def test_progress_reporter_coalesces_updates():
+    writes = []
+    reporter = ProgressReporter(lambda done, total, percent: writes.append(percent), min_interval=0, min_percent=10)
+
+    for done in range(1, 1001):
+        reporter(done, 1000)
+    reporter.close()
+
+    # at least 10 points apart (updates are skipped while a write is in flight),
+    # and never 100: the total is only an estimate
+    assert writes and writes[0] == 10
+    assert all(b - a >= 10 for a, b in zip(writes, writes[1:]))
+    assert writes[-1] < 100
+
+def test_progress_reporter_waits_for_interval():
+    writes = []
+    reporter = ProgressReporter(lambda *args: writes.append(args), min_interval=3600)
+
+    for done in range(100):
+        reporter(done, 100)
+    reporter.close()
+
+    assert writes == []
+
+def test_progress_reporter_skips_while_write_in_flight():
+    import threading
+
+    release = threading.Event()
+    writes = []
+    def slow_write(done, total, percent):
+        release.wait(5)
+        writes.append(percent)
+
+    reporter = ProgressReporter(slow_write, min_interval=0, min_percent=1)
+    for done in range(1, 101):
+        reporter(done, 100)
+    release.set()
+    reporter.close()
+
+    assert writes == [1]
+
+def test_chunk_progress_adds_deltas():
+    dynamodb = Mock()
+    table = dynamodb.Table.return_value
+    clients.set_resource('dynamodb', dynamodb)
+
+    reporter = StorageManager().progress_reporter('user', 'video', 2)
+    reporter.min_interval = 0
+    reporter.min_percent = 50
+    for done in range(1, 101):
+        reporter(done, 100)
+    reporter.close()
+
+    values = [c.kwargs['ExpressionAttributeValues'] for c in table.update_item.call_args_list]
+    assert [(v[':previous'], v[':done'], v[':delta']) for v in values] == [(0, 50, 50), (50, 100, 50)]
+    assert table.update_item.call_args.kwargs['ExpressionAttributeNames']['#chunk'] == '2'
+
+def test_redelivered_chunk_progress_is_not_counted_twice():
+    from botocore.exceptions import ClientError
+
+    dynamodb = Mock()
+    table = dynamodb.Table.return_value
+    clients.set_resource('dynamodb', dynamodb)
+    # An earlier attempt of this chunk got to 60 frames
+    stored = {'count': 60}
+
+    def update_item(**kwargs):
+        values = kwargs['ExpressionAttributeValues']
+        if values[':previous'] != stored['count']:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        stored['count'] = values[':done']
+
+    table.update_item.side_effect = update_item
+    table.get_item.side_effect = lambda **kwargs: {'Item': {'chunk_frames': {'2': stored['count']}}}
+
+    reporter = StorageManager().progress_reporter('user', 'video', 2)
+    reporter.min_interval = 0
+    reporter.min_percent = 25
+    for done in range(1, 101):
+        reporter(done, 100)
+    reporter.close()
+
+    added = [c.kwargs['ExpressionAttributeValues'][':delta'] for c in table.update_item.call_args_list]
+    applied = sum(added[1:])  # the first write was rejected
+    assert 60 + applied == 100
+    assert stored['count'] == 100
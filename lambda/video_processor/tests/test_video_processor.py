@@ -1,9 +1,11 @@
 import pytest
 import os
 import json
+import zipfile
+from unittest import mock
 from unittest.mock import Mock, patch, MagicMock
 from src.main import handler
-from src.utils.video import extract_frames, create_zip
+from src.utils.video import extract_frames, extract_frames_to_zip, create_zip, FRAME_STRATEGIES, _map_ordered, _plan_segments, merge_zips, plan_chunks
 
 @pytest.fixture
 def mock_event():
@@ -24,17 +26,17 @@ def mock_context():
 @pytest.fixture
 def mock_storage():
     with patch('src.main.StorageManager') as mock:
-        storage_instance = Mock()
+        storage_instance = MagicMock()
+        storage_instance.get_checkpoint.return_value = None
+        storage_instance.read_video_info.return_value = None
         mock.return_value = storage_instance
         yield storage_instance
 
 @pytest.fixture
 def mock_video_utils():
-    with patch('src.main.extract_frames') as mock_extract, \
-         patch('src.main.create_zip') as mock_zip:
+    with patch('src.main.extract_frames_to_zip') as mock_extract:
         mock_extract.return_value = (True, 10)
-        mock_zip.return_value = True
-        yield (mock_extract, mock_zip)
+        yield mock_extract
 
 def test_extract_frames(tmp_path):
     # Create a small test video file
@@ -45,11 +47,81 @@ def test_extract_frames(tmp_path):
     with patch('cv2.VideoCapture') as mock_cap:
         mock_cap.return_value.isOpened.return_value = True
         mock_cap.return_value.read.side_effect = [(True, Mock()), (True, Mock()), (False, None)]
-        
-        success, count = extract_frames(video_path, frames_dir, frame_interval=1)
-        
+
+        # Frames are encoded in memory before being written out
+        with patch('cv2.imencode', return_value=(True, Mock(tobytes=Mock(return_value=b'jpeg')))):
+            success, count = extract_frames(video_path, frames_dir, frame_interval=1)
+
         assert success
         assert count == 2
+        assert sorted(os.listdir(frames_dir)) == ['frame_0000.jpg', 'frame_0001.jpg']
+
+@pytest.mark.parametrize('strategy', FRAME_STRATEGIES)
+def test_extract_frames_strategies_match_read(sample_video, tmp_path, strategy):
+    expected_dir = tmp_path / "expected"
+    frames_dir = tmp_path / strategy
+
+    assert extract_frames(sample_video, str(expected_dir), frame_interval=30, strategy='read') == (True, 4)
+    assert extract_frames(sample_video, str(frames_dir), frame_interval=30, strategy=strategy,
+                          keyframe_interval=12 if strategy == 'auto' else None) == (True, 4)
+
+    for name in sorted(os.listdir(expected_dir)):
+        assert (frames_dir / name).read_bytes() == (expected_dir / name).read_bytes()
+
+@pytest.fixture
+def long_gop_video(tmp_path):
+    """H.264 (avc1) with 120-frame GOPs and B-frames, as phones and cameras write it"""
+    av = pytest.importorskip('av')
+    import cv2
+    import numpy as np
+
+    video_path = str(tmp_path / "long_gop.mp4")
+    with av.open(video_path, 'w') as container:
+        try:
+            stream = container.add_stream('libx264', rate=30)
+        except Exception:
+            pytest.skip('libx264 is not available')
+        stream.width, stream.height, stream.pix_fmt = 160, 120, 'yuv420p'
+        stream.options = {'g': '120', 'bf': '3', 'sc_threshold': '0'}
+        for i in range(300):
+            image = np.full((120, 160, 3), (i * 7) % 256, dtype=np.uint8)
+            cv2.putText(image, str(i), (10, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+            container.mux(stream.encode(av.VideoFrame.from_ndarray(image, format='bgr24')))
+        container.mux(stream.encode())
+    return video_path
+
+@pytest.mark.parametrize('strategy', FRAME_STRATEGIES)
+def test_extract_frames_strategies_match_read_long_gop(long_gop_video, tmp_path, strategy):
+    expected_dir = tmp_path / "expected"
+    frames_dir = tmp_path / strategy
+
+    assert extract_frames(long_gop_video, str(expected_dir), frame_interval=30, strategy='read',
+                          decoder='opencv') == (True, 10)
+    assert extract_frames(long_gop_video, str(frames_dir), frame_interval=30, strategy=strategy,
+                          keyframe_interval=120 if strategy == 'auto' else None, decoder='opencv') == (True, 10)
+
+    for name in sorted(os.listdir(expected_dir)):
+        assert (frames_dir / name).read_bytes() == (expected_dir / name).read_bytes()
+
+def test_extract_frames_seek_skips_decoding(tmp_path):
+    with patch('cv2.VideoCapture') as mock_cap:
+        cap = mock_cap.return_value
+        cap.isOpened.return_value = True
+        cap.read.side_effect = [(True, Mock()), (True, Mock()), (False, None)]
+
+        with patch('cv2.imencode', return_value=(True, Mock(tobytes=Mock(return_value=b'jpeg')))):
+            success, count = extract_frames('video.mp4', str(tmp_path / "frames"), frame_interval=30, strategy='seek')
+
+        assert success
+        assert count == 2
+        cap.grab.assert_not_called()
+        assert [c.args[1] for c in cap.set.call_args_list] == [30, 60]
+
+def test_extract_frames_unknown_strategy(tmp_path):
+    success, count = extract_frames('video.mp4', str(tmp_path / "frames"), strategy='fast')
+
+    assert not success
+    assert count == 0
 
 def test_create_zip(tmp_path):
     # Create test files
@@ -63,9 +135,291 @@ def test_create_zip(tmp_path):
     assert create_zip(str(source_dir), zip_path)
     assert os.path.exists(zip_path)
 
+def test_extract_frames_to_zip_matches_disk_path(sample_video, tmp_path):
+    frames_dir = str(tmp_path / "frames")
+    disk_zip = str(tmp_path / "disk.zip")
+    stream_zip = str(tmp_path / "stream.zip")
+
+    assert extract_frames(sample_video, frames_dir, frame_interval=30) == (True, 4)
+    assert create_zip(frames_dir, disk_zip)
+    assert extract_frames_to_zip(sample_video, stream_zip, frame_interval=30) == (True, 4)
+
+    with zipfile.ZipFile(disk_zip) as expected, zipfile.ZipFile(stream_zip) as actual:
+        assert sorted(actual.namelist()) == sorted(expected.namelist())
+        for name in expected.namelist():
+            assert actual.read(name) == expected.read(name)
+
+def test_map_ordered_keeps_input_order():
+    import random
+    import time
+
+    def slow_square(x):
+        time.sleep(random.random() / 100)
+        return x * x
+
+    assert list(_map_ordered(slow_square, range(20), workers=4, max_pending=3)) == [x * x for x in range(20)]
+
+def test_extract_frames_encoder_pool_matches_single_thread(sample_video, tmp_path):
+    single_dir = tmp_path / "single"
+    pool_dir = tmp_path / "pool"
+
+    assert extract_frames(sample_video, str(single_dir), frame_interval=5, encode_workers=1) == (True, 19)
+    assert extract_frames(sample_video, str(pool_dir), frame_interval=5, encode_workers=4) == (True, 19)
+
+    assert sorted(os.listdir(pool_dir)) == [f"frame_{i:04d}.jpg" for i in range(19)]
+    for name in os.listdir(single_dir):
+        assert (pool_dir / name).read_bytes() == (single_dir / name).read_bytes()
+
+def test_plan_segments():
+    assert _plan_segments(500, 30, workers=4, min_segment_frames=900) == [(0, None)]
+    assert _plan_segments(3600, 30, workers=4, min_segment_frames=900) == [
+        (0, 900), (900, 1800), (1800, 2700), (2700, None)
+    ]
+    # boundaries stay on sampled frames when the count does not divide evenly
+    assert _plan_segments(2000, 30, workers=2, min_segment_frames=900) == [(0, 1020), (1020, None)]
+
+def test_extract_frames_parallel_decode_matches_single_pass(sample_video, tmp_path):
+    single_zip = str(tmp_path / "single.zip")
+    parallel_zip = str(tmp_path / "parallel.zip")
+
+    assert extract_frames_to_zip(sample_video, single_zip, frame_interval=7, decode_workers=1) == (True, 14)
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20):
+        assert extract_frames_to_zip(sample_video, parallel_zip, frame_interval=7, decode_workers=3) == (True, 14)
+
+    with zipfile.ZipFile(single_zip) as expected, zipfile.ZipFile(parallel_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+        for name in expected.namelist():
+            assert actual.read(name) == expected.read(name)
+
+def test_parallel_decode_bounds_buffered_frames(sample_video, tmp_path):
+    from collections import deque
+
+    sizes = []
+
+    class TrackingDeque(deque):
+        def append(self, item):
+            super().append(item)
+            sizes.append(len(self))
+
+    single_zip = str(tmp_path / "single.zip")
+    parallel_zip = str(tmp_path / "parallel.zip")
+    assert extract_frames_to_zip(sample_video, single_zip, frame_interval=1, decode_workers=1) == (True, 95)
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20), patch('src.utils.video.MAX_BUFFERED_FRAMES', 2), \
+            patch('src.utils.video.deque', TrackingDeque):
+        assert extract_frames_to_zip(sample_video, parallel_zip, frame_interval=1, decode_workers=3) == (True, 95)
+
+    # Segments ahead of the one being streamed hold at most MAX_BUFFERED_FRAMES frames
+    assert sizes and max(sizes) <= 2
+    with zipfile.ZipFile(single_zip) as expected, zipfile.ZipFile(parallel_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+        for name in expected.namelist():
+            assert actual.read(name) == expected.read(name)
+
+def test_plan_chunks():
+    assert plan_chunks(100, 30, 18000) == [(0, None)]
+    assert plan_chunks(40000, 30, 18000) == [(0, 18000), (18000, 36000), (36000, None)]
+    assert plan_chunks(40000, 7, 18000) == [(0, 17997), (17997, 35994), (35994, None)]
+
+def test_chunked_extraction_merges_to_single_pass(sample_video, tmp_path):
+    single_zip = str(tmp_path / "single.zip")
+    chunk_zips = []
+
+    assert extract_frames_to_zip(sample_video, single_zip, frame_interval=7) == (True, 14)
+    for i, (start, end) in enumerate(plan_chunks(95, 7, 40)):
+        chunk_zips.append(str(tmp_path / f"chunk_{i}.zip"))
+        success, _ = extract_frames_to_zip(sample_video, chunk_zips[-1], frame_interval=7, start=start, end=end)
+        assert success
+
+    merged_zip = str(tmp_path / "merged.zip")
+    assert merge_zips(chunk_zips, merged_zip) == (True, 14)
+    with zipfile.ZipFile(single_zip) as expected, zipfile.ZipFile(merged_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+        for name in expected.namelist():
+            assert actual.read(name) == expected.read(name)
+
+def test_handler_fan_out(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('CHUNK_QUEUE_URL', 'https://sqs/chunks')
+    with patch('src.main.probe_video', return_value={'frame_count': 40000}):
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['chunk_count'] == 3
+    queue_url, messages = mock_storage.enqueue_messages.call_args.args
+    assert queue_url == 'https://sqs/chunks'
+    assert [m['chunk'] for m in messages] == [
+        {'index': 0, 'start': 0, 'end': 18000, 'total': 3},
+        {'index': 1, 'start': 18000, 'end': 36000, 'total': 3},
+        {'index': 2, 'start': 36000, 'end': None, 'total': 3}
+    ]
+    mock_storage.download_video.assert_not_called()
+
+VIDEO_INFO = {'container': 'mov,mp4,m4a,3gp,3g2,mj2', 'codec': 'hevc', 'width': 1920, 'height': 1080,
+              'frame_count': 40000, 'fps': 30.0, 'duration': 1333.3, 'keyframe_interval': 60, 'size': 10 ** 9}
+
+def test_handler_fan_out_uses_probe(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('CHUNK_QUEUE_URL', 'https://sqs/chunks')
+    mock_storage.read_video_info.return_value = VIDEO_INFO
+    with patch('src.main.probe_video') as probe_video:
+        response = handler(mock_event, mock_context)
+
+    assert json.loads(response['body'])['chunk_count'] == 3
+    probe_video.assert_not_called()
+    mock_storage.update_status.assert_any_call('test-user', 'test-video-123', 'PROCESSING', video_info=VIDEO_INFO)
+    # Chunk workers get the probe with their message
+    _, messages = mock_storage.enqueue_messages.call_args.args
+    assert all(m['video_info'] == VIDEO_INFO for m in messages)
+
+def test_handler_uses_probe_for_extraction(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('DECODER_BACKEND', 'auto')
+    mock_storage.read_video_info.return_value = VIDEO_INFO
+    mock_storage.download_video.return_value = True
+    mock_video_utils.return_value = (True, 5)
+
+    with patch('src.main.select_backend', return_value='pyav') as select_backend:
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    select_backend.assert_called_once_with('hevc', 'mov,mp4,m4a,3gp,3g2,mj2', keyframes_only=False)
+    kwargs = mock_video_utils.call_args.kwargs
+    assert (kwargs['decoder'], kwargs['keyframe_interval']) == ('pyav', 60)
+
+@pytest.mark.parametrize('limits, error', [
+    ({'MAX_VIDEO_DURATION_SECONDS': '600'}, 'Video is 1333s long; the limit is 600s'),
+    ({'MAX_VIDEO_PIXELS': str(1280 * 720)}, 'Video resolution 1920x1080 exceeds the limit of 921600 pixels'),
+])
+def test_handler_rejects_oversized_video(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch,
+                                         limits, error):
+    for name, value in limits.items():
+        monkeypatch.setenv(name, value)
+    mock_storage.read_video_info.return_value = VIDEO_INFO
+    mock_event['Records'][0]['messageId'] = 'm1'
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == error
+    # Rejections are final: the message is not redelivered
+    assert response['batchItemFailures'] == []
+    mock_storage.download_video.assert_not_called()
+    mock_video_utils.assert_not_called()
+    mock_storage.update_status.assert_called_once_with('test-user', 'test-video-123', 'ERROR', error=error)
+    mock_storage.notify_completion.assert_called_once_with('test-user', 'test-video-123', 'ERROR', error=error)
+
+def chunk_event(index, total):
+    return {
+        'Records': [{
+            'body': json.dumps({
+                'user_id': 'test-user',
+                'video_id': 'test-video-123',
+                'video_key': 'inputs/test-user/test-video-123/video.mp4',
+                'chunk': {'index': index, 'start': index * 18000, 'end': None, 'total': total}
+            })
+        }]
+    }
+
+def test_handler_chunk_worker(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.download_video.return_value = True
+    mock_storage.complete_chunk.return_value = False
+
+    response = handler(chunk_event(1, 3), mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['chunk_index'] == 1
+    mock_storage.open_zip_upload.assert_called_once_with('out', 'outputs/test-user/test-video-123/chunks/0001.zip')
+    assert mock_video_utils.call_args.kwargs == {
+        'sampling': {'mode': 'interval', 'frame_interval': 30}, 'output': {'format': 'jpeg'},
+        'start': 18000, 'end': None, 'stats': {}, 'progress': mock_storage.progress_reporter.return_value,
+        'stop': None, 'decoder': 'auto', 'keyframe_interval': None
+    }
+    mock_storage.progress_reporter.assert_called_once_with('test-user', 'test-video-123', 1)
+    mock_storage.progress_reporter.return_value.close.assert_called_once()
+    mock_storage.complete_chunk.assert_called_once_with('test-user', 'test-video-123', 1, 3)
+    mock_storage.notify_completion.assert_not_called()
+
+def test_handler_last_chunk_merges(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.complete_chunk.return_value = True
+    mock_storage.claim_merge.return_value = {'status': 'PROCESSING'}
+    mock_context.get_remaining_time_in_millis.return_value = 600000
+
+    with patch('src.main.merge_zips', return_value=(True, 1400)):
+        response = handler(chunk_event(2, 3), mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['frame_count'] == 1400
+    mock_storage.claim_merge.assert_called_once_with('test-user', 'test-video-123', 600.0)
+    # frames.zip is recorded as complete before the chunks go away
+    mock_storage.record_merge.assert_called_once_with('test-user', 'test-video-123', 1400)
+    mock_storage.delete_objects.assert_called_once_with('out', [
+        f'outputs/test-user/test-video-123/chunks/{i:04d}.zip' for i in range(3)
+    ])
+    mock_storage.update_status.assert_called_with('test-user', 'test-video-123', 'COMPLETED',
+                                                output_url='s3://out/outputs/test-user/test-video-123/frames.zip')
+
+def test_handler_chunk_waits_for_merge_claim(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.complete_chunk.return_value = True
+    # Another invocation is merging
+    mock_storage.claim_merge.return_value = None
+
+    with patch('src.main.merge_zips') as mock_merge:
+        response = handler(chunk_event(2, 3), mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['message'] == 'Chunk processed successfully'
+    mock_merge.assert_not_called()
+    mock_storage.notify_completion.assert_not_called()
+
+def test_handler_redelivered_chunk_finishes_recorded_merge(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.complete_chunk.return_value = True
+    # The merging invocation timed out after frames.zip was complete
+    mock_storage.claim_merge.return_value = {'status': 'PROCESSING', 'merge_state': 'MERGED', 'merged_frames': 1400}
+
+    with patch('src.main.merge_zips') as mock_merge:
+        response = handler(chunk_event(2, 3), mock_context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['frame_count'] == 1400
+    mock_merge.assert_not_called()
+    mock_storage.delete_objects.assert_called_once()
+    mock_storage.notify_completion.assert_called_once_with('test-user', 'test-video-123', 'COMPLETED',
+                                                           output_url=mock.ANY)
+
+def test_handler_merge_failure_is_retried(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.complete_chunk.return_value = True
+    mock_storage.claim_merge.return_value = {'status': 'PROCESSING'}
+    event = chunk_event(2, 3)
+    event['Records'][0]['messageId'] = 'm1'
+
+    with patch('src.main.merge_zips', return_value=(False, 0)):
+        response = handler(event, mock_context)
+
+    assert response['statusCode'] == 500
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+    # The job stays PROCESSING and the claim is released for the redelivery
+    mock_storage.release_merge.assert_called_once_with('test-user', 'test-video-123')
+    mock_storage.fail_job.assert_not_called()
+    mock_storage.notify_completion.assert_not_called()
+    mock_storage.delete_objects.assert_not_called()
+
+def test_handler_chunk_reads_ranges(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    mock_storage.complete_chunk.return_value = False
+    mock_storage.get_video_url.return_value = 'https://bucket.s3/video.mp4?signature'
+
+    with patch('src.main.probe_video', return_value={'frame_count': 54000}):
+        response = handler(chunk_event(1, 3), mock_context)
+
+    assert response['statusCode'] == 200
+    assert mock_video_utils.call_args.args[0] == 'https://bucket.s3/video.mp4?signature'
+    # Chunks do not download the whole video, whether or not it is faststart
+    mock_storage.is_streamable.assert_not_called()
+    mock_storage.download_video.assert_not_called()
+
 def test_handler_success(mock_event, mock_context, mock_storage, mock_video_utils):
     mock_storage.download_video.return_value = True
-    mock_storage.upload_zip.return_value = True
     mock_storage.update_status.return_value = True
     mock_storage.notify_completion.return_value = True
     
@@ -76,12 +430,536 @@ def test_handler_success(mock_event, mock_context, mock_storage, mock_video_util
     mock_storage.update_status.assert_called_with('test-user', 'test-video-123', 'COMPLETED', 
                                                 output_url=mock.ANY)
 
+def test_handler_extract_failure_aborts_upload(mock_event, mock_context, mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+    mock_video_utils.return_value = (False, 0)
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 500
+    upload = mock_storage.open_zip_upload.return_value
+    assert upload.__exit__.call_args.args[0] is Exception
+
 def test_handler_download_failure(mock_event, mock_context, mock_storage):
     mock_storage.download_video.return_value = False
     
     response = handler(mock_event, mock_context)
     
     assert response['statusCode'] == 500
-    mock_storage.update_status.assert_called_with('test-user', 'test-video-123', 'ERROR', 
-                                                error=mock.ANY)
+    mock_storage.fail_job.assert_called_once_with('test-user', 'test-video-123', mock.ANY)
+    mock_storage.notify_completion.assert_called_once_with('test-user', 'test-video-123', 'ERROR', error=mock.ANY)
+
+def test_handler_failed_chunk_notifies_once(mock_context, mock_storage, monkeypatch):
+    # A sibling chunk already failed the job
+    mock_storage.download_video.return_value = False
+    mock_storage.fail_job.return_value = False
+
+    response = handler(chunk_event(1, 3), mock_context)
+
+    assert response['statusCode'] == 500
+    mock_storage.fail_job.assert_called_once_with('test-user', 'test-video-123', mock.ANY)
+    mock_storage.notify_completion.assert_not_called()
+
+
+def test_handler_batch_reports_failed_messages(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('RECORD_CONCURRENCY', '2')
+    event = {
+        'Records': [
+            {
+                'messageId': f'message-{i}',
+                'body': json.dumps({
+                    'user_id': 'test-user',
+                    'video_id': f'video-{i}',
+                    'video_key': f'inputs/test-user/video-{i}/video.mp4'
+                })
+            }
+            for i in range(3)
+        ]
+    }
+    mock_storage.download_video.side_effect = lambda bucket, key, path: 'video-1' not in key
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 500
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    results = json.loads(response['body'])['results']
+    assert [r['message'] for r in results] == [
+        'Processing completed successfully', 'Error processing video', 'Processing completed successfully'
+    ]
+    assert mock_video_utils.call_count == 2
+
+def test_handler_streams_faststart_video(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('INPUT_MODE', 'stream')
+    mock_storage.is_streamable.return_value = True
+    mock_storage.get_video_url.return_value = 'https://bucket.s3/video.mp4?signature'
+
+    with patch('src.main.probe_video', return_value={'frame_count': 300}):
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert mock_video_utils.call_args.args[0] == 'https://bucket.s3/video.mp4?signature'
+    mock_storage.download_video.assert_not_called()
+
+def test_handler_stream_falls_back_to_download(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('INPUT_MODE', 'stream')
+    mock_storage.is_streamable.return_value = False
+    mock_storage.download_video.return_value = True
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    assert mock_video_utils.call_args.args[0].endswith('video.mp4')
+    mock_storage.get_video_url.assert_not_called()
+
+def test_handler_result_cache_hit(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.head_object.return_value = {'ETag': '"abc"', 'ContentLength': 1234}
+    mock_storage.copy_object.return_value = True
+
+    with patch('src.main.ResultCache') as mock_cache:
+        cache = mock_cache.return_value
+        cache.enabled = True
+        cache.content_key.return_value = 'content-key'
+        cache.lookup.return_value = {'bucket': 'out', 'key': 'outputs/other/video/frames.zip', 'frame_count': 42}
+
+        response = handler(mock_event, mock_context)
+
+    body = json.loads(response['body'])
+    assert response['statusCode'] == 200
+    assert body['cached'] is True
+    assert body['frame_count'] == 42
+    mock_storage.copy_object.assert_called_once_with('out', 'outputs/other/video/frames.zip',
+                                                     'out', 'outputs/test-user/test-video-123/frames.zip')
+    mock_storage.download_video.assert_not_called()
+    mock_video_utils.assert_not_called()
+
+def test_handler_result_cache_miss_stores_result(mock_event, mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.download_video.return_value = True
+    mock_storage.head_object.return_value = {'ETag': '"abc"', 'ContentLength': 1234}
+
+    with patch('src.main.ResultCache') as mock_cache:
+        cache = mock_cache.return_value
+        cache.enabled = True
+        cache.content_key.return_value = 'content-key'
+        cache.lookup.return_value = None
+
+        response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    cache.store.assert_called_once_with('content-key', 'out', 'outputs/test-user/test-video-123/frames.zip', 10)
+
+def test_extract_frames_fps_sampling(sample_video, tmp_path):
+    frames_dir = tmp_path / "frames"
+    single_zip = str(tmp_path / "single.zip")
+    sampling = {'mode': 'fps', 'fps': 2}
+
+    # 95 frames at 30 fps, sampled twice per second: frames 0, 15, ..., 90
+    assert extract_frames(sample_video, str(frames_dir), sampling=sampling, strategy='read') == (True, 7)
+    assert extract_frames_to_zip(sample_video, single_zip, sampling=sampling) == (True, 7)
+    with zipfile.ZipFile(single_zip) as zipf:
+        for name in sorted(os.listdir(frames_dir)):
+            assert zipf.read(name) == (frames_dir / name).read_bytes()
+
+    chunk_zips = []
+    for i, (start, end) in enumerate(plan_chunks(95, 1, 40)):
+        chunk_zips.append(str(tmp_path / f"chunk_{i}.zip"))
+        assert extract_frames_to_zip(sample_video, chunk_zips[-1], sampling=sampling, start=start, end=end)[0]
+    merged_zip = str(tmp_path / "merged.zip")
+    assert merge_zips(chunk_zips, merged_zip) == (True, 7)
+    with zipfile.ZipFile(single_zip) as expected, zipfile.ZipFile(merged_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+
+def test_extract_frames_scene_sampling(tmp_path):
+    import cv2
+    import numpy as np
+
+    video_path = str(tmp_path / "scenes.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 30, (160, 120))
+    for shade in (30, 220, 120):
+        for i in range(30):
+            frame = np.full((120, 160, 3), shade, dtype=np.uint8)
+            frame[:, i:i + 2] = 0  # slow motion within the scene is not a cut
+            writer.write(frame)
+    writer.release()
+
+    success, count = extract_frames_to_zip(video_path, str(tmp_path / "frames.zip"),
+                                           sampling={'mode': 'scene', 'threshold': 0.2})
+
+    assert (success, count) == (True, 3)
+
+def test_handler_scene_sampling_is_not_split(mock_context, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('CHUNK_QUEUE_URL', 'https://sqs/chunks')
+    mock_storage.download_video.return_value = True
+    sampling = {'mode': 'scene', 'threshold': 0.2}
+    event = {'Records': [{'body': json.dumps({
+        'user_id': 'test-user', 'video_id': 'test-video-123',
+        'video_key': 'inputs/test-user/test-video-123/video.mp4', 'sampling': sampling
+    })}]}
+
+    with patch('src.main.probe_video', return_value={'frame_count': 40000}):
+        response = handler(event, mock_context)
+
+    assert response['statusCode'] == 200
+    mock_storage.enqueue_messages.assert_not_called()
+    assert mock_video_utils.call_args.kwargs['sampling'] == sampling
+
+def test_handler_unknown_sampling_mode(mock_context, mock_storage, mock_video_utils):
+    event = {'Records': [{'body': json.dumps({
+        'user_id': 'test-user', 'video_id': 'test-video-123',
+        'video_key': 'inputs/test-user/test-video-123/video.mp4', 'sampling': {'mode': 'random'}
+    })}]}
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 400
+    mock_storage.download_video.assert_not_called()
+    mock_storage.fail_job.assert_not_called()
+    mock_storage.update_status.assert_called_once_with('test-user', 'test-video-123', 'ERROR',
+                                                       error='Unknown sampling mode: random')
+
+def test_handler_invalid_sampling_option_is_rejected(mock_context, mock_storage, mock_video_utils):
+    event = {'Records': [{'body': json.dumps({
+        'user_id': 'test-user', 'video_id': 'test-video-123',
+        'video_key': 'inputs/test-user/test-video-123/video.mp4', 'sampling': {'mode': 'fps', 'fps': 0}
+    })}]}
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 400
+    mock_storage.download_video.assert_not_called()
+    mock_storage.fail_job.assert_not_called()
+    mock_storage.update_status.assert_called_once_with('test-user', 'test-video-123', 'ERROR',
+                                                       error='Invalid sampling option fps: 0')
+
+def test_extract_frames_dedup_drops_near_duplicates(tmp_path):
+    import cv2
+    import numpy as np
+
+    # A static slide with a blinking cursor, then a different slide
+    video_path = str(tmp_path / "slides.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 30, (160, 120))
+    ramp = np.tile(np.linspace(0, 200, 160, dtype=np.uint8), (120, 1))
+    for i in range(120):
+        frame = cv2.cvtColor(ramp if i < 90 else ramp[:, ::-1].copy(), cv2.COLOR_GRAY2BGR)
+        if i % 20 < 10:
+            frame[100:110, 20:22] = 255
+        writer.write(frame)
+    writer.release()
+
+    stats = {}
+    success, count = extract_frames(video_path, str(tmp_path / "frames"), stats=stats,
+                                    sampling={'mode': 'interval', 'frame_interval': 10, 'dedup': True})
+
+    assert (success, count) == (True, 2)
+    assert stats == {'frames_dropped': 10}
+    assert sorted(os.listdir(tmp_path / "frames")) == ['frame_0000.jpg', 'frame_0001.jpg']
+
+def test_handler_reports_dropped_frames(mock_event, mock_context, mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+
+    def extract(*args, stats=None, **kwargs):
+        stats['frames_dropped'] = 7
+        return True, 3
+    mock_video_utils.side_effect = extract
+
+    response = handler(mock_event, mock_context)
+
+    body = json.loads(response['body'])
+    assert (body['frame_count'], body['frames_dropped']) == (3, 7)
+
+def test_extract_frames_to_zip_output_options(sample_video, tmp_path):
+    import cv2
+    import numpy as np
+
+    output = {'format': 'webp', 'quality': 70, 'max_width': 80, 'grayscale': True}
+    single_zip = str(tmp_path / "single.zip")
+    parallel_zip = str(tmp_path / "parallel.zip")
+
+    assert extract_frames_to_zip(sample_video, single_zip, frame_interval=30, output=output) == (True, 4)
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20):
+        assert extract_frames_to_zip(sample_video, parallel_zip, frame_interval=30, output=output,
+                                     decode_workers=2) == (True, 4)
+
+    with zipfile.ZipFile(single_zip) as expected, zipfile.ZipFile(parallel_zip) as actual:
+        assert expected.namelist() == [f"frame_{i:04d}.webp" for i in range(4)]
+        assert actual.namelist() == expected.namelist()
+        for info in expected.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED
+            image = cv2.imdecode(np.frombuffer(expected.read(info), np.uint8), cv2.IMREAD_UNCHANGED)
+            assert image.shape[:2] == (60, 80)
+            assert actual.read(info.filename) == expected.read(info.filename)
+
+@pytest.mark.parametrize('output', [{'format': 'gif'}, {'quality': 'high'}, {'max_width': '1280'}])
+def test_handler_invalid_output_is_rejected(mock_context, mock_storage, mock_video_utils, output):
+    event = {'Records': [{'body': json.dumps({
+        'user_id': 'test-user', 'video_id': 'test-video-123',
+        'video_key': 'inputs/test-user/test-video-123/video.mp4', 'output': output
+    })}]}
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 400
+    assert response['batchItemFailures'] == []
+    mock_storage.download_video.assert_not_called()
+    mock_storage.get_checkpoint.assert_not_called()
+    mock_storage.fail_job.assert_not_called()
+    assert mock_storage.update_status.call_args.args[2] == 'ERROR'
+    mock_storage.notify_completion.assert_called_once()
+
+def test_handler_passes_decoder(mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('DECODER_BACKEND', 'opencv')
+    mock_storage.download_video.return_value = True
+    mock_video_utils.return_value = (True, 5)
+    message = {'user_id': 'test-user', 'video_id': 'test-video-123',
+               'video_key': 'inputs/test-user/test-video-123/video.mp4'}
+
+    handler({'Records': [{'body': json.dumps(message)}]}, Mock())
+    assert mock_video_utils.call_args.kwargs['decoder'] == 'opencv'
+
+    handler({'Records': [{'body': json.dumps({**message, 'decoder': 'pyav'})}]}, Mock())
+    assert mock_video_utils.call_args.kwargs['decoder'] == 'pyav'
+
+def test_handler_unknown_decoder(mock_context, mock_storage, mock_video_utils):
+    event = {'Records': [{'body': json.dumps({
+        'user_id': 'test-user', 'video_id': 'test-video-123',
+        'video_key': 'inputs/test-user/test-video-123/video.mp4', 'decoder': 'gstreamer'
+    })}]}
+
+    response = handler(event, mock_context)
+
+    assert response['statusCode'] == 400
+    mock_storage.download_video.assert_not_called()
+    mock_storage.fail_job.assert_not_called()
+
+def test_extract_frames_records_metrics(sample_video, tmp_path):
+    from utils.metrics import Metrics, recording
+
+    with recording(Metrics()) as metrics:
+        assert extract_frames_to_zip(sample_video, str(tmp_path / "frames.zip"), frame_interval=30,
+                                     encode_workers=2) == (True, 4)
+
+    values = metrics.as_dict()
+    assert {'decode', 'encode', 'zip_write'} <= set(values['stages_ms'])
+    assert values['counters']['frames_decoded'] == 4
+    assert values['counters']['frames_saved'] == 4
+    assert values['counters']['encoded_bytes'] > 0
+
+def test_handler_reports_metrics(mock_event, mock_context, mock_storage, mock_video_utils, capsys):
+    mock_storage.download_video.return_value = True
+
+    response = handler(mock_event, mock_context)
+
+    metrics = json.loads(response['body'])['metrics']
+    assert {'total', 'input', 'extract'} <= set(metrics['stages_ms'])
+    record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert record['video_id'] == 'test-video-123'
+    assert record['status_code'] == 200
+    assert 'total_ms' in record
+
+def test_extract_frames_reports_progress(sample_video, tmp_path):
+    single, parallel = [], []
+
+    assert extract_frames_to_zip(sample_video, str(tmp_path / "single.zip"), frame_interval=7,
+                                 progress=lambda done, total: single.append((done, total)))[0]
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20):
+        assert extract_frames_to_zip(sample_video, str(tmp_path / "parallel.zip"), frame_interval=7,
+                                     decode_workers=3,
+                                     progress=lambda done, total: parallel.append((done, total)))[0]
+
+    assert single == [(i * 7 + 1, 95) for i in range(14)]
+    assert parallel == single
+
+def test_extract_frames_reports_progress_of_range(sample_video, tmp_path):
+    calls = []
+
+    extract_frames_to_zip(sample_video, str(tmp_path / "chunk.zip"), frame_interval=7, start=35, end=70,
+                          progress=lambda done, total: calls.append((done, total)))
+
+    assert calls == [(1, 35), (8, 35), (15, 35), (22, 35), (29, 35)]
+
+def test_handler_closes_progress_before_completing(mock_event, mock_context, mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+    reporter = mock_storage.progress_reporter.return_value
+    reporter.close.side_effect = lambda: mock_storage.update_status.assert_called_once()
+
+    response = handler(mock_event, mock_context)
+
+    assert response['statusCode'] == 200
+    mock_storage.progress_reporter.assert_called_once_with('test-user', 'test-video-123', None)
+    assert mock_video_utils.call_args.kwargs['progress'] is reporter
+    reporter.close.assert_called_once()
+
+def stop_after(frames):
+    calls = []
+    return lambda: calls.append(None) or len(calls) > frames
+
+@pytest.mark.parametrize('decode_workers', [1, 3])
+def test_extract_frames_stop_and_resume_match_single_pass(sample_video, tmp_path, decode_workers):
+    full_zip = str(tmp_path / "full.zip")
+    assert extract_frames_to_zip(sample_video, full_zip, frame_interval=7, decode_workers=1) == (True, 14)
+
+    parts = []
+    start = 0
+    with patch('src.utils.video.MIN_SEGMENT_FRAMES', 20):
+        while True:
+            part_zip = str(tmp_path / f"part{len(parts)}.zip")
+            stats = {}
+            assert extract_frames_to_zip(sample_video, part_zip, frame_interval=7, decode_workers=decode_workers,
+                                         start=start, stats=stats, stop=stop_after(5))[0]
+            parts.append(part_zip)
+            if 'resume_frame' not in stats:
+                break
+            start = stats['resume_frame']
+
+    merged_zip = str(tmp_path / "merged.zip")
+    assert merge_zips(parts, merged_zip) == (True, 14)
+    assert len(parts) == 3
+    with zipfile.ZipFile(full_zip) as expected, zipfile.ZipFile(merged_zip) as actual:
+        assert actual.namelist() == expected.namelist()
+        for name in expected.namelist():
+            assert actual.read(name) == expected.read(name)
+
+def test_extract_frames_cannot_stop_filtered_sampling(sample_video, tmp_path):
+    sampling = {'mode': 'interval', 'frame_interval': 5, 'dedup': True}
+    assert extract_frames_to_zip(sample_video, str(tmp_path / "frames.zip"), sampling=sampling,
+                                 stop=lambda: False) == (False, 0)
+
+class LambdaContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+def checkpointing_extract(resume_frame):
+    def extract(source, upload, stats, stop, **kwargs):
+        if stop():
+            stats['resume_frame'] = resume_frame
+        return True, 5
+    return extract
+
+def draining_extract(context, resume_frame):
+    # The invocation's time runs out during extraction
+    def extract(source, upload, stats, stop, **kwargs):
+        context.remaining_ms = 1000
+        return checkpointing_extract(resume_frame)(source, upload, stats, stop)
+    return extract
+
+def test_handler_checkpoints_when_time_runs_low(mock_event, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.download_video.return_value = True
+    context = LambdaContext(600000)
+    mock_video_utils.side_effect = draining_extract(context, 150)
+    mock_event['Records'][0]['eventSourceARN'] = 'arn:aws:sqs:us-east-1:123456789012:videos-large'
+
+    response = handler(mock_event, context)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['next_frame'] == 150
+    # The first run's archive becomes part 0
+    mock_storage.copy_object.assert_called_once_with(
+        'out', 'outputs/test-user/test-video-123/frames.zip', 'out', 'outputs/test-user/test-video-123/chunks/0000.zip'
+    )
+    mock_storage.save_checkpoint.assert_called_once_with('test-user', 'test-video-123', 150, 1)
+    queue_url, messages = mock_storage.enqueue_messages.call_args.args
+    assert queue_url == 'https://sqs.us-east-1.amazonaws.com/123456789012/videos-large'
+    assert messages[0]['video_id'] == 'test-video-123'
+    mock_storage.notify_completion.assert_not_called()
+
+def test_handler_does_not_checkpoint_with_time_left(mock_event, mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+    mock_video_utils.side_effect = checkpointing_extract(150)
+
+    response = handler(mock_event, LambdaContext(600000))
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['message'] == 'Processing completed successfully'
+    mock_storage.save_checkpoint.assert_not_called()
+
+def test_handler_resumes_from_checkpoint(mock_event, mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('OUTPUT_BUCKET', 'out')
+    mock_storage.download_video.return_value = True
+    mock_storage.get_checkpoint.return_value = {'next_frame': 300, 'parts': 2}
+    reporter = mock_storage.progress_reporter.return_value
+
+    with patch('src.main.merge_zips', return_value=(True, 45)):
+        response = handler(mock_event, LambdaContext(600000))
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['frame_count'] == 45
+    mock_storage.open_zip_upload.assert_any_call('out', 'outputs/test-user/test-video-123/chunks/0002.zip')
+    kwargs = mock_video_utils.call_args.kwargs
+    assert (kwargs['start'], kwargs['end']) == (300, None)
+    # Progress covers the whole video, not just the rest of it
+    kwargs['progress'](10, 90)
+    reporter.assert_called_once_with(310, 390)
+    # Resumed jobs skip the cache lookup and fan-out, and start no new PROCESSING status
+    assert all(call.args[2] != 'PROCESSING' for call in mock_storage.update_status.call_args_list)
+    mock_storage.delete_objects.assert_called_once_with('out', [
+        f'outputs/test-user/test-video-123/chunks/{i:04d}.zip' for i in range(3)
+    ])
+    mock_storage.clear_checkpoint.assert_called_once_with('test-user', 'test-video-123')
+    mock_storage.update_status.assert_called_with('test-user', 'test-video-123', 'COMPLETED',
+                                                output_url='s3://out/outputs/test-user/test-video-123/frames.zip')
+
+def test_handler_checkpoint_without_progress_fails(mock_event, mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+    context = LambdaContext(600000)
+    mock_video_utils.side_effect = draining_extract(context, 0)
+
+    response = handler(mock_event, context)
+
+    assert response['statusCode'] == 500
+    assert 'No frames extracted' in response['body']
+    mock_storage.enqueue_messages.assert_not_called()
+
+def batch_event(count):
+    return {
+        'Records': [
+            {
+                'messageId': f'message-{i}',
+                'body': json.dumps({
+                    'user_id': 'test-user',
+                    'video_id': f'video-{i}',
+                    'video_key': f'inputs/test-user/video-{i}/video.mp4'
+                })
+            }
+            for i in range(count)
+        ]
+    }
+
+def test_handler_defers_records_without_time(mock_storage, mock_video_utils, monkeypatch):
+    monkeypatch.setenv('RESUME_QUEUE_URL', 'https://sqs/videos')
+    mock_storage.download_video.return_value = True
+    context = LambdaContext(600000)
+    # The first record uses up the invocation
+    mock_video_utils.side_effect = draining_extract(context, 150)
+
+    response = handler(batch_event(2), context)
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    results = json.loads(response['body'])['results']
+    assert [r['message'] for r in results] == ['Processing checkpointed', 'Processing deferred']
+    # The deferred record is left as it was: not downloaded, failed or notified
+    assert mock_storage.download_video.call_count == 1
+    assert all(call.args[1] == 'video-0' for call in mock_storage.update_status.call_args_list)
+    mock_storage.fail_job.assert_not_called()
+    mock_storage.notify_completion.assert_not_called()
+
+def test_handler_defers_later_record_without_progress(mock_storage, mock_video_utils):
+    mock_storage.download_video.return_value = True
+    context = LambdaContext(600000)
+    drain = draining_extract(context, 0)
+    # The first record finishes; the second runs out of time before its first frame
+    mock_video_utils.side_effect = lambda *args, **kwargs: \
+        drain(*args, **kwargs) if mock_video_utils.call_count == 2 else (True, 5)
+
+    response = handler(batch_event(2), context)
 
+    # The second record started after the first, so running out of time is not its fault
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    assert json.loads(response['body'])['results'][1]['message'] == 'Processing deferred'
+    mock_storage.fail_job.assert_not_called()
+    mock_storage.save_checkpoint.assert_not_called()
+    mock_storage.notify_completion.assert_called_once_with('test-user', 'video-0', 'COMPLETED', output_url=mock.ANY)